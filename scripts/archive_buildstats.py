@@ -2,38 +2,121 @@
 #
 # SPDX-License-Identifier: GPL-2.0-only
 #
-import glob, os, random, subprocess, socket, sys
+# Archive the buildstats of a build into <dest>/<target>/buildstats
+#
+# Each buildstats timestamp directory is streamed into its own tarball
+# compressed by a multi-threaded zstd, the timestamps are processed in
+# parallel and every archive is renamed into place once complete.
+#
+# Builds with intermittent failure host data are always archived, others
+# are sampled deterministically from a hash of the build ID and target so
+# it's possible to work out which builds were archived.
+#
+
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import os
+import socket
+import subprocess
+import sys
+import tarfile
 
-def usage():
-     print("Usage: " + sys.argv[0] + " <src> <dest> <target>")
+def build_id_from_dest(dest):
+    """Results are published to <buildname>/testresults, use the build name"""
+    dest = os.path.abspath(dest)
+    if os.path.basename(dest) == "testresults":
+        dest = os.path.dirname(dest)
+    return os.path.basename(dest)
+
+def sampled(build_id, target, rate):
+    """Return True if this build is in the rate percent of builds sampled"""
+    digest = hashlib.sha256(("%s:%s" % (build_id, target)).encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) % 10000 < rate * 100
+
+def archive_timestamp(build_bsdir, timestamp, dest_bsdir, output):
+    final = os.path.join(dest_bsdir, output)
+    tmp = os.path.join(dest_bsdir, "." + output + ".tmp")
+    try:
+        with open(tmp, "wb") as out:
+            zstd = subprocess.Popen(["zstd", "-T0", "-q", "-c"], stdin=subprocess.PIPE, stdout=out)
+            try:
+                # Same layout as 'tar -cf <output> <timestamp>/*', which
+                # leaves out hidden files
+                with tarfile.open(fileobj=zstd.stdin, mode="w|") as tar:
+                    for name in sorted(os.listdir(os.path.join(build_bsdir, timestamp))):
+                        if name.startswith("."):
+                            continue
+                        tar.add(os.path.join(build_bsdir, timestamp, name), arcname=timestamp + "/" + name)
+            finally:
+                zstd.stdin.close()
+                ret = zstd.wait()
+        if ret:
+            raise subprocess.CalledProcessError(ret, "zstd")
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    os.rename(tmp, final)
+    return final
 
 def main():
-    if len(sys.argv) != 4:
-        usage()
-        sys.exit()
+    parser = argparse.ArgumentParser(description="Archive the buildstats of a build")
+    parser.add_argument("builddir", help="The build directory")
+    parser.add_argument("dest", help="The results directory")
+    parser.add_argument("target", help="The target being built")
+    parser.add_argument("--build-id",
+                        help="Build identifier used for sampling (default: the build name from the results directory)")
+    parser.add_argument("--sample-rate",
+                        type=float, default=1.0,
+                        help="Percentage of builds without failures to archive")
+    parser.add_argument("-j", "--jobs",
+                        type=int, default=4,
+                        help="Number of timestamp directories to archive in parallel")
+    parser.add_argument("--store",
+                        help="Also ingest the archived buildstats into this buildstats_store.py store")
+    args = parser.parse_args()
 
-    builddir = sys.argv[1]
-    dest = sys.argv[2]
-    target = sys.argv[3]
+    builddir = args.builddir
+    dest = args.dest
+    target = args.target
     dest_bsdir = os.path.join(dest, target, "buildstats")
-    subprocess.run(["mkdir", "-p", dest_bsdir])
+    os.makedirs(dest_bsdir, exist_ok=True)
 
     build_bsdir = os.path.join(builddir, "tmp/buildstats")
     if not os.path.exists(build_bsdir):
         sys.exit(0)
     hostname = socket.gethostname()
-    os.chdir(build_bsdir)
     fail_path = os.path.join(dest, target, "intermittent_failure_host_data")
     fail_output = glob.glob(fail_path + '/*top_summary.txt')
 
-    #archive the buildstats of failures and 1% of random builds
-    if fail_output or random.randint(1,100)%100 == 0:
-        for timestamp in os.listdir(build_bsdir):
+    build_id = args.build_id or build_id_from_dest(dest)
+    if fail_output:
+        print("Archiving buildstats, intermittent failure data present")
+    elif sampled(build_id, target, args.sample_rate):
+        print("Archiving buildstats, %s:%s is in the %s%% sample" % (build_id, target, args.sample_rate))
+    else:
+        return
+
+    #archive the buildstats of failures and a sample of other builds
+    timestamps = [t for t in sorted(os.listdir(build_bsdir)) if os.path.isdir(os.path.join(build_bsdir, t))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = []
+        archives = []
+        for timestamp in timestamps:
             if hostname:
                 output = hostname + "-" + timestamp + ".tar.zst"
             else:
                 output = "nohostname-"+ timestamp + ".tar.zst"
-            subprocess.check_call("tar -I zstd -cf "+output+" "+timestamp+"/*", shell=True)
-            subprocess.run(["mv", output, dest_bsdir])
+            futures.append(executor.submit(archive_timestamp, build_bsdir, timestamp, dest_bsdir, output))
+        for future in futures:
+            archives.append(future.result())
+            print("Archived %s" % archives[-1])
+
+    if args.store:
+        # numpy is only needed on workers which maintain a store
+        import buildstats_store
+        buildstats_store.ingest(args.store, archives)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
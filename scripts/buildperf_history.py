@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Local history of build performance test results with change detection
+#
+# The results of each oe-build-perf-test run (results.json and metadata.json
+# in its output directory) are ingested into an SQLite database keyed by
+# host, branch, machine and commit, one row per measurement: the elapsed time
+# of resource measurements and the size of disk usage measurements.
+# globalres.log files can be ingested as well to backfill older history,
+# lines for commits already ingested from JSON results are skipped.
+#
+# Each measurement series is then checked for change points: a run from
+# which all later runs lie outside the noise band (median +/- a multiple of
+# the median absolute deviation) of the runs before it. The summary is short
+# enough to be appended to the report email.
+#
+
+import fcntl
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import time
+
+import utils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    file TEXT,
+    host TEXT,
+    branch TEXT,
+    machine TEXT,
+    commit_id TEXT,
+    commit_count INTEGER,
+    ingested REAL
+);
+CREATE INDEX IF NOT EXISTS runs_file ON runs(file);
+CREATE INDEX IF NOT EXISTS runs_series ON runs(host, branch, machine, commit_count);
+CREATE TABLE IF NOT EXISTS measurements (
+    run INTEGER,
+    test TEXT,
+    name TEXT,
+    kind TEXT,
+    value REAL,
+    PRIMARY KEY (run, test, name, kind)
+) WITHOUT ROWID;
+"""
+
+# Columns of globalres.log after host, branch:commit and commit count as
+# written by oe-build-perf-test, (test, measurement, kind)
+GLOBALRES_COLUMNS = [
+    ("test1", "build", "time"),
+    ("test12", "build", "time"),
+    ("test13", "build", "time"),
+    ("test2", "do_rootfs", "time"),
+    ("test3", "parse_1", "time"),
+    ("test3", "parse_2", "time"),
+    ("test3", "parse_3", "time"),
+    ("test4", "deploy", "time"),
+    ("test1", "tmpdir", "size"),
+    ("test13", "tmpdir", "size"),
+    ("test4", "installer_bin", "size"),
+    ("test4", "deploy_dir", "size"),
+]
+
+UNITS = {"time" : "s", "size" : " KiB"}
+
+def parse_duration(value):
+    """Accept seconds or a [H:]MM:SS[.ff] duration"""
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+def json_measurements(results):
+    """Yield (test, measurement, kind, value) from an oe-build-perf-test results.json"""
+    for testname, test in results.get("tests", {}).items():
+        if test.get("status") not in ("SUCCESS", "EXPECTED_FAILURE"):
+            continue
+        for name, m in test.get("measurements", {}).items():
+            values = m.get("values", {})
+            if m.get("type") == "sysres" and "elapsed_time" in values:
+                yield testname, name, "time", float(values["elapsed_time"])
+            elif m.get("type") == "diskusage" and "size" in values:
+                yield testname, name, "size", float(values["size"])
+
+def globalres_runs(path):
+    """
+    Return [(host, branch, commit, commit count, measurements)] for the lines
+    of a globalres.log and the number of lines skipped. Only lines with the
+    columns of GLOBALRES_COLUMNS are understood, logs from releases with a
+    different set of tests are skipped rather than misread.
+    """
+    runs = []
+    skipped = 0
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            fields = line.split(",")
+            if len(fields) != 3 + len(GLOBALRES_COLUMNS) or ":" not in fields[1]:
+                skipped += 1
+                continue
+            branch, commit = fields[1].rsplit(":", 1)
+            try:
+                values = [parse_duration(v) if kind == "time" else float(v)
+                          for v, (_, _, kind) in zip(fields[3:], GLOBALRES_COLUMNS)]
+                commit_count = int(fields[2])
+            except ValueError:
+                skipped += 1
+                continue
+            # Skipped or failed tests are recorded as 0
+            measurements = [c + (v,) for c, v in zip(GLOBALRES_COLUMNS, values) if v]
+            runs.append((fields[0], branch, commit, commit_count, measurements))
+    return runs, skipped
+
+def find_results(paths):
+    """Yield oe-build-perf-test output directories and globalres.log files below paths"""
+    for path in paths:
+        if os.path.isfile(path):
+            yield os.path.abspath(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            if "results.json" in files and "metadata.json" in files:
+                yield os.path.abspath(root)
+            if "globalres.log" in files:
+                yield os.path.abspath(os.path.join(root, "globalres.log"))
+
+def median_band(values, k, minrel):
+    """Return the median and the half width of the noise band of values"""
+    median = statistics.median(values)
+    mad = statistics.median(abs(v - median) for v in values)
+    # 1.4826 scales the MAD to a standard deviation for normal noise. Disk
+    # usage is often identical between runs so allow a minimal relative band.
+    return median, max(k * 1.4826 * mad, minrel * abs(median))
+
+def change_point(values, window=10, recent=3, minruns=5, k=3.0, minrel=0.02):
+    """
+    Find the earliest of the last recent values from which all later values
+    are outside the noise band of the window of values before it. Returns
+    (index, median before, median after, band) or None.
+    """
+    for i in range(max(minruns, len(values) - recent), len(values)):
+        before = values[max(0, i - window):i]
+        after = values[i:]
+        median, band = median_band(before, k, minrel)
+        if all(v > median + band for v in after) or all(v < median - band for v in after):
+            return i, median, statistics.median(after), band
+    return None
+
+class BuildPerfHistory(object):
+    def __init__(self, dbpath):
+        utils.mkdir(os.path.dirname(os.path.abspath(dbpath)))
+        self.db = sqlite3.connect(dbpath, timeout=60)
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def changed(self, path, st):
+        return self.db.execute("SELECT mtime, size FROM files WHERE path = ?", (path,)).fetchone() != (st.st_mtime_ns, st.st_size)
+
+    def add_run(self, path, host, branch, machine, commit, commit_count, measurements):
+        runid = self.db.execute("INSERT INTO runs (file, host, branch, machine, commit_id, commit_count, ingested) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (path, host, branch, machine, commit, commit_count, time.time())).lastrowid
+        self.db.executemany("INSERT OR REPLACE INTO measurements VALUES (?, ?, ?, ?, ?)", [(runid,) + m for m in measurements])
+
+    def delete_runs(self, where, params):
+        runs = [r for (r,) in self.db.execute("SELECT id FROM runs WHERE " + where, params).fetchall()]
+        for runid in runs:
+            self.db.execute("DELETE FROM measurements WHERE run = ?", (runid,))
+            self.db.execute("DELETE FROM runs WHERE id = ?", (runid,))
+
+    def ingest_results(self, path):
+        """Add an oe-build-perf-test output directory, returns the number of runs added"""
+        st = os.stat(os.path.join(path, "results.json"))
+        if not self.changed(path, st):
+            return 0
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        with open(os.path.join(path, "results.json")) as f:
+            results = json.load(f)
+        meta = metadata.get("layers", {}).get("meta", {})
+        key = (metadata.get("hostname"), meta.get("branch"), metadata.get("config", {}).get("MACHINE"), meta.get("commit"))
+        with self.db:
+            self.delete_runs("file = ?", (path,))
+            # The same run may have been backfilled from globalres.log
+            self.delete_runs("host = ? AND branch = ? AND machine = ? AND commit_id = ? AND file LIKE '%/globalres.log'", key)
+            self.add_run(path, *key, meta.get("commit_count"), list(json_measurements(results)))
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, st.st_mtime_ns, st.st_size))
+        return 1
+
+    def ingest_globalres(self, path, machine):
+        """Add the runs of a globalres.log not already known, returns the number of runs added"""
+        st = os.stat(path)
+        if not self.changed(path, st):
+            return 0
+        runs, skipped = globalres_runs(path)
+        if skipped:
+            print("Skipped %d unrecognised lines of %s" % (skipped, path), file=sys.stderr)
+        added = 0
+        with self.db:
+            self.delete_runs("file = ?", (path,))
+            for host, branch, commit, commit_count, measurements in runs:
+                if self.db.execute("SELECT 1 FROM runs WHERE host = ? AND branch = ? AND machine = ? AND commit_id = ? AND file != ? LIMIT 1",
+                                   (host, branch, machine, commit, path)).fetchone():
+                    continue
+                self.add_run(path, host, branch, machine, commit, commit_count, measurements)
+                added += 1
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, st.st_mtime_ns, st.st_size))
+        return added
+
+    def series(self, host, branch, machine):
+        """Return the runs [(commit, commit count)] and {(test, measurement, kind): [value or None per run]}"""
+        runs = self.db.execute("SELECT id, commit_id, commit_count FROM runs WHERE host = ? AND branch = ? AND machine = ? "
+                               "ORDER BY commit_count, id", (host, branch, machine)).fetchall()
+        index = dict((r[0], i) for i, r in enumerate(runs))
+        series = {}
+        for run, test, name, kind, value in self.db.execute("SELECT measurements.* FROM measurements JOIN runs ON runs.id = measurements.run "
+                                                            "WHERE host = ? AND branch = ? AND machine = ?", (host, branch, machine)):
+            series.setdefault((test, name, kind), [None] * len(runs))[index[run]] = value
+        return [(r[1], r[2]) for r in runs], series
+
+    def changes(self, host, branch, machine, **kwargs):
+        """Return the runs and a list of (test, measurement, kind, first changed commit, runs since, before, after, band)"""
+        runs, series = self.series(host, branch, machine)
+        changes = []
+        for key in sorted(series):
+            points = [(run, v) for run, v in zip(runs, series[key]) if v is not None]
+            found = change_point([v for _, v in points], **kwargs)
+            if found:
+                i, before, after, band = found
+                changes.append(key + (points[i][0][0], len(points) - i, before, after, band))
+        return runs, changes
+
+def lock_history(dbpath):
+    lf = open(dbpath + ".lock", "a+")
+    fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+    return lf
+
+def ingest(dbpath, paths, machine="qemux86"):
+    """Ingest results directories and globalres.log files found below paths, returns the number of runs added"""
+    with lock_history(dbpath):
+        history = BuildPerfHistory(dbpath)
+        added = 0
+        found = list(find_results(paths))
+        # JSON results first so they take precedence over globalres.log lines
+        for path in found:
+            if os.path.isdir(path):
+                added += history.ingest_results(path)
+        for path in found:
+            if not os.path.isdir(path):
+                added += history.ingest_globalres(path, machine)
+        history.close()
+    return added
+
+def format_summary(host, branch, machine, runs, changes):
+    out = "Build performance history for %s on %s (%s), %d runs\n" % (branch, host, machine, len(runs))
+    if not changes:
+        return out + "No measurements moved outside the noise band of recent runs\n"
+    for test, name, kind, commit, count, before, after, band in changes:
+        unit = UNITS[kind]
+        out += "    %s.%s %s: %.1f%s -> %.1f%s (%+.1f%%, noise +/-%.1f%s) since %s (%d run%s)\n" % (
+            test, name, kind, before, unit, after, unit, (after - before) * 100 / before if before else 0,
+            band, unit, (commit or "unknown")[:12], count, "s" if count > 1 else "")
+    return out
+
+def summary(dbpath, host, branch, machine, **kwargs):
+    """Return the change summary of a series, or None if there is no history for it"""
+    if not os.path.exists(dbpath):
+        return None
+    history = BuildPerfHistory(dbpath)
+    try:
+        runs, changes = history.changes(host, branch, machine, **kwargs)
+    finally:
+        history.close()
+    if not runs:
+        return None
+    return format_summary(host, branch, machine, runs, changes)
+
+def results_summary(dbpath, path, **kwargs):
+    """Return the change summary of the series an ingested results directory belongs to"""
+    if not os.path.exists(dbpath):
+        return None
+    history = BuildPerfHistory(dbpath)
+    try:
+        row = history.db.execute("SELECT host, branch, machine FROM runs WHERE file = ?", (os.path.abspath(path),)).fetchone()
+    finally:
+        history.close()
+    if not row:
+        return None
+    return summary(dbpath, *row, **kwargs)
+
+def main():
+    parser = utils.ArgParser(description='Maintain and check a local history of build performance test results.')
+    parser.add_argument('-d', '--database', required=True,
+                        help="The history database")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser('ingest', help="Add oe-build-perf-test output directories or globalres.log files")
+    p.add_argument('paths', nargs='+')
+    p.add_argument('-m', '--machine', default="qemux86",
+                   help="Machine of the runs in globalres.log files (default: %(default)s)")
+
+    p = subparsers.add_parser('summary', help="Report measurements which changed in recent runs")
+    p.add_argument('host')
+    p.add_argument('branch')
+    p.add_argument('-m', '--machine', default="qemux86",
+                   help="Machine (default: %(default)s)")
+    p.add_argument('--window', type=int, default=10,
+                   help="Number of runs forming the noise band (default: %(default)s)")
+    p.add_argument('--recent', type=int, default=3,
+                   help="Number of latest runs in which to look for a change (default: %(default)s)")
+    p.add_argument('-k', type=float, default=3.0,
+                   help="Width of the noise band in scaled MADs (default: %(default)s)")
+
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        start = time.time()
+        added = ingest(args.database, args.paths, args.machine)
+        print("Added %d runs in %.1fs" % (added, time.time() - start))
+    elif args.command == "summary":
+        out = summary(args.database, args.host, args.branch, args.machine, window=args.window, recent=args.recent, k=args.k)
+        if out is None:
+            print("No history for %s on %s (%s)" % (args.branch, args.host, args.machine))
+            return 1
+        sys.stdout.write(out)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
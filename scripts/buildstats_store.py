@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Columnar store of buildstats for cross-build queries
+#
+# Buildstats directories (or the .tar.zst archives written by
+# archive_buildstats.py) are ingested into a single NumPy .npz file holding
+# one row per task execution with the build, recipe, task, start time,
+# elapsed time, CPU time and IO bytes as separate arrays, so top-N,
+# percentile and regression queries over hundreds of builds are a handful
+# of vectorised operations.
+#
+# Requires numpy.
+#
+
+import argparse
+import fcntl
+import os
+import socket
+import subprocess
+import sys
+import tarfile
+
+import numpy as np
+
+COLUMNS = {
+    "build" : np.int32,
+    "recipe" : np.int32,
+    "task" : np.int32,
+    "started" : np.float64,
+    "elapsed" : np.float32,
+    "cpu" : np.float32,
+    "read_bytes" : np.int64,
+    "write_bytes" : np.int64,
+}
+METRICS = ["elapsed", "cpu", "read_bytes", "write_bytes"]
+
+def parse_task(lines):
+    """Parse a buildstats task file into (started, elapsed, cpu, read_bytes, write_bytes)"""
+    values = {}
+    for line in lines:
+        key, sep, value = line.partition(":")
+        if not sep:
+            continue
+        values[key.strip()] = value.strip()
+    if "Elapsed time" not in values:
+        return None
+    def num(key):
+        try:
+            return float(values.get(key, "0").split()[0])
+        except (ValueError, IndexError):
+            return 0.0
+    cpu = num("rusage ru_utime") + num("rusage ru_stime") + num("Child rusage ru_utime") + num("Child rusage ru_stime")
+    return (num("Started"), num("Elapsed time"), cpu, int(num("IO read_bytes")), int(num("IO write_bytes")))
+
+def recipe_name(pf):
+    """Buildstats directories are named ${PF}, strip the version and revision"""
+    parts = pf.rsplit("-", 2)
+    if len(parts) == 3:
+        return parts[0]
+    return pf
+
+def read_buildstats_dir(tsdir):
+    """Yield (recipe, task, values) for the tasks in a timestamp directory"""
+    for pf in sorted(os.listdir(tsdir)):
+        recipedir = os.path.join(tsdir, pf)
+        if not os.path.isdir(recipedir):
+            continue
+        for task in sorted(os.listdir(recipedir)):
+            with open(os.path.join(recipedir, task), errors="replace") as f:
+                values = parse_task(f)
+            if values:
+                yield recipe_name(pf), task, values
+
+def read_buildstats_tarball(path):
+    """Yield (recipe, task, values) from an archive_buildstats.py tarball"""
+    zstd = subprocess.Popen(["zstd", "-d", "-q", "-c", path], stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=zstd.stdout, mode="r|") as tar:
+            for member in tar:
+                parts = member.name.split("/")
+                # <timestamp>/<PF>/<task>
+                if not member.isfile() or len(parts) != 3:
+                    continue
+                data = tar.extractfile(member).read().decode("utf-8", errors="replace")
+                values = parse_task(data.splitlines())
+                if values:
+                    yield recipe_name(parts[1]), parts[2], values
+    finally:
+        zstd.stdout.close()
+        zstd.wait()
+
+class BuildstatsStore(object):
+    def __init__(self, path):
+        self.path = path
+        self._columns = dict((c, np.zeros(0, dtype=t)) for c, t in COLUMNS.items())
+        # Builds added since the columns were last concatenated
+        self._pending = dict((c, []) for c in COLUMNS)
+        self.builds = []
+        self.build_times = []
+        self.recipes = []
+        self.tasks = []
+        if os.path.exists(path):
+            with np.load(path) as data:
+                for c in COLUMNS:
+                    self._columns[c] = data[c]
+                self.builds = data["builds"].tolist()
+                self.build_times = data["build_times"].tolist()
+                self.recipes = data["recipes"].tolist()
+                self.tasks = data["tasks"].tolist()
+        self.buildset = set(self.builds)
+
+    @property
+    def columns(self):
+        """The column arrays, added builds are concatenated on first use"""
+        if self._pending["build"]:
+            for c in COLUMNS:
+                self._columns[c] = np.concatenate([self._columns[c]] + self._pending[c])
+                self._pending[c] = []
+        return self._columns
+
+    def save(self):
+        tmp = self.path + ".tmp.npz"
+        np.savez(tmp, builds=np.array(self.builds, dtype=str), build_times=np.array(self.build_times, dtype=np.float64),
+            recipes=np.array(self.recipes, dtype=str), tasks=np.array(self.tasks, dtype=str), **self.columns)
+        os.rename(tmp, self.path)
+
+    def add_build(self, build_id, rows):
+        """Add the (recipe, task, values) rows of a build, returns False if already present"""
+        if build_id in self.buildset:
+            return False
+        recipeids = dict((r, i) for i, r in enumerate(self.recipes))
+        taskids = dict((t, i) for i, t in enumerate(self.tasks))
+        buildid = len(self.builds)
+        new = dict((c, []) for c in COLUMNS)
+        for recipe, task, values in rows:
+            if recipe not in recipeids:
+                recipeids[recipe] = len(self.recipes)
+                self.recipes.append(recipe)
+            if task not in taskids:
+                taskids[task] = len(self.tasks)
+                self.tasks.append(task)
+            new["build"].append(buildid)
+            new["recipe"].append(recipeids[recipe])
+            new["task"].append(taskids[task])
+            for c, v in zip(["started", "elapsed", "cpu", "read_bytes", "write_bytes"], values):
+                new[c].append(v)
+        started = [s for s in new["started"] if s]
+        self.builds.append(build_id)
+        self.buildset.add(build_id)
+        self.build_times.append(min(started) if started else 0.0)
+        for c, t in COLUMNS.items():
+            self._pending[c].append(np.array(new[c], dtype=t))
+        return True
+
+    def latest_builds(self, count):
+        order = np.argsort(np.array(self.build_times))
+        return order[-count:]
+
+    def top(self, metric, limit, build=None):
+        if build is None:
+            build = self.latest_builds(1)[0]
+        rows = np.nonzero(self.columns["build"] == build)[0]
+        values = self.columns[metric][rows]
+        best = rows[np.argsort(values)[::-1][:limit]]
+        return [(self.recipes[self.columns["recipe"][i]], self.tasks[self.columns["task"][i]], self.columns[metric][i]) for i in best]
+
+    def percentiles(self, metric, percentiles, builds=None):
+        """Per task name percentiles of metric, returns {task : (count, [values])}"""
+        mask = np.ones(len(self.columns["task"]), dtype=bool)
+        if builds is not None:
+            mask = np.isin(self.columns["build"], builds)
+        tasks = self.columns["task"][mask]
+        values = self.columns[metric][mask]
+        order = np.lexsort((values, tasks))
+        tasks = tasks[order]
+        values = values[order]
+        counts = np.bincount(tasks, minlength=len(self.tasks))
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        present = np.nonzero(counts)[0]
+        result = {}
+        pvalues = []
+        for p in percentiles:
+            idx = offsets[present] + np.floor((counts[present] - 1) * p / 100.0).astype(np.int64)
+            pvalues.append(values[idx])
+        for n, t in enumerate(present):
+            result[self.tasks[t]] = (int(counts[t]), [float(pv[n]) for pv in pvalues])
+        return result
+
+    def mean_by_key(self, metric, builds):
+        """Mean of metric per recipe:task over builds, plus the number of samples"""
+        mask = np.isin(self.columns["build"], builds)
+        keys = self.columns["recipe"][mask].astype(np.int64) * len(self.tasks) + self.columns["task"][mask]
+        size = len(self.recipes) * len(self.tasks)
+        counts = np.bincount(keys, minlength=size)
+        sums = np.bincount(keys, weights=self.columns[metric][mask], minlength=size)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return sums / counts, counts
+
+    def regressions(self, metric, recent, baseline, threshold, minimum):
+        """
+        Compare the mean of metric per recipe:task over the most recent
+        builds against the builds before them. Returns rows of
+        (recipe, task, baseline mean, recent mean) which grew by more than
+        threshold times and minimum in absolute terms.
+        """
+        order = self.latest_builds(recent + baseline)
+        if len(order) <= recent:
+            return []
+        recentmean, recentcount = self.mean_by_key(metric, order[-recent:])
+        basemean, basecount = self.mean_by_key(metric, order[:-recent])
+        candidates = np.nonzero((recentcount > 0) & (basecount > 0) &
+                                (recentmean > basemean * threshold) & (recentmean - basemean > minimum))[0]
+        candidates = candidates[np.argsort((recentmean - basemean)[candidates])[::-1]]
+        ntasks = len(self.tasks)
+        return [(self.recipes[k // ntasks], self.tasks[k % ntasks], float(basemean[k]), float(recentmean[k])) for k in candidates]
+
+def lock_store(path):
+    lf = open(path + ".lock", "a+")
+    fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+    return lf
+
+def ingest(storepath, sources, build_prefix=None):
+    """
+    Ingest buildstats timestamp directories, directories containing them
+    or archive_buildstats.py tarballs. Build IDs match the archive names,
+    <hostname>-<timestamp>.
+    """
+    build_prefix = build_prefix or socket.gethostname() or "nohostname"
+    with lock_store(storepath):
+        store = BuildstatsStore(storepath)
+        added = 0
+        for source in sources:
+            if source.endswith(".tar.zst"):
+                builds = [(os.path.basename(source)[:-len(".tar.zst")], read_buildstats_tarball(source))]
+            elif any(os.path.isdir(os.path.join(source, e)) and not e[0].isdigit() for e in os.listdir(source)):
+                builds = [(build_prefix + "-" + os.path.basename(os.path.normpath(source)), read_buildstats_dir(source))]
+            else:
+                builds = [(build_prefix + "-" + ts, read_buildstats_dir(os.path.join(source, ts))) for ts in sorted(os.listdir(source))
+                          if os.path.isdir(os.path.join(source, ts))]
+            for build_id, rows in builds:
+                if store.add_build(build_id, rows):
+                    print("Ingested %s" % build_id)
+                    added += 1
+        if added:
+            store.save()
+    return added
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar buildstats store and queries")
+    parser.add_argument("-s", "--store", required=True, help="The store (.npz) file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("ingest", help="Add buildstats directories or .tar.zst archives")
+    p.add_argument("sources", nargs="+")
+    p.add_argument("--host", help="Hostname to prefix build IDs of directories with")
+
+    p = subparsers.add_parser("top", help="Show the most expensive tasks of a build")
+    p.add_argument("-m", "--metric", choices=METRICS, default="elapsed")
+    p.add_argument("-n", "--limit", type=int, default=20)
+    p.add_argument("-b", "--build", help="Build ID (default: the most recent)")
+
+    p = subparsers.add_parser("percentiles", help="Show per task percentiles across builds")
+    p.add_argument("-m", "--metric", choices=METRICS, default="elapsed")
+    p.add_argument("-p", "--percentile", type=float, action="append")
+    p.add_argument("-r", "--recent", type=int, help="Only use the most recent N builds")
+
+    p = subparsers.add_parser("regressions", help="Show recipe tasks which got slower recently")
+    p.add_argument("-m", "--metric", choices=METRICS, default="elapsed")
+    p.add_argument("-r", "--recent", type=int, default=7, help="Number of recent builds")
+    p.add_argument("-B", "--baseline", type=int, default=28, help="Number of builds before those to compare against")
+    p.add_argument("-t", "--threshold", type=float, default=1.5, help="Ratio of recent to baseline mean to report")
+    p.add_argument("--minimum", type=float, default=10.0, help="Minimum absolute increase to report")
+
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        ingest(args.store, args.sources, args.host)
+        return 0
+
+    store = BuildstatsStore(args.store)
+    if not store.builds:
+        print("Store %s is empty" % args.store)
+        return 1
+    if args.command == "top":
+        build = None
+        if args.build:
+            if args.build not in store.buildset:
+                print("Build %s is not in store %s" % (args.build, args.store))
+                return 1
+            build = store.builds.index(args.build)
+        for recipe, task, value in store.top(args.metric, args.limit, build):
+            print("%14.2f  %s:%s" % (value, recipe, task))
+    elif args.command == "percentiles":
+        percentiles = args.percentile or [50, 90, 99]
+        builds = store.latest_builds(args.recent) if args.recent else None
+        print("%-30s %8s  %s" % ("Task", "Count", "  ".join("%12s" % ("p%g" % p) for p in percentiles)))
+        for task, (count, values) in sorted(store.percentiles(args.metric, percentiles, builds).items()):
+            print("%-30s %8d  %s" % (task, count, "  ".join("%12.2f" % v for v in values)))
+    elif args.command == "regressions":
+        for recipe, task, before, after in store.regressions(args.metric, args.recent, args.baseline, args.threshold, args.minimum):
+            print("%12.2f -> %12.2f (%+.0f%%)  %s:%s" % (before, after, (after / before - 1) * 100 if before else 0, recipe, task))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
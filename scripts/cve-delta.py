@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Report the changes between consecutive cve-check cve-summary.json reports
+#
+# Each report is indexed by (recipe, CVE) to its status, so comparing two
+# full world reports is a pair of dictionary passes. Issues which became
+# unpatched, were fixed or became ignored are listed per recipe along with
+# issues no longer reported at all (e.g. removed recipes).
+#
+
+import argparse
+import collections
+import json
+import sys
+
+import utils
+
+CATEGORIES = [
+    ("unpatched", "Newly unpatched"),
+    ("fixed", "Newly fixed"),
+    ("ignored", "Newly ignored"),
+    ("removed", "No longer reported"),
+]
+
+def index_report(filename):
+    """Return {(recipe, CVE): status} for a cve-summary.json"""
+    index = {}
+    for name, issues in utils.cvesummary_packages(filename):
+        for cve, status in issues:
+            index[(name, cve)] = status
+    return index
+
+def delta(old, new):
+    """Return {category: sorted [(recipe, CVE, old status, new status)]} between two indexes"""
+    changes = collections.defaultdict(list)
+    for key, status in new.items():
+        before = old.get(key)
+        if before == status:
+            continue
+        if status == "Unpatched":
+            changes["unpatched"].append(key + (before, status))
+        elif status == "Patched" and before == "Unpatched":
+            changes["fixed"].append(key + (before, status))
+        elif status == "Ignored":
+            changes["ignored"].append(key + (before, status))
+    for key, before in old.items():
+        if before == "Unpatched" and key not in new:
+            changes["removed"].append(key + (before, None))
+    return dict((c, sorted(changes[c])) for c, _ in CATEGORIES)
+
+def format_delta(oldname, newname, changes):
+    out = "CVE changes from %s to %s\n\n" % (oldname, newname)
+    out += ", ".join("%d %s" % (len(changes[c]), title.lower()) for c, title in CATEGORIES) + "\n"
+
+    recipes = collections.defaultdict(collections.Counter)
+    for c, _ in CATEGORIES:
+        for recipe, _, _, _ in changes[c]:
+            recipes[recipe][c] += 1
+    if recipes:
+        out += "\nPer recipe:\n"
+        out += "  %-40s %s\n" % ("recipe", " ".join("%9s" % c for c, _ in CATEGORIES))
+        for recipe in sorted(recipes, key=lambda r: (-recipes[r]["unpatched"], r)):
+            out += "  %-40s %s\n" % (recipe, " ".join("%9d" % recipes[recipe][c] for c, _ in CATEGORIES))
+
+    for c, title in CATEGORIES:
+        if not changes[c]:
+            continue
+        out += "\n%s:\n" % title
+        for recipe, cve, before, after in changes[c]:
+            out += "  %s: https://web.nvd.nist.gov/view/vuln/detail?vulnId=%s (%s -> %s)\n" % (recipe, cve, before or "not reported", after or "not reported")
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the changes between consecutive cve-summary.json reports")
+    parser.add_argument("reports", nargs="+",
+                        help="cve-summary.json files, oldest first")
+    parser.add_argument("--json", action="store_true",
+                        help="Output the changes as JSON")
+    args = parser.parse_args()
+
+    if len(args.reports) < 2:
+        parser.error("At least two reports are needed")
+
+    results = []
+    old = index_report(args.reports[0])
+    for i, (oldname, newname) in enumerate(zip(args.reports, args.reports[1:])):
+        new = index_report(newname)
+        changes = delta(old, new)
+        if args.json:
+            results.append({"from" : oldname, "to" : newname, "changes" : changes})
+        else:
+            if i:
+                print("")
+            sys.stdout.write(format_delta(oldname, newname, changes))
+        old = new
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print("")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
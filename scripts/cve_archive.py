@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Compact content-addressed archive of cve-check reports
+#
+# Consecutive cve-summary.json reports mostly contain identical package
+# records, so rather than storing each report in full every package record
+# is stored once under objects/<sha256 prefix>/<sha256>.json and each report
+# becomes a manifest in snapshots/<branch>/<timestamp>.json listing its
+# packages in order:
+#
+#   {"version": 1,
+#    "report": {<top level fields of the report, "package": null>},
+#    "packages": [
+#   [<name>, <object hash>, [<unpatched CVE ids>]],
+#   ...]}
+#
+# with one package per line so manifests delta well in git. Reports can be
+# reconstructed from the manifests and objects, and CVE counts computed from
+# the manifests alone. Objects no snapshot refers to any more can be removed
+# with gc.
+#
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import sys
+
+import utils
+
+MANIFEST_VERSION = 1
+
+class CVEArchive(object):
+    def __init__(self, path):
+        self.path = path
+
+    def lock(self):
+        # Outside the archive so it isn't committed along with it
+        utils.mkdir(os.path.dirname(os.path.abspath(self.path)))
+        lf = open(self.path.rstrip("/") + ".lock", "a+")
+        fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+        return lf
+
+    def objectpath(self, digest):
+        return os.path.join(self.path, "objects", digest[:2], digest[2:] + ".json")
+
+    def manifestpath(self, branch, timestamp):
+        return os.path.join(self.path, "snapshots", branch, "%s.json" % timestamp)
+
+    def write_atomic(self, path, data):
+        utils.mkdir(os.path.dirname(path))
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def add_object(self, record):
+        """Store a package record, returns its hash and whether it was new"""
+        data = json.dumps(record, separators=(",", ":"))
+        digest = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        path = self.objectpath(digest)
+        if os.path.exists(path):
+            return digest, False
+        self.write_atomic(path, data + "\n")
+        return digest, True
+
+    def add(self, branch, timestamp, filename):
+        """Add a cve-summary.json as the snapshot for branch at timestamp, returns (packages, new objects)"""
+        report = {}
+        entries = []
+        new = 0
+        # Stream the report so only one package record is in memory at a time
+        with self.lock(), open(filename) as f:
+            reader = utils.JSONStreamReader(f)
+            for key in reader.items():
+                if key != "package":
+                    report[key] = reader.read_value()
+                    continue
+                report[key] = None
+                for _ in reader.elements():
+                    record = reader.read_value()
+                    digest, added = self.add_object(record)
+                    new += added
+                    unpatched = [i['id'] for i in record.get('issue', []) if i['status'] == "Unpatched"]
+                    entries.append(json.dumps([record.get('name'), digest, unpatched]))
+            data = '{"version": %d,\n"report": %s,\n"packages": [\n%s]}\n' % (MANIFEST_VERSION, json.dumps(report), ",\n".join(entries))
+            self.write_atomic(self.manifestpath(branch, timestamp), data)
+        return len(entries), new
+
+    def import_reports(self, directory):
+        """Add the <branch>/<timestamp>.json reports below directory, yields (branch, timestamp, packages, new objects)"""
+        for branch in sorted(os.listdir(directory)):
+            branchdir = os.path.join(directory, branch)
+            if not os.path.isdir(branchdir):
+                continue
+            for f in sorted(os.listdir(branchdir)):
+                timestamp = f[:-len(".json")]
+                if not f.endswith(".json") or not timestamp.isdigit():
+                    continue
+                yield (branch, timestamp) + self.add(branch, timestamp, os.path.join(branchdir, f))
+
+    def branches(self):
+        try:
+            return sorted(os.listdir(os.path.join(self.path, "snapshots")))
+        except FileNotFoundError:
+            return []
+
+    def snapshots(self, branch):
+        """Return the timestamps of the snapshots of a branch, oldest first"""
+        try:
+            names = os.listdir(os.path.join(self.path, "snapshots", branch))
+        except FileNotFoundError:
+            return []
+        return sorted((n[:-len(".json")] for n in names if n.endswith(".json")), key=lambda t: (len(t), t))
+
+    def manifest(self, branch, timestamp):
+        return load_manifest(self.manifestpath(branch, timestamp))
+
+    def report(self, branch, timestamp):
+        """Reconstruct the report of a snapshot"""
+        manifest = self.manifest(branch, timestamp)
+        packages = []
+        for name, digest, unpatched in manifest["packages"]:
+            with open(self.objectpath(digest)) as f:
+                packages.append(json.load(f))
+        report = manifest["report"]
+        report["package"] = packages
+        return report
+
+    def gc(self, dry_run=False):
+        """
+        Remove the objects no snapshot refers to and temporary files left by
+        interrupted writes, returns (files removed, bytes)
+        """
+        count = size = 0
+        with self.lock():
+            referenced = set()
+            for branch in self.branches():
+                for timestamp in self.snapshots(branch):
+                    referenced.update(digest for _, digest, _ in self.manifest(branch, timestamp)["packages"])
+            for root, dirs, files in os.walk(self.path):
+                for name in files:
+                    p = os.path.join(root, name)
+                    if not name.endswith(".tmp"):
+                        if os.path.dirname(root) != os.path.join(self.path, "objects"):
+                            continue
+                        if os.path.basename(root) + name[:-len(".json")] in referenced:
+                            continue
+                    size += os.lstat(p).st_size
+                    count += 1
+                    if not dry_run:
+                        os.unlink(p)
+        return count, size
+
+def load_manifest(filename):
+    with open(filename) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError("Unsupported manifest version in %s" % filename)
+    return manifest
+
+def manifest_unpatched(filename):
+    """Yield (package name, [unpatched CVE ids]) from a snapshot manifest"""
+    for name, digest, unpatched in load_manifest(filename)["packages"]:
+        yield name, unpatched
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain and read a compact archive of cve-check reports")
+    parser.add_argument("-a", "--archive", required=True,
+                        help="The archive directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("add", help="Add a cve-summary.json as a snapshot")
+    p.add_argument("branch")
+    p.add_argument("timestamp")
+    p.add_argument("report")
+
+    p = subparsers.add_parser("import", help="Add all the <branch>/<timestamp>.json reports below a directory")
+    p.add_argument("directory")
+
+    p = subparsers.add_parser("list", help="List the snapshots")
+    p.add_argument("branch", nargs="?")
+
+    p = subparsers.add_parser("cat", help="Reconstruct a report")
+    p.add_argument("branch")
+    p.add_argument("timestamp", nargs="?",
+                   help="The snapshot to show (default: the latest)")
+
+    p = subparsers.add_parser("gc", help="Remove the package records no snapshot refers to")
+    p.add_argument("-n", "--dry-run", action="store_true",
+                   help="Only report what would be removed")
+
+    args = parser.parse_args()
+    archive = CVEArchive(args.archive)
+
+    if args.command == "add":
+        packages, new = archive.add(args.branch, args.timestamp, args.report)
+        print("Added %s/%s: %d packages, %d new records" % (args.branch, args.timestamp, packages, new))
+    elif args.command == "import":
+        for branch, timestamp, packages, new in archive.import_reports(args.directory):
+            print("Added %s/%s: %d packages, %d new records" % (branch, timestamp, packages, new))
+    elif args.command == "list":
+        for branch in [args.branch] if args.branch else archive.branches():
+            for timestamp in archive.snapshots(branch):
+                print("%s %s" % (branch, timestamp))
+    elif args.command == "cat":
+        timestamp = args.timestamp
+        if not timestamp:
+            snapshots = archive.snapshots(args.branch)
+            if not snapshots:
+                print("No snapshots for %s" % args.branch, file=sys.stderr)
+                return 1
+            timestamp = snapshots[-1]
+        json.dump(archive.report(args.branch, timestamp), sys.stdout, indent=2)
+        print()
+    elif args.command == "gc":
+        count, size = archive.gc(args.dry_run)
+        print("%s %d files (%d bytes) from %s" % ("Would remove" if args.dry_run else "Removed", count, size, args.archive))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,11 +6,18 @@
 #
 
 import argparse
+import collections
+import concurrent.futures
+import fcntl
 import os
 import glob
+import hashlib
 import json
 import re
 import subprocess
+import sys
+import time
+import utils
 from jinja2 import Template
 
 index_template = """
@@ -19,10 +26,30 @@ index_template = """
 <head>
   <meta charset="utf-8">
   <meta name="viewport" content="width=device-width, initial-scale=1">
-  <title>Index of autobuilder test results</title>
+  <title>Index of autobuilder test results{% if title %} - {{title}}{% endif %}</title>
   <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bulma@0.9.1/css/bulma.min.css">
 </head>
 <body>
+<nav class="breadcrumb">
+<ul>
+  <li><a href="index.html">Latest builds</a></li>
+  {% if title %}<li class="is-active"><a href="#">{{title}}</a></li>{% endif %}
+</ul>
+</nav>
+{% if shards %}
+<p>Older builds by month:
+{% for shard in shards %}
+  <a href="{{shard[1]}}">{{shard[0]}}</a>
+{% endfor %}
+</p>
+{% endif %}
+{% if pages|length > 1 %}
+<p>Pages:
+{% for page in pages %}
+  {% if loop.index == pagenum %}<strong>{{loop.index}}</strong>{% else %}<a href="{{page}}">{{loop.index}}</a>{% endif %}
+{% endfor %}
+</p>
+{% endif %}
  
 <table class="table is-narrow is-striped">
 <thead>
@@ -75,32 +102,90 @@ index_template = """
 </html>
 """
 
+COMMANDS = ['index', 'ptest-logs', 'prune-objects']
+
 def parse_args(argv=None):
     """Parse command line arguments"""
     parser = argparse.ArgumentParser(
             description="Generate an html index for a directory of autobuilder results",
             formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
 
-    parser.add_argument('path', help='path to directory to index')
+    index = subparsers.add_parser('index', help='generate index.html (the default command)',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    index.add_argument('path', help='path to directory to index')
+    index.add_argument('--cache',
+                        help='per build metadata cache (default: .index-cache.json in the indexed directory)')
+    index.add_argument('--full', action='store_true',
+                        help='rescan every build instead of only new or changed ones')
+    index.add_argument('--no-ptest-logs', action='store_true',
+                        help='don\'t extract missing ptest logs of rescanned builds first')
+    index.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of ptest log extractions to run in parallel')
+    index.add_argument('--latest', type=int, default=100,
+                        help='number of builds on the landing page')
+    index.add_argument('--page-size', type=int, default=500,
+                        help='maximum number of builds per page of a month')
 
-    return parser.parse_args(argv)
+    ptestlogs = subparsers.add_parser('ptest-logs', help='extract missing ptest logs with resulttool',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    ptestlogs.add_argument('path', help='path to directory of builds')
+    ptestlogs.add_argument('builds', nargs='*', help='only process these builds (default: all)')
+    ptestlogs.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of extractions to run in parallel')
+    ptestlogs.add_argument('--retry-failed', action='store_true',
+                        help='retry directories where extraction failed before')
+
+    prune = subparsers.add_parser('prune-objects', help='remove collect-results store objects no build links to any more',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    prune.add_argument('path', help='path to directory of builds')
+    prune.add_argument('--min-age', type=int, default=86400,
+                        help='only remove objects older than this many seconds, so collections in progress are safe')
+    prune.add_argument('-n', '--dry-run', action='store_true',
+                        help='only report what would be removed')
 
-args = parse_args()
-path = os.path.abspath(args.path)
-entries = []
+    if argv is None:
+        argv = sys.argv[1:]
+    # Keep 'generate-testresult-index.py <path>' working
+    if argv and argv[0] not in COMMANDS and argv[0] not in ['-h', '--help']:
+        argv = ['index'] + argv
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.error("a command or path is required")
+    return args
+
+CACHE_VERSION = 1
+
+# The collect-results object store in the results root
+STORE_DIR = ".objects"
+
+BRANCH_PATH = ['configuration', 'LAYERS', 'meta', 'branch']
+
+def get_file_branch(f):
+    # The configuration is at the start of the first record so streaming
+    # only needs to read a tiny prefix of what can be a very large file
+    try:
+        return utils.json_find(f, [None] + BRANCH_PATH)
+    except ValueError:
+        # Not something the streaming reader understands, use a full parse
+        pass
+    with open(f, "r") as filedata:
+        data = json.load(filedata)
+    for build in data:
+        try:
+            return data[build]['configuration']['LAYERS']['meta']['branch']
+        except KeyError:
+            continue
+    raise KeyError(BRANCH_PATH)
 
 def get_build_branch(p):
     for root, dirs, files in os.walk(p):
         for name in files:
             if name == "testresults.json":
-                f = os.path.join(root, name)
-                with open(f, "r") as filedata:
-                    data = json.load(filedata)
-                for build in data:
-                    try:
-                        return data[build]['configuration']['LAYERS']['meta']['branch']
-                    except KeyError:
-                        continue 
+                try:
+                    return get_file_branch(os.path.join(root, name))
+                except KeyError:
+                    continue
 
     return ""
 
@@ -113,15 +198,29 @@ def keygen(k):
     else:
         return k
 
-for build in sorted(os.listdir(path), key=keygen, reverse=True):
-    buildpath = os.path.join(path, build, "testresults")
-    if not os.path.exists(buildpath):
-        # No test results
-        continue
-    reldir = "./" + build + "/"
+def build_signature(buildpath):
+    """
+    Everything the index shows lives at most three levels below the
+    testresults directory, so the names and mtimes of the directories in
+    the top two levels change whenever any of it is added or removed.
+    """
+    h = hashlib.sha1()
+    pending = [(buildpath, 0)]
+    while pending:
+        d, depth = pending.pop()
+        with os.scandir(d) as it:
+            for entry in sorted(it, key=lambda e: e.name):
+                if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+                    continue
+                h.update(("%s %d\n" % (os.path.relpath(entry.path, buildpath), entry.stat(follow_symlinks=False).st_mtime_ns)).encode("utf-8", "surrogateescape"))
+                if depth < 1:
+                    pending.append((entry.path, depth + 1))
+    return h.hexdigest()
 
+def build_type(buildpath):
     btype = "other"
-    files = os.listdir(buildpath)
+    # Ignore hidden entries such as the collect-results object store
+    files = [f for f in os.listdir(buildpath) if not f.startswith(".")]
     if os.path.exists(buildpath + "/a-full-posttrigger") or \
             os.path.exists(buildpath + "/a-full"):
         btype = "full"
@@ -130,6 +229,13 @@ for build in sorted(os.listdir(path), key=keygen, reverse=True):
         btype = "quick"
     elif len(files) == 1:
         btype = files[0]
+    return btype
+
+def scan_build(path, build):
+    buildpath = os.path.join(path, build, "testresults")
+    reldir = "./" + build + "/"
+
+    btype = build_type(buildpath)
 
     testreport = ""
     if os.path.exists(buildpath + "/testresult-report.txt"):
@@ -175,9 +281,17 @@ for build in sorted(os.listdir(path), key=keygen, reverse=True):
 
     branch = get_build_branch(buildpath)
 
-    entries.append((build, reldir, btype, testreport, branch, buildhistory, perfreports, ptestlogs, hd, regressionreport))
+    return (build, reldir, btype, testreport, branch, buildhistory, perfreports, ptestlogs, hd, regressionreport)
+
+PTEST_LOCK = ".resulttool-log.lock"
+PTEST_FAILED = ".resulttool-log-failed"
 
-    # Also ensure we have saved out log data for ptest runs to aid debugging
+def ptest_dirs(buildpath, retry_failed=False):
+    """Return the ptest result directories of a build which have no logs saved yet"""
+    todo = []
+    if not os.path.exists(buildpath):
+        return todo
+    btype = build_type(buildpath)
     if "ptest" in btype or btype in ["full", "quick"]:
         for root, dirs, files in os.walk(buildpath):
             for name in dirs:
@@ -186,11 +300,254 @@ for build in sorted(os.listdir(path), key=keygen, reverse=True):
                     logs = glob.glob(f + "/*.log")
                     if logs:
                         continue
-                    subprocess.check_call(["resulttool", "log", f, "--dump-ptest", f])
-                    # Ensure we don't rerun every time with a dummy log
-                    with open(f + "/resulttool-done.log", "a+") as tf:
-                        tf.write("\n")
-
-t = Template(index_template)
-with open(os.path.join(path, "index.html"), 'w') as f:
-    f.write(t.render(entries = entries))
+                    if not retry_failed and os.path.exists(os.path.join(f, PTEST_FAILED)):
+                        continue
+                    todo.append(f)
+    return todo
+
+def dump_ptest_log(f, retry_failed=False):
+    """
+    Save out log data for a ptest run to aid debugging. A lock per
+    directory stops concurrent runs duplicating the work, failures are
+    recorded in a marker file rather than stopping the index.
+    """
+    with open(os.path.join(f, PTEST_LOCK), "a") as lock:
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return "locked"
+        if glob.glob(f + "/*.log") or (not retry_failed and os.path.exists(os.path.join(f, PTEST_FAILED))):
+            return "done"
+        error = None
+        try:
+            subprocess.run(["resulttool", "log", f, "--dump-ptest", f], check=True,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            error = "%s\n%s" % (e, e.output.decode("utf-8", errors="replace"))
+        except OSError as e:
+            error = str(e)
+        if error:
+            with open(os.path.join(f, PTEST_FAILED), "w") as marker:
+                marker.write(error)
+            return "failed"
+        # Ensure we don't rerun every time with a dummy log
+        with open(f + "/resulttool-done.log", "a+") as tf:
+            tf.write("\n")
+        if os.path.exists(os.path.join(f, PTEST_FAILED)):
+            os.unlink(os.path.join(f, PTEST_FAILED))
+        return "dumped"
+
+def dump_ptest_logs(dirs, jobs, retry_failed=False):
+    """Run the extractions in a bounded pool, returns the count of each outcome"""
+    counts = collections.Counter()
+    # The work happens in the resulttool processes, threads only wait for them
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = dict((executor.submit(dump_ptest_log, f, retry_failed), f) for f in dirs)
+        for future in concurrent.futures.as_completed(futures):
+            status = future.result()
+            if status == "failed":
+                print("Extracting ptest logs failed for %s, see %s" % (futures[future], PTEST_FAILED))
+            counts[status] += 1
+    return counts
+
+def load_cache(cachefile):
+    try:
+        with open(cachefile) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("version") != CACHE_VERSION:
+        return {}
+    return cache.get("builds", {})
+
+def save_cache(cachefile, builds):
+    tmp = cachefile + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version" : CACHE_VERSION, "builds" : builds}, f)
+    os.rename(tmp, cachefile)
+
+# Fields of an index entry, the JSON listing uses these names
+ENTRY_FIELDS = ["build", "url", "type", "report", "branch", "buildhistory", "perf", "ptest", "hostdata", "regressions"]
+LINK_FIELDS = ["buildhistory", "perf", "ptest", "hostdata"]
+
+def entry_json(entry):
+    data = dict(zip(ENTRY_FIELDS, entry))
+    for field in LINK_FIELDS:
+        data[field] = [{"url" : link[0], "name" : link[1]} for link in data[field]]
+    return data
+
+def build_month(build):
+    """Builds are named <YYYYMMDD>-<N>, anything else is sharded as 'other'"""
+    m = re.match(r"(\d{4})(\d{2})\d{2}-\d+$", build)
+    if m:
+        return m.group(1) + "-" + m.group(2)
+    return "other"
+
+def shard_pages(shard, count, pagesize):
+    pages = ["index-%s.html" % shard]
+    for n in range(2, (count + pagesize - 1) // pagesize + 1):
+        pages.append("index-%s-%d.html" % (shard, n))
+    return pages
+
+def write_atomic(filename, data):
+    tmp = os.path.join(os.path.dirname(filename), "." + os.path.basename(filename) + ".tmp")
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.rename(tmp, filename)
+
+def write_shard(path, shard, entries, pagesize, force):
+    """
+    Write index-<shard>.json and the pages of a month, unless the listing
+    is unchanged since the last run. Returns True if anything was written.
+    """
+    jsonfile = os.path.join(path, "index-%s.json" % shard)
+    listing = json.dumps({"shard" : shard, "builds" : [entry_json(e) for e in entries]}, indent=1)
+    pages = shard_pages(shard, len(entries), pagesize)
+    if not force and all(os.path.exists(os.path.join(path, p)) for p in pages):
+        try:
+            with open(jsonfile) as f:
+                if f.read() == listing:
+                    return False
+        except OSError:
+            pass
+    t = Template(index_template)
+    for n, page in enumerate(pages):
+        write_atomic(os.path.join(path, page), t.render(entries = entries[n * pagesize:(n + 1) * pagesize],
+            title = shard, pages = pages, pagenum = n + 1, shards = []))
+    write_atomic(jsonfile, listing)
+    return True
+
+SHARD_RE = re.compile(r"index-(\d{4}-\d{2}|other)(-\d+)?\.(html|json)$")
+
+def remove_stale_shards(path, keep):
+    """
+    Remove the shard pages and listings not in keep, left over from months
+    which have fewer builds than before or none at all any more. Returns
+    the number of files removed.
+    """
+    removed = 0
+    for name in os.listdir(path):
+        if SHARD_RE.match(name) and name not in keep:
+            os.unlink(os.path.join(path, name))
+            removed += 1
+    return removed
+
+def list_builds(path):
+    # Hidden entries such as the collect-results object store aren't builds
+    return sorted((b for b in os.listdir(path) if not b.startswith(".")), key=keygen, reverse=True)
+
+def cmd_ptest_logs(args):
+    path = os.path.abspath(args.path)
+    builds = args.builds or list_builds(path)
+    dirs = []
+    for build in builds:
+        dirs.extend(ptest_dirs(os.path.join(path, build, "testresults"), args.retry_failed))
+    counts = dump_ptest_logs(dirs, args.jobs, args.retry_failed)
+    print("Extracted ptest logs for %d directories, %d failed, %d in progress elsewhere" % (
+        counts["dumped"], counts["failed"], counts["locked"]))
+    return 1 if counts["failed"] else 0
+
+def cmd_index(args):
+    path = os.path.abspath(args.path)
+    cachefile = args.cache or os.path.join(path, ".index-cache.json")
+    cache = {} if args.full else load_cache(cachefile)
+    newcache = {}
+    builds = []
+    pending = []
+
+    for build in list_builds(path):
+        buildpath = os.path.join(path, build, "testresults")
+        if not os.path.exists(buildpath):
+            # No test results
+            continue
+        builds.append(build)
+
+        # The cache is keyed on the mtime of the testresults directory and
+        # a signature of the directories below it
+        cached = cache.get(build)
+        if cached and cached["mtime"] == os.stat(buildpath).st_mtime_ns and cached["signature"] == build_signature(buildpath):
+            newcache[build] = cached
+        else:
+            pending.append(build)
+
+    # Extract missing ptest logs first so the index lists them straight away
+    if pending and not args.no_ptest_logs:
+        dirs = []
+        for build in pending:
+            dirs.extend(ptest_dirs(os.path.join(path, build, "testresults")))
+        dump_ptest_logs(dirs, args.jobs)
+
+    for build in pending:
+        buildpath = os.path.join(path, build, "testresults")
+        mtime = os.stat(buildpath).st_mtime_ns
+        signature = build_signature(buildpath)
+        newcache[build] = {"mtime" : mtime, "signature" : signature, "entry" : scan_build(path, build)}
+
+    entries = [newcache[build]["entry"] for build in builds]
+
+    # One set of pages and an index-<month>.json per month, builds are
+    # already sorted newest first
+    shards = collections.OrderedDict()
+    for entry in entries:
+        shards.setdefault(build_month(entry[0]), []).append(entry)
+    written = 0
+    keep = set()
+    for shard, shardentries in shards.items():
+        if write_shard(path, shard, shardentries, args.page_size, args.full):
+            written += 1
+        keep.add("index-%s.json" % shard)
+        keep.update(shard_pages(shard, len(shardentries), args.page_size))
+    removed = remove_stale_shards(path, keep)
+
+    # The landing page lists the most recent builds and links to the months
+    shardlinks = [(shard, "index-%s.html" % shard) for shard in shards]
+    t = Template(index_template)
+    write_atomic(os.path.join(path, "index.html"), t.render(entries = entries[:args.latest],
+        title = None, pages = [], pagenum = 1, shards = shardlinks))
+    write_atomic(os.path.join(path, "index.json"), json.dumps({
+        "builds" : [entry_json(e) for e in entries[:args.latest]],
+        "shards" : [{"shard" : shard, "url" : link, "json" : "index-%s.json" % shard, "count" : len(shards[shard])} for shard, link in shardlinks],
+    }, indent=1))
+
+    save_cache(cachefile, newcache)
+    print("Indexed %d builds, %d rescanned, %d of %d months updated, %d stale month pages removed" % (
+        len(entries), len(pending), written, len(shards), removed))
+    return 0
+
+def cmd_prune_objects(args):
+    """
+    collect-results hardlinks the builds' files to objects in the .objects
+    store of the results root, so once every build using an object has been
+    deleted the store holds the only link left.
+    """
+    store = os.path.join(os.path.abspath(args.path), STORE_DIR)
+    now = time.time()
+    count = size = 0
+    for root, dirs, files in os.walk(store):
+        for name in files:
+            p = os.path.join(root, name)
+            try:
+                st = os.lstat(p)
+            except FileNotFoundError:
+                continue
+            # Objects keep the mtime of the collected file, the ctime is
+            # when they were added or last linked
+            if st.st_nlink > 1 or now - st.st_ctime < args.min_age:
+                continue
+            if not args.dry_run:
+                os.unlink(p)
+            count += 1
+            size += st.st_size
+    print("%s %d unreferenced objects (%d bytes) from %s" % ("Would remove" if args.dry_run else "Removed", count, size, store))
+    return 0
+
+def main():
+    args = parse_args()
+    if args.command == "ptest-logs":
+        return cmd_ptest_logs(args)
+    if args.command == "prune-objects":
+        return cmd_prune_objects(args)
+    return cmd_index(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
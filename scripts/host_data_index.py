@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Timeline index of the intermittent failure host data across builds
+#
+# Every top invocation in the host_stats files collected into
+# <results>/<target>/intermittent_failure_host_data is reduced to a compact
+# record (load average, top CPU users, zombie and qemu counts, other builds
+# running on the worker) and stored in an SQLite database per worker so
+# patterns across hundreds of builds can be queried by worker, time window
+# or failure type and dumped as JSON for dashboards.
+#
+# The worker and the buildstats directory the data came from are taken from
+# the collect-results manifest. The date comes from the buildstats timestamp
+# and the time of day from the top output itself. Without a manifest the
+# date is worked out back from the mtime of the file instead.
+#
+
+import datetime
+import glob
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import utils
+import summarize_top_output
+
+HOST_DATA_DIR = "intermittent_failure_host_data"
+MANIFEST = "collect-results-manifest.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    file TEXT,
+    seq INTEGER,
+    time REAL,
+    build TEXT,
+    target TEXT,
+    failure TEXT,
+    load1 REAL,
+    load5 REAL,
+    load15 REAL,
+    zombies INTEGER,
+    qemu INTEGER,
+    hogs TEXT,
+    zombie_procs TEXT,
+    other_builds TEXT,
+    PRIMARY KEY (file, seq)
+);
+CREATE INDEX IF NOT EXISTS snapshots_time ON snapshots(time);
+CREATE INDEX IF NOT EXISTS snapshots_failure ON snapshots(failure);
+"""
+
+COLUMNS = ["time", "build", "target", "failure", "load1", "load5", "load15", "zombies", "qemu", "hogs", "zombie_procs", "other_builds"]
+JSON_COLUMNS = ["hogs", "zombie_procs", "other_builds"]
+
+top_re = re.compile(r"^top - (\d+):(\d+):(\d+) .*load average: ([\d.]+),? ([\d.]+),? ([\d.]+)")
+stats_re = re.compile(r"^host_stats_?(.*?)_failure_\d+\.txt$")
+
+def failure_type(name):
+    """host_stats_do_testimage_failure_1.txt is a do_testimage failure, anything else is interval data"""
+    m = stats_re.match(name)
+    if m:
+        return m.group(1) or "failure"
+    return "interval"
+
+def buildstats_start(source):
+    """Return the start of the build from the buildstats timestamp directory of a collected file"""
+    if not source:
+        return None
+    try:
+        return datetime.datetime.strptime(os.path.basename(os.path.dirname(source)), "%Y%m%d%H%M%S")
+    except ValueError:
+        return None
+
+def mtime_start(mtime):
+    """
+    The file was last written after its snapshots were taken, so when the
+    build start is unknown its snapshots are placed in the day before that
+    """
+    return datetime.datetime.fromtimestamp(mtime) - datetime.timedelta(days=1)
+
+def snapshot_time(start, header):
+    """
+    top only prints the time of day, combine it with the build start,
+    moving to the following day(s) as the time of day wraps around.
+    """
+    m = top_re.match(header)
+    if not m or not start:
+        return start, None
+    clock = datetime.time(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+    when = datetime.datetime.combine(start.date(), clock)
+    if when < start:
+        when += datetime.timedelta(days=1)
+    return when, [float(m.group(i)) for i in range(4, 7)]
+
+def snapshot_record(snapshot, start):
+    header = snapshot.short_summary[0] if snapshot.short_summary else ""
+    when, load = snapshot_time(start, header)
+    if when:
+        start = when
+    hogs = []
+    for line in snapshot.short_summary[summarize_top_output.top_header:]:
+        fields = line.split(maxsplit=summarize_top_output.max_cols)
+        if len(fields) <= summarize_top_output.max_cols:
+            continue
+        try:
+            cpu = float(fields[8])
+        except ValueError:
+            cpu = None
+        hogs.append([cpu, summarize_top_output.summarize_path(fields[-1].split()[0])])
+    qemu = sum(count for prog, count in snapshot.summary.items() if os.path.basename(prog).startswith("qemu"))
+    record = {
+        "time" : when.timestamp() if when else None,
+        "load1" : load[0] if load else None,
+        "load5" : load[1] if load else None,
+        "load15" : load[2] if load else None,
+        "zombies" : sum(snapshot.zombie_summary.values()),
+        "qemu" : qemu,
+        "hogs" : hogs,
+        "zombie_procs" : dict(snapshot.zombie_summary.most_common()),
+        "other_builds" : list(snapshot.other_builds),
+    }
+    return record, start
+
+def find_host_data(paths):
+    """Yield (build, target, targetdir) for each host data directory below paths"""
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            # Skip hidden directories such as the collect-results object store
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            if HOST_DATA_DIR not in dirs:
+                continue
+            dirs.remove(HOST_DATA_DIR)
+            targetdir = root
+            dest = os.path.dirname(targetdir)
+            if os.path.basename(dest) == "testresults":
+                dest = os.path.dirname(dest)
+            yield os.path.basename(dest), os.path.basename(targetdir), targetdir
+
+def read_manifest(targetdir):
+    try:
+        with open(os.path.join(targetdir, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+class HostDataIndex(object):
+    def __init__(self, indexdir, worker):
+        utils.mkdir(indexdir)
+        self.db = sqlite3.connect(os.path.join(indexdir, worker + ".sqlite"))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def ingest(self, path, build, target, source):
+        """Add the snapshots of a host data file, returns the number of new snapshots"""
+        st = os.stat(path)
+        known = self.db.execute("SELECT mtime, size FROM files WHERE path = ?", (path,)).fetchone()
+        if known == (st.st_mtime_ns, st.st_size):
+            return 0
+        snapshots, _ = summarize_top_output.summarize_top(path)
+        start = buildstats_start(source) or mtime_start(st.st_mtime)
+        failure = failure_type(os.path.basename(path))
+        rows = []
+        for seq, snapshot in enumerate(snapshots):
+            record, start = snapshot_record(snapshot, start)
+            record.update({"build" : build, "target" : target, "failure" : failure})
+            for c in JSON_COLUMNS:
+                record[c] = json.dumps(record[c])
+            rows.append([path, seq] + [record[c] for c in COLUMNS])
+        with self.db:
+            self.db.execute("DELETE FROM snapshots WHERE file = ?", (path,))
+            self.db.executemany("INSERT INTO snapshots VALUES (%s)" % ", ".join(["?"] * (len(COLUMNS) + 2)), rows)
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, st.st_mtime_ns, st.st_size))
+        return len(rows)
+
+    def query(self, since=None, until=None, failure=None, build=None):
+        query = "SELECT %s FROM snapshots WHERE 1" % ", ".join(COLUMNS)
+        params = []
+        if since is not None:
+            query += " AND time >= ?"
+            params.append(since)
+        if until is not None:
+            query += " AND time < ?"
+            params.append(until)
+        if failure:
+            query += " AND failure = ?"
+            params.append(failure)
+        if build:
+            query += " AND build = ?"
+            params.append(build)
+        query += " ORDER BY time, file, seq"
+        for row in self.db.execute(query, params):
+            record = dict(zip(COLUMNS, row))
+            for c in JSON_COLUMNS:
+                record[c] = json.loads(record[c])
+            yield record
+
+def cmd_ingest(args):
+    start = time.time()
+    indexes = {}
+    files = 0
+    added = 0
+    for build, target, targetdir in find_host_data(args.results):
+        manifest = read_manifest(targetdir)
+        worker = manifest.get("worker", "unknown")
+        if worker not in indexes:
+            indexes[worker] = HostDataIndex(args.index_dir, worker)
+        sources = manifest.get("files", {})
+        hostdata = os.path.join(targetdir, HOST_DATA_DIR)
+        names = set(glob.glob(hostdata + "/*_top.txt")) | set(glob.glob(hostdata + "/*_failure_*.txt"))
+        for path in sorted(names):
+            entry = sources.get(os.path.relpath(path, targetdir), {})
+            added += indexes[worker].ingest(os.path.abspath(path), build, target, entry.get("source"))
+            files += 1
+    for index in indexes.values():
+        index.close()
+    print("Checked %d files from %d workers in %.1fs, added %d snapshots" % (files, len(indexes), time.time() - start, added))
+    return 0
+
+def parse_time(value):
+    """Accept seconds since the epoch or an ISO 8601 date/time"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def cmd_query(args):
+    workers = args.worker
+    if not workers:
+        workers = sorted(f[:-len(".sqlite")] for f in os.listdir(args.index_dir) if f.endswith(".sqlite"))
+    since = parse_time(args.since) if args.since else None
+    until = parse_time(args.until) if args.until else None
+    records = []
+    for worker in workers:
+        if not os.path.exists(os.path.join(args.index_dir, worker + ".sqlite")):
+            print("No index for worker %s" % worker, file=sys.stderr)
+            return 1
+        index = HostDataIndex(args.index_dir, worker)
+        for record in index.query(since, until, args.failure, args.build):
+            record["worker"] = worker
+            records.append(record)
+        index.close()
+    records.sort(key=lambda r: (r["time"] is None, r["time"] or 0))
+    if args.json:
+        json.dump(records, sys.stdout, indent=args.indent)
+        print()
+        return 0
+    for r in records:
+        when = datetime.datetime.fromtimestamp(r["time"]).strftime("%Y-%m-%d %H:%M:%S") if r["time"] else "unknown"
+        load = "%.1f" % r["load1"] if r["load1"] is not None else "-"
+        print("%s %-20s %-20s %-24s load %6s zombies %3d qemu %3d other builds: %s" % (when, r["worker"], r["build"],
+            r["target"] + ":" + r["failure"], load, r["zombies"], r["qemu"], " ".join(r["other_builds"])))
+    return 0
+
+def main():
+    parser = utils.ArgParser(description='Index the intermittent failure host data of builds per worker.')
+    parser.add_argument('-i', '--index-dir',
+                        required=True,
+                        help="Directory holding the per worker index databases")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest = subparsers.add_parser('ingest', help="Add the host data found below results directories")
+    ingest.add_argument('results', nargs='+',
+                        help="Results directories to search for host data")
+    ingest.set_defaults(func=cmd_ingest)
+
+    query = subparsers.add_parser('query', help="Show snapshots matching the given filters")
+    query.add_argument('-w', '--worker', action='append',
+                       help="Worker to show (default: all)")
+    query.add_argument('--since',
+                       help="Start of the time window (epoch seconds or ISO 8601)")
+    query.add_argument('--until',
+                       help="End of the time window (epoch seconds or ISO 8601)")
+    query.add_argument('-f', '--failure',
+                       help="Failure type, the failing task or 'interval' for periodic data")
+    query.add_argument('-b', '--build',
+                       help="Build name")
+    query.add_argument('--json', action='store_true',
+                       help="Dump the records as JSON")
+    query.add_argument('--indent', type=int,
+                       help="Indentation of the JSON output")
+    query.set_defaults(func=cmd_query)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
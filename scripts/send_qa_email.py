@@ -5,6 +5,8 @@
 # Send email about the build to prompt QA to begin testing
 #
 
+import concurrent.futures
+import fcntl
 import json
 import os
 import sys
@@ -12,7 +14,10 @@ import subprocess
 import tempfile
 import re
 import logging
+import sqlite3
+import time
 
+import testresults_store
 import utils
 
 TEST_RESULTS_REPOSITORY_URL="git@push.yoctoproject.org:yocto-testresults"
@@ -27,7 +32,7 @@ def get_previous_tag(targetrepodir, version):
     previousmilestone = None
     if version:
         if not is_release_version(version):
-            return subprocess.check_output(["git", "describe", "--abbrev=0"], cwd=targetrepodir).decode('utf-8').strip()
+            return utils.gitdescribe(targetrepodir)
         compareversion, comparemilestone, _ = utils.get_version_from_string(version)
         compareversionminor = compareversion[-1]
         # After ignoring rc part, if we get a minor to 0 on point release (e.g 4.0.0),
@@ -47,7 +52,7 @@ def get_previous_tag(targetrepodir, version):
         else:
             comparetagstring = utils.get_tag_from_version(compareversion, comparemilestone)
             previous_major = compareversion[0] - 1
-            tags_list = subprocess.check_output(["git", "ls-remote", "--refs", "-t", "origin", f"refs/tags/yocto-{previous_major}*"], cwd=targetrepodir).decode('utf-8').strip()
+            tags_list = utils.lsremote(["--refs", "-t", "origin", f"refs/tags/yocto-{previous_major}*"], cwd=targetrepodir).strip()
             # Get last tag from list, pick only the tag part, and remove the
             # "refs/tags/" part
             return tags_list.splitlines()[-1].split()[1].split('/')[-1]
@@ -55,20 +60,20 @@ def get_previous_tag(targetrepodir, version):
         return utils.get_tag_from_version(previousversion, previousmilestone)
 
     # All other cases : merely check against latest tag reachable
-    defaultbaseversion, _, _ = utils.get_version_from_string(subprocess.check_output(["git", "describe", "--abbrev=0"], cwd=targetrepodir).decode('utf-8').strip())
+    defaultbaseversion, _, _ = utils.get_version_from_string(utils.gitdescribe(targetrepodir))
     return utils.get_tag_from_version(defaultbaseversion, None)
 
-def get_last_tested_rev_on_branch(branch, test_results_url, log):
+def get_last_tested_rev_on_branch(branch, test_results_url, log, cachedir=None):
     # Fetch latest test results revision on corresponding branch in test
     # results repository
-    tags_list = subprocess.check_output(["git", "ls-remote", "--refs", "-t", test_results_url, "refs/tags/" + branch + "/*"]).decode('utf-8').strip()
+    tags_list = utils.lsremote(["--refs", "-t", test_results_url, "refs/tags/" + branch + "/*"], cachedir).strip()
     latest_test_tag=tags_list.splitlines()[-1].split()[1]
     # From test results tag, extract Poky revision
     tested_revision = re.match('refs\/tags\/.*\/\d+-g([a-f0-9]+)\/\d', latest_test_tag).group(1)
     log.info(f"Last tested revision on branch {branch} is {tested_revision}")
     return tested_revision
 
-def get_regression_base_and_target(targetbranch, basebranch, release, targetrepodir, test_results_url, log):
+def get_regression_base_and_target(targetbranch, basebranch, release, targetrepodir, test_results_url, log, cachedir=None):
     if not targetbranch:
         # Targetbranch/basebranch is an arbitrary configuration (not defined in config.json): do not run regression reporting
         return None, None
@@ -81,19 +86,191 @@ def get_regression_base_and_target(targetbranch, basebranch, release, targetrepo
         # Basebranch/targetbranch are defined in config.json: regression
         # reporting must be done between latest test result available on base branch
         # and latest result on targetbranch
-        latest_tested_rev_on_basebranch = get_last_tested_rev_on_branch(basebranch, test_results_url, log)
+        latest_tested_rev_on_basebranch = get_last_tested_rev_on_branch(basebranch, test_results_url, log, cachedir)
         return latest_tested_rev_on_basebranch, targetbranch
 
     #Default case: return previous tag as base
     return get_previous_tag(targetrepodir, release), targetbranch
 
+def mirror_path(mirrorbase, url):
+    return os.path.join(mirrorbase, re.sub(r'[^A-Za-z0-9._-]', '_', url) + ".git")
+
+# How often the mirror is repacked, and how long objects no longer
+# referenced by it are kept for clones which may still be borrowing them
+MIRROR_GC_INTERVAL = 7 * 24 * 60 * 60
+MIRROR_PRUNE_EXPIRE = "2.days.ago"
+
+def update_testresults_mirror(url, mirrorbase, log):
+    """
+    Create or incrementally fetch the persistent mirror of the test results
+    repository, returns its path or None if it can't be used. Updates are
+    serialised with a lock. Clones of the mirror in use by other runs stay
+    valid as fetches only add objects and the periodic repack keeps
+    unreferenced objects for longer than any run takes.
+    """
+    mirror = mirror_path(mirrorbase, url)
+    utils.mkdir(mirrorbase)
+    with open(mirror + ".lock", "a+") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            update_mirror(mirror, url, log)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning(f"Unable to update test results mirror {mirror}, cloning instead: {e}")
+            return None
+        try:
+            gc_mirror(mirror, log)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning(f"Unable to repack test results mirror {mirror}: {e}")
+    return mirror
+
+def run(cmd, log, output=False, **kwargs):
+    """
+    Run a command with its messages going to log so that the output of
+    stages running concurrently doesn't interleave. With output, stdout is
+    returned rather than logged.
+    """
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE if output else subprocess.STDOUT, **kwargs)
+    messages = proc.stderr if output else proc.stdout
+    for line in messages.decode("utf-8", errors="replace").splitlines():
+        log.info(line)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, proc.stdout, proc.stderr)
+    return proc.stdout if output else None
+
+def update_mirror(mirror, url, log):
+    if not os.path.exists(mirror):
+        log.info(f"Creating test results mirror {mirror}")
+        tmp = mirror + ".tmp"
+        subprocess.call(["rm", "-rf", tmp])
+        run(["git", "clone", "--mirror", url, tmp], log)
+        # Clones share its objects, only gc_mirror() may prune them
+        run(["git", "config", "gc.auto", "0"], log, cwd=tmp)
+        os.rename(tmp, mirror)
+    else:
+        log.info(f"Updating test results mirror {mirror}")
+        run(["git", "fetch", "--prune", "--tags", "origin"], log, cwd=mirror)
+
+def gc_mirror(mirror, log, interval=MIRROR_GC_INTERVAL):
+    """Repack the mirror if it hasn't been for interval seconds"""
+    stamp = mirror + ".gc-stamp"
+    try:
+        if time.time() - os.stat(stamp).st_mtime < interval:
+            return False
+    except FileNotFoundError:
+        pass
+    log.info(f"Repacking test results mirror {mirror}")
+    run(["git", "gc", "--quiet", "--prune=" + MIRROR_PRUNE_EXPIRE], log, cwd=mirror)
+    with open(stamp, "w"):
+        pass
+    return True
+
+def clone_testresults(mirror, url, tempdir, cloneopts, log):
+    # The clone borrows the objects of the mirror so it's cheap, but has refs
+    # of its own for resulttool store. Fetches come from the mirror, pushes
+    # go to the real repository.
+    try:
+        run(["git", "clone", "--shared", "--single-branch", mirror, tempdir] + cloneopts, log)
+    except subprocess.CalledProcessError:
+        log.info("No comparision branch found, falling back to master")
+        subprocess.call(["rm", "-rf", tempdir])
+        run(["git", "clone", "--shared", "--single-branch", mirror, tempdir], log)
+    run(["git", "remote", "set-url", "--push", "origin", url], log, cwd=tempdir)
+
+def git_refs(repodir):
+    """Return {ref: object} for the branches and tags of a repository"""
+    out = subprocess.check_output(["git", "for-each-ref", "--format=%(refname) %(objectname)", "refs/heads", "refs/tags"],
+                                  cwd=repodir, universal_newlines=True)
+    return dict(line.split(" ", 1) for line in out.splitlines())
+
+def push_new_refs(repodir, before, force, log):
+    """
+    Push the branches and tags which were created or moved since before,
+    i.e. what resulttool store added. The clone can hold every tag of the
+    repository so pushing them all could resurrect or overwrite tags.
+    """
+    after = git_refs(repodir)
+    refs = sorted(ref for ref, obj in after.items() if before.get(ref) != obj)
+    if not refs:
+        log.info("No new test results to push")
+        return refs
+    prefix = "+" if force else ""
+    run(["git", "push", "origin"] + [prefix + ref + ":" + ref for ref in refs], log, cwd=repodir)
+    return refs
+
+def generate_store_regression_report(store, targetrepodir, base, revision, outputdir, log):
+    # The local store has the results of the build from collect-results,
+    # make sure all of them are there before comparing. The report has its
+    # own format so it goes alongside the resulttool one rather than
+    # replacing it.
+    try:
+        testresults_store.ingest(store, [outputdir])
+        regreport = testresults_store.regression_report(store, base, revision, targetrepodir)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        log.warning(f"Unable to use the test results store {store}: {e}")
+        return False
+    if regreport is None:
+        log.info(f"No results for {base} and {revision} in the test results store")
+        return False
+    with open(outputdir + "/testresult-regressions-store-report.txt", "w") as f:
+       f.write(regreport)
+    return True
+
 def generate_regression_report(querytool, targetrepodir, base, target, resultdir, outputdir, log):
     log.info(f"Comparing {target} to {base}")
 
-    regreport = subprocess.check_output([querytool, "regression-report", base, target, '-t', resultdir])
+    regreport = run([querytool, "regression-report", base, target, '-t', resultdir], log, output=True)
     with open(outputdir + "/testresult-regressions-report.txt", "wb") as f:
        f.write(regreport)
 
+class StageLog(logging.LoggerAdapter):
+    """Prefix messages with the stage they come from"""
+    def process(self, msg, kwargs):
+        return "[%s] %s" % (self.extra["stage"], msg), kwargs
+
+def run_stages(stages, log):
+    """
+    Run stages, a dict of name -> (function, [dependencies]), each as soon as
+    the stages it depends on are complete. Functions are passed the dict of
+    results so far and a log prefixing messages with the stage name, their
+    commands should go through run() with it. Once a stage fails no new
+    stages are started and the exception is raised when the running ones
+    have finished.
+    """
+    def timed(name, func, results):
+        stagelog = StageLog(log, {"stage" : name})
+        start = time.time()
+        try:
+            result = func(results, stagelog)
+        except Exception:
+            stagelog.error(f"Stage failed after {time.time() - start:.1f}s")
+            raise
+        stagelog.info(f"Stage finished in {time.time() - start:.1f}s")
+        return result
+
+    results = {}
+    pending = dict(stages)
+    running = {}
+    error = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while True:
+            if error is None:
+                for name, (func, deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        del pending[name]
+                        running[executor.submit(timed, name, func, dict(results))] = name
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    error = error or e
+    if error is not None:
+        raise error
+    return results
+
 def send_qa_email():
     # Setup logging
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
@@ -147,70 +324,105 @@ def send_qa_email():
         test_results_url = TEST_RESULTS_REPOSITORY_URL
 
     if 'poky' in repos and os.path.exists(resulttool) and os.path.exists(querytool) and args.results_dir:
-        utils.printheader("Processing test report")
         # Need the finalised revisions (not 'HEAD')
         targetrepodir = "%s/poky" % (repodir)
-        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=targetrepodir).decode('utf-8').strip()
+        revision = utils.githead(targetrepodir)
         branch = repos['poky']['branch']
         repo = repos['poky']['url']
 
         targetbranch, basebranch = utils.getcomparisonbranch(ourconfig, repo, branch)
-        report = subprocess.check_output([resulttool, "report", args.results_dir])
-        with open(args.results_dir + "/testresult-report.txt", "wb") as f:
-            f.write(report)
+        mirrorbase = utils.getconfig("TESTRESULTS_MIRROR_DIR", ourconfig)
+
+        def test_report(results, log):
+            log.info("Processing test report")
+            report = run([resulttool, "report", args.results_dir], log, output=True)
+            with open(args.results_dir + "/testresult-report.txt", "wb") as f:
+                f.write(report)
+
+        def regression_base(results, log):
+            # Only looks at the tags of the base branch, so doesn't need to
+            # wait for the results of this build to be pushed. Failures are
+            # only reported by the regression stage so that storing the
+            # results still happens.
+            try:
+                return get_regression_base_and_target(targetbranch, basebranch, args.release, targetrepodir, test_results_url, log,
+                                                      mirrorbase and os.path.join(mirrorbase, "ls-remote"))
+            except Exception as e:
+                return e
 
-        tempdir = tempfile.mkdtemp(prefix='sendqaemail.')
-        try:
-            utils.printheader("Importing test results repo data")
+        def prepare_repo(results, log):
+            log.info("Importing test results repo data")
             cloneopts = []
             if basebranch:
                 cloneopts = ["--branch", basebranch]
             elif targetbranch:
                 cloneopts = ["--branch", targetbranch]
-            try:
-                subprocess.check_call(["git", "clone", test_results_url, tempdir, "--depth", "1"] + cloneopts)
-            except subprocess.CalledProcessError:
-                log.info("No comparision branch found, falling back to master")
-                subprocess.check_call(["git", "clone", test_results_url, tempdir, "--depth", "1"])
+            mirror = None
+            if mirrorbase:
+                mirror = update_testresults_mirror(test_results_url, mirrorbase, log)
+            if mirror:
+                clone_testresults(mirror, test_results_url, tempdir, cloneopts, log)
+            else:
+                try:
+                    run(["git", "clone", test_results_url, tempdir, "--depth", "1"] + cloneopts, log)
+                except subprocess.CalledProcessError:
+                    log.info("No comparision branch found, falling back to master")
+                    run(["git", "clone", test_results_url, tempdir, "--depth", "1"], log)
 
             # If the base comparision branch isn't present regression comparision won't work
             # at least until we can tell the tool to ignore internal branch information
             if targetbranch:
                 try:
-                    subprocess.check_call(["git", "rev-parse", "--verify", targetbranch], cwd=tempdir)
+                    run(["git", "rev-parse", "--verify", targetbranch], log, cwd=tempdir)
                 except subprocess.CalledProcessError:
                     # Doesn't exist so base it off master
                     # some older hosts don't have git branch old new
-                    subprocess.check_call(["git", "checkout", "master"], cwd=tempdir)
-                    subprocess.check_call(["git", "branch", targetbranch], cwd=tempdir)
-                    subprocess.check_call(["git", "checkout", targetbranch], cwd=tempdir)
+                    run(["git", "checkout", "master"], log, cwd=tempdir)
+                    run(["git", "branch", targetbranch], log, cwd=tempdir)
+                    run(["git", "checkout", targetbranch], log, cwd=tempdir)
 
-            utils.printheader("Storing results")
+        def store_results(results, log):
+            log.info("Storing results")
 
             if not args.dry_run:
-                subprocess.check_call([resulttool, "store", args.results_dir, tempdir])
+                before = git_refs(tempdir)
+                run([resulttool, "store", args.results_dir, tempdir], log)
                 if basebranch:
-                    subprocess.check_call(["git", "push", "--all", "--force"], cwd=tempdir)
-                    subprocess.check_call(["git", "push", "--tags", "--force"], cwd=tempdir)
+                    push_new_refs(tempdir, before, True, log)
                 elif targetbranch:
-                    subprocess.check_call(["git", "push", "--all"], cwd=tempdir)
-                    subprocess.check_call(["git", "push", "--tags"], cwd=tempdir)
+                    push_new_refs(tempdir, before, False, log)
                 elif is_release_version(args.release) and not basebranch and not targetbranch:
                     log.warning("Test results not published on release version. Faulty AB configuration ?")
             else:
                 log.info(f"[SKIP] store results (base {basebranch}, compare {targetbranch})")
 
-            utils.printheader("Processing regression report")
+        def regression_report(results, log):
+            log.info("Processing regression report")
             try:
-                regression_base, regression_target = get_regression_base_and_target(targetbranch, basebranch, args.release, targetrepodir, test_results_url, log)
+                if isinstance(results["base"], Exception):
+                    raise results["base"]
+                regression_base, regression_target = results["base"]
                 log.info(f"Generating regression report between {regression_base} and {regression_target}")
                 generate_regression_report(querytool, targetrepodir, regression_base, regression_target, tempdir, args.results_dir, log)
+                store = utils.getconfig("TESTRESULTS_STORE", ourconfig)
+                if regression_base and store and os.path.exists(store):
+                    generate_store_regression_report(store, targetrepodir, regression_base, revision, args.results_dir, log)
             except subprocess.CalledProcessError as e:
-                error = str(e)
-                exitcode = 1
-                log.error(f"Error while generating regression report: {error}")
-
+                log.error(f"Error while generating regression report: {e}")
+                return 1
+            return 0
 
+        tempdir = tempfile.mkdtemp(prefix='sendqaemail.')
+        try:
+            # Results are only stored once the report succeeded, as before
+            results = run_stages({
+                "report" : (test_report, []),
+                "base" : (regression_base, []),
+                "prepare" : (prepare_repo, []),
+                "store" : (store_results, ["report", "prepare"]),
+                "regression" : (regression_report, ["base", "store"]),
+            }, log)
+            exitcode = results["regression"] or exitcode
         finally:
             if not args.dry_run:
                 subprocess.check_call(["rm", "-rf",  tempdir])
@@ -224,14 +436,12 @@ def send_qa_email():
     utils.printheader("Generating QA email")
 
     buildhashes = ""
-    for repo in sorted(repos.keys()):
-        # gplv2 is no longer built/tested in master
-        if repo == "meta-gplv2":
-            continue
-        # Need the finalised revisions (not 'HEAD')
-        targetrepodir = "%s/%s" % (repodir, repo)
-        revision = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=targetrepodir).decode('utf-8').strip()
-        buildhashes += "%s: %s\n" % (repo, revision)
+    # gplv2 is no longer built/tested in master
+    hashrepos = [repo for repo in sorted(repos.keys()) if repo != "meta-gplv2"]
+    # Need the finalised revisions (not 'HEAD')
+    revisions = utils.githeads("%s/%s" % (repodir, repo) for repo in hashrepos)
+    for repo in hashrepos:
+        buildhashes += "%s: %s\n" % (repo, revisions["%s/%s" % (repodir, repo)])
 
     web_root = utils.getconfig('WEBPUBLISH_DIR', ourconfig)
     web_url = utils.getconfig('WEBPUBLISH_URL', ourconfig)
@@ -0,0 +1 @@
+sstate_clean.py
\ No newline at end of file
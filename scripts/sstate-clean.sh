@@ -1,24 +1,33 @@
 #!/bin/bash
-{
-if [ -f /mnt/tank/yocto/sstate-clean.lock ]; then
+
+SCRIPTSDIR=$(dirname $(readlink -f $0))
+
+# Hold a real lock for the duration of the run, a stale lock file left
+# behind by a crashed run doesn't block future clean ups
+exec 9>>/mnt/tank/yocto/sstate-clean.lock
+if ! flock -n 9; then
     echo "Already running a clean up. Exiting."
     exit 0
 fi
-}
 
-touch /mnt/tank/yocto/sstate-clean.lock
-
-# Track how much we delete and long it takes to do it on any given day
-/usr/bin/time -ao /mnt/tank/yocto/sstate-matime.log du -chs /mnt/tank/yocto/sstate-to-remove/sstate >> /mnt/tank/yocto/sstate-matime.log
-/usr/bin/time -ao /mnt/tank/yocto/sstate-matime.log rm -R /mnt/tank/yocto/sstate-to-remove/sstate
+# Delete what the previous run staged in rate limited batches, resuming if
+# the last purge was interrupted. Sizes come from the move log, not du.
+/usr/local/bin/python3 $SCRIPTSDIR/sstate-clean.py purge \
+    --dest /mnt/tank/yocto/sstate-to-remove \
+    --bytes-per-sec 200M --files-per-sec 2000 \
+    --log /mnt/tank/yocto/sstate-matime.log
 
 mv /mnt/tank/yocto/sstate-matime.log /mnt/tank/yocto/$(date +%Y%m%d)-sstate-matime.log
 
+# Move old objects into the staging area while preserving the directory
+# structure, the timing summary goes into the log for the next run. The
+# index only rescans prefix directories which changed since the last run.
 cd /mnt/tank/yocto
-/usr/bin/find /mnt/tank/yocto/autobuilder/autobuilder.yoctoproject.org/pub/sstate \( -mtime +15 -a -atime +15 \) -type f \( -name '*.tar*' -o -name '*.tgz*' \) -print > /mnt/tank/yocto/sstate-matime.log
-
-# Call out to a python program to move file while preserving the directory structure 
-/usr/local/bin/python3 sstate-clean.py
+/usr/local/bin/python3 $SCRIPTSDIR/sstate-clean.py age \
+    --sstate-dir /mnt/tank/yocto/autobuilder/autobuilder.yoctoproject.org/pub/sstate \
+    --dest /mnt/tank/yocto/sstate-to-remove-30 \
+    --mtime 15 --atime 15 \
+    --index /mnt/tank/yocto/sstate-index.sqlite \
+    --log /mnt/tank/yocto/sstate-matime.log
 
 # Exit and wait until next run for deletion
-rm /mnt/tank/yocto/sstate-clean.lock
@@ -0,0 +1,752 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Age out objects from the published sstate directory
+#
+# The sstate tree is walked with os.scandir in parallel, one worker per two
+# level hash prefix directory (sstate/XX/YY/), and any objects older than the
+# mtime/atime policy are moved (preserving the directory structure) into a
+# staging directory for later deletion, or deleted directly.
+#
+
+import collections
+import concurrent.futures
+import datetime
+import fcntl
+import glob
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+import utils
+
+DEFAULT_SSTATE_DIR = "/mnt/tank/yocto/autobuilder/autobuilder.yoctoproject.org/pub/sstate"
+DEFAULT_STAGING_DIR = "/mnt/tank/yocto/sstate-to-remove-30"
+DEFAULT_PURGE_DIR = "/mnt/tank/yocto/sstate-to-remove"
+
+# Written into the staging directory, one "<size>\t<relative path>" per object
+MOVE_LOG = "moves.log"
+PURGE_CHECKPOINT = "purge.checkpoint"
+# The subdirectory of the staging directory objects are moved into, purging
+# never touches anything else in the staging directory
+STAGING_SUBDIR = "sstate"
+
+SstateObject = collections.namedtuple("SstateObject", "path size mtime atime")
+
+def is_sstate_object(name):
+    # Matches the historical find -name '*.tar*' -o -name '*.tgz*'
+    return ".tar" in name or ".tgz" in name
+
+class AgePolicy(object):
+    """
+    Select objects which were neither modified nor accessed in the last N
+    days, with the same rounding as find's -mtime +N/-atime +N.
+    """
+    def __init__(self, mtime_days, atime_days, now=None):
+        self.mtime_days = mtime_days
+        self.atime_days = atime_days
+        self.now = now or time.time()
+
+    def __call__(self, obj):
+        if self.mtime_days is not None and int((self.now - obj.mtime) // 86400) <= self.mtime_days:
+            return False
+        if self.atime_days is not None and int((self.now - obj.atime) // 86400) <= self.atime_days:
+            return False
+        return True
+
+    def cutoffs(self):
+        """Return the (mtime, atime) timestamps at or before which objects match"""
+        mtime_cutoff = atime_cutoff = None
+        if self.mtime_days is not None:
+            mtime_cutoff = self.now - (self.mtime_days + 1) * 86400
+        if self.atime_days is not None:
+            atime_cutoff = self.now - (self.atime_days + 1) * 86400
+        return mtime_cutoff, atime_cutoff
+
+    def __str__(self):
+        return "mtime +%s, atime +%s" % (self.mtime_days, self.atime_days)
+
+class Totals(object):
+    def __init__(self):
+        self.scanned = 0
+        self.scanned_bytes = 0
+        self.matched = 0
+        self.matched_bytes = 0
+        self.actioned = 0
+        self.errors = 0
+        self.scantime = 0.0
+        self.actiontime = 0.0
+
+    def add(self, other):
+        for k, v in vars(other).items():
+            setattr(self, k, getattr(self, k) + v)
+
+def scan_objects(path):
+    """Yield SstateObjects below path using os.scandir"""
+    try:
+        it = os.scandir(path)
+    except FileNotFoundError:
+        return
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from scan_objects(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False) or not is_sstate_object(entry.name):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # Raced with a deletion
+                continue
+            yield SstateObject(entry.path, st.st_size, st.st_mtime, st.st_atime)
+
+def stat_objects(paths):
+    """Yield SstateObjects for a list of paths which weren't found by scanning"""
+    for path in paths:
+        if not is_sstate_object(os.path.basename(path)):
+            continue
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        yield SstateObject(path, st.st_size, st.st_mtime, st.st_atime)
+
+def list_prefixes(sstatedir):
+    """
+    Split the tree into units of work, one per XX/YY prefix directory.
+    Files found above that level are returned separately.
+    """
+    prefixes = []
+    loose = []
+    with os.scandir(sstatedir) as it:
+        for top in it:
+            if not top.is_dir(follow_symlinks=False):
+                loose.append(top.path)
+                continue
+            with os.scandir(top.path) as subit:
+                for sub in subit:
+                    if sub.is_dir(follow_symlinks=False):
+                        prefixes.append(sub.path)
+                    else:
+                        loose.append(sub.path)
+    return sorted(prefixes), loose
+
+def batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+class SstateCleaner(object):
+    def __init__(self, sstatedir, policy, stagingdir=None, delete=False, dryrun=False, batchsize=1000):
+        self.sstatedir = os.path.abspath(sstatedir)
+        # Moved objects keep their path relative to the sstate parent so the
+        # staging tree looks like <stagingdir>/sstate/XX/YY/<object>
+        self.basedir = os.path.dirname(self.sstatedir)
+        self.policy = policy
+        self.stagingdir = stagingdir
+        self.delete = delete
+        self.dryrun = dryrun
+        self.batchsize = batchsize
+        self.movelock = threading.Lock()
+
+    def stagingpath(self, path):
+        return os.path.join(self.stagingdir, os.path.relpath(path, self.basedir))
+
+    def action(self, batch, totals):
+        start = time.time()
+        if self.delete:
+            for obj in batch:
+                try:
+                    os.unlink(obj.path)
+                    totals.actioned += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print("Unable to delete %s: %s" % (obj.path, str(e)))
+                    totals.errors += 1
+        else:
+            made = set()
+            moved = []
+            for obj in batch:
+                dest = self.stagingpath(obj.path)
+                destdir = os.path.dirname(dest)
+                if destdir not in made:
+                    os.makedirs(destdir, exist_ok=True)
+                    made.add(destdir)
+                try:
+                    os.rename(obj.path, dest)
+                    totals.actioned += 1
+                    moved.append("%d\t%s\n" % (obj.size, os.path.relpath(dest, self.stagingdir)))
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print("Unable to move %s: %s" % (obj.path, str(e)))
+                    totals.errors += 1
+            # Record what was moved so the purge stage knows the sizes
+            # without walking the staging tree
+            with self.movelock, open(os.path.join(self.stagingdir, MOVE_LOG), "a") as f:
+                f.write("".join(moved))
+        totals.actiontime += time.time() - start
+
+    def process(self, objects):
+        totals = Totals()
+        start = time.time()
+        victims = []
+        for obj in objects:
+            totals.scanned += 1
+            totals.scanned_bytes += obj.size
+            if self.policy(obj):
+                totals.matched += 1
+                totals.matched_bytes += obj.size
+                victims.append(obj)
+        totals.scantime += time.time() - start
+        if not self.dryrun:
+            for batch in batches(victims, self.batchsize):
+                self.action(batch, totals)
+        return victims, totals
+
+    def run(self, jobs):
+        prefixes, loose = list_prefixes(self.sstatedir)
+        totals = Totals()
+        victims = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(self.process, scan_objects(p)) for p in prefixes]
+            futures.append(executor.submit(self.process, stat_objects(loose)))
+            for future in concurrent.futures.as_completed(futures):
+                v, t = future.result()
+                victims.extend(v)
+                totals.add(t)
+        return victims, totals
+
+    def process_candidates(self, paths):
+        objects = list(stat_objects(paths))
+        victims, totals = self.process(objects)
+        return victims, objects, totals
+
+    def run_candidates(self, paths, jobs):
+        """
+        Process objects selected from an index. They're stat()ed again first
+        since the index can be out of date. Returns the victims, all the
+        objects which still existed and the totals.
+        """
+        totals = Totals()
+        victims = []
+        existing = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(self.process_candidates, chunk) for chunk in batches(paths, self.batchsize)]
+            for future in concurrent.futures.as_completed(futures):
+                v, e, t = future.result()
+                victims.extend(v)
+                existing.extend(e)
+                totals.add(t)
+        return victims, existing, totals
+
+def format_bytes(n):
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if abs(n) < 1024 or unit == "TiB":
+            return "%.1f %s" % (n, unit)
+        n = n / 1024
+
+def parse_size(size):
+    """Parse a size such as 500G or 12T (binary units) into bytes"""
+    units = {"K" : 1 << 10, "M" : 1 << 20, "G" : 1 << 30, "T" : 1 << 40}
+    size = size.strip().upper().rstrip("B").rstrip("I")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def release_sstate_dirs(ourconfig):
+    """
+    Find the release sstate directories from the SSTATE_DIR settings of
+    SSTATEDIR_RELEASE, with the config variables expanded. A value with
+    @RELEASENUM@ gives a directory per release, otherwise all releases
+    share the one directory. Values depending on per build variables such
+    as ${HELPERBUILDDIR} can't be resolved here and are skipped. The
+    directories hold symlinks to the objects releases use from elsewhere.
+    """
+    values = list(utils.getconfigvar("SSTATEDIR_RELEASE", ourconfig) or [])
+    for target in ourconfig.get("overrides", {}):
+        values.extend(utils.getconfigvar("SSTATEDIR_RELEASE", ourconfig, target) or [])
+    dirs = []
+    for value in values:
+        if not value.lstrip().startswith("SSTATE_DIR") or "=" not in value:
+            continue
+        path = value.split("=", 1)[1].strip().strip("'\"")
+        if "${" in path:
+            continue
+        for d in glob.glob(glob.escape(path).replace("@RELEASENUM@", "*")):
+            if os.path.isdir(d) and d not in dirs:
+                dirs.append(d)
+    return dirs
+
+def object_stem(name):
+    for suffix in [".siginfo", ".sig"]:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def protected_objects(dirs):
+    """
+    Return the names of all objects referenced by symlinks in dirs. Names
+    are compared rather than paths since the release directories may have
+    been created with the sstate share mounted elsewhere. Signature and
+    siginfo files of referenced objects are protected too.
+    """
+    stems = set()
+    def walk(path):
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    stems.add(object_stem(os.path.basename(os.readlink(entry.path))))
+                elif entry.is_dir():
+                    walk(entry.path)
+    for d in dirs:
+        if os.path.isdir(d):
+            walk(d)
+    return stems
+
+def select_lru(objects, target, protected):
+    """
+    Pick objects in least recently accessed order until the remaining total
+    size is at or below target. Returns the victims and the resulting size.
+    """
+    total = sum(o.size for o in objects)
+    victims = []
+    for obj in sorted(objects, key=lambda o: o.atime):
+        if total <= target:
+            break
+        if object_stem(os.path.basename(obj.path)) in protected:
+            continue
+        victims.append(obj)
+        total -= obj.size
+    return victims, total
+
+def select_lru_rechecked(objects, target, protected, restat):
+    """
+    As select_lru() for objects from a possibly out of date index. Victims
+    are stat()ed again with restat(paths); any which have gone or were read
+    since the index was updated are replaced by selecting further objects.
+    Returns the victims, the resulting size, the objects found to have been
+    read and the paths found to have gone.
+    """
+    objects = dict((o.path, o) for o in objects)
+    checked = set()
+    refreshed = []
+    gone = []
+    while True:
+        victims, remaining = select_lru(objects.values(), target, protected)
+        unchecked = [o for o in victims if o.path not in checked]
+        if not unchecked:
+            return victims, remaining, refreshed, gone
+        fresh = dict((o.path, o) for o in restat([o.path for o in unchecked]))
+        for obj in unchecked:
+            checked.add(obj.path)
+            new = fresh.get(obj.path)
+            if new is None:
+                del objects[obj.path]
+                gone.append(obj.path)
+                continue
+            objects[obj.path] = new
+            if new.atime - obj.atime >= 86400:
+                refreshed.append(new)
+
+def eviction_report(victims, target, remaining, protected):
+    import sstate_index
+
+    groups = collections.defaultdict(lambda: [0, 0])
+    for obj in victims:
+        recipe, task, _ = sstate_index.parse_sstate_name(os.path.basename(obj.path))
+        g = groups[(recipe or "(unknown)", task or "(unknown)")]
+        g[0] += 1
+        g[1] += obj.size
+    out = "Evicted %d objects, %s, to reach a target of %s (now %s)\n" % (len(victims),
+        format_bytes(sum(o.size for o in victims)), format_bytes(target), format_bytes(remaining))
+    out += "%d objects protected by release sstate directories\n\n" % len(protected)
+    out += "%12s %8s  %s\n" % ("Size", "Objects", "Recipe:task")
+    for (recipe, task), (count, size) in sorted(groups.items(), key=lambda g: g[1][1], reverse=True):
+        out += "%12s %8d  %s:%s\n" % (format_bytes(size), count, recipe, task)
+    out += "\nObjects:\n"
+    for obj in victims:
+        out += "%s %d %d\n" % (obj.path, obj.size, obj.atime)
+    return out
+
+def timing_summary(name, totals, wallclock, dryrun):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    out = "%s sstate %s%s\n" % (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), name, " (dry-run)" if dryrun else "")
+    out += "  scanned: %d objects, %s\n" % (totals.scanned, format_bytes(totals.scanned_bytes))
+    out += "  matched: %d objects, %s\n" % (totals.matched, format_bytes(totals.matched_bytes))
+    if not dryrun:
+        out += "  actioned: %d objects, %d errors\n" % (totals.actioned, totals.errors)
+    out += "  elapsed: %.1fs wall, %.1fs user, %.1fs sys (scan %.1fs, action %.1fs summed over workers)\n" % (
+        wallclock, usage.ru_utime, usage.ru_stime, totals.scantime, totals.actiontime)
+    return out
+
+def report(name, totals, wallclock, args):
+    summary = timing_summary(name, totals, wallclock, args.dry_run)
+    print(summary, end="")
+    if args.log:
+        with open(args.log, "a") as f:
+            f.write(summary)
+
+def add_common_args(parser):
+    parser.add_argument('-s', '--sstate-dir',
+                        default=DEFAULT_SSTATE_DIR,
+                        help="The published sstate directory")
+    parser.add_argument('-j', '--jobs',
+                        type=int, default=16,
+                        help="Number of prefix directories to process in parallel")
+    parser.add_argument('-n', '--dry-run',
+                        action='store_true',
+                        help="Only report the number of objects and bytes which would be removed")
+    parser.add_argument('-l', '--log',
+                        help="Append the timing summary to this file")
+    parser.add_argument('-i', '--index',
+                        help="Select objects using this sstate index (see sstate_index.py) instead of walking the tree")
+    parser.add_argument('--no-update',
+                        action='store_true',
+                        help="Don't bring the index up to date before using it")
+
+def add_action_args(parser):
+    parser.add_argument('-d', '--dest',
+                        default=DEFAULT_STAGING_DIR,
+                        help="Staging directory to move objects into")
+    parser.add_argument('--delete',
+                        action='store_true',
+                        help="Delete objects directly instead of moving them to the staging directory")
+    parser.add_argument('-b', '--batch-size',
+                        type=int, default=1000,
+                        help="Number of objects to move or delete per batch")
+
+def run_indexed(cleaner, args):
+    import sstate_index
+
+    index = sstate_index.SstateIndex(args.index)
+    if not args.no_update:
+        rescanned, total = index.update(args.sstate_dir, args.jobs)
+        print("Updated index %s, rescanned %d of %d directories" % (args.index, rescanned, total))
+    mtime_cutoff, atime_cutoff = cleaner.policy.cutoffs()
+    candidates = [o.path for o in index.select(mtime_cutoff, atime_cutoff, under=cleaner.sstatedir)]
+    print("Index selected %d candidate objects" % len(candidates))
+    utils.flush()
+    victims, existing, totals = cleaner.run_candidates(candidates, args.jobs)
+    victimpaths = set(o.path for o in victims)
+    index.refresh([o for o in existing if o.path not in victimpaths])
+    gone = set(candidates) - set(o.path for o in existing)
+    if not args.dry_run:
+        gone.update(victimpaths)
+    index.remove(gone)
+    index.close()
+    return totals
+
+def cmd_age(args):
+    start = time.time()
+    policy = AgePolicy(args.mtime, args.atime)
+    print("Ageing %s (%s)" % (args.sstate_dir, policy))
+    utils.flush()
+    cleaner = SstateCleaner(args.sstate_dir, policy, args.dest, args.delete, args.dry_run, args.batch_size)
+    if args.index:
+        totals = run_indexed(cleaner, args)
+    else:
+        _, totals = cleaner.run(args.jobs)
+    report("age", totals, time.time() - start, args)
+    return 1 if totals.errors else 0
+
+def cmd_evict(args):
+    start = time.time()
+    target = parse_size(args.target_size)
+    protectdirs = args.protect
+    for d in protectdirs:
+        if not os.path.isdir(d):
+            print("Release sstate directory %s does not exist" % d)
+            return 1
+    if not protectdirs:
+        protectdirs = release_sstate_dirs(utils.loadconfig())
+    if not protectdirs:
+        # Never evict without knowing what the releases still need
+        print("No release sstate directories found from SSTATEDIR_RELEASE, refusing to evict (use --protect)")
+        return 1
+    protected = protected_objects(protectdirs)
+    print("Evicting from %s down to %s, %d objects referenced from %d release sstate directories are protected" % (
+        args.sstate_dir, format_bytes(target), len(protected), len(protectdirs)))
+    utils.flush()
+
+    cleaner = SstateCleaner(args.sstate_dir, None, args.dest, args.delete, args.dry_run, args.batch_size)
+    index = None
+    if args.index:
+        import sstate_index
+        index = sstate_index.SstateIndex(args.index)
+        if not args.no_update:
+            index.update(args.sstate_dir, args.jobs)
+        objects = index.select(under=cleaner.sstatedir)
+    else:
+        scanner = SstateCleaner(args.sstate_dir, lambda o: True, dryrun=True)
+        objects, _ = scanner.run(args.jobs)
+
+    totals = Totals()
+    totals.scanned = len(objects)
+    totals.scanned_bytes = sum(o.size for o in objects)
+    if index:
+        # Anything read since the index was updated is no longer a victim
+        victims, remaining, refreshed, gone = select_lru_rechecked(objects, target, protected,
+                                                                   lambda paths: list(stat_objects(paths)))
+        index.refresh(refreshed)
+        index.remove(gone)
+    else:
+        victims, remaining = select_lru(objects, target, protected)
+
+    totals.matched = len(victims)
+    totals.matched_bytes = sum(o.size for o in victims)
+    if not args.dry_run:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            batchtotals = [Totals() for _ in batches(victims, args.batch_size)]
+            # Consume the results so errors in a batch aren't lost
+            list(executor.map(cleaner.action, batches(victims, args.batch_size), batchtotals))
+        for t in batchtotals:
+            totals.add(t)
+        if index:
+            index.remove(o.path for o in victims)
+    if index:
+        index.close()
+
+    reportfile = os.path.join(args.report_dir, "sstate-evict-%s.txt" % datetime.datetime.now().strftime("%Y%m%d%H%M%S"))
+    os.makedirs(args.report_dir, exist_ok=True)
+    with open(reportfile, "w") as f:
+        f.write(eviction_report(victims, target, remaining, protected))
+    print("Eviction report written to %s" % reportfile)
+    report("evict", totals, time.time() - start, args)
+    return 1 if totals.errors else 0
+
+class Throttle(object):
+    """Sleep as needed to keep within a bytes and files per second budget"""
+    def __init__(self, bytes_per_sec=None, files_per_sec=None):
+        self.bytes_per_sec = bytes_per_sec
+        self.files_per_sec = files_per_sec
+        self.start = time.time()
+        self.bytes = 0
+        self.files = 0
+
+    def account(self, nbytes, nfiles):
+        self.bytes += nbytes
+        self.files += nfiles
+        wanted = 0
+        if self.bytes_per_sec:
+            wanted = max(wanted, self.bytes / self.bytes_per_sec)
+        if self.files_per_sec:
+            wanted = max(wanted, self.files / self.files_per_sec)
+        delay = wanted - (time.time() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+def read_checkpoint(stagingdir):
+    try:
+        with open(os.path.join(stagingdir, PURGE_CHECKPOINT)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"offset" : 0, "deleted" : 0, "deleted_bytes" : 0}
+
+def write_checkpoint(stagingdir, checkpoint):
+    path = os.path.join(stagingdir, PURGE_CHECKPOINT)
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.rename(path + ".tmp", path)
+
+def read_move_log(stagingdir, offset, batchsize):
+    """Yield (end offset, [(size, path), ...]) batches from the move log"""
+    try:
+        f = open(os.path.join(stagingdir, MOVE_LOG), "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        f.seek(offset)
+        batch = []
+        for line in f:
+            offset += len(line)
+            size, path = line.decode("utf-8").rstrip("\n").split("\t", 1)
+            batch.append((int(size), os.path.join(stagingdir, path)))
+            if len(batch) >= batchsize:
+                yield offset, batch
+                batch = []
+        if batch:
+            yield offset, batch
+
+def move_log_totals(stagingdir, offset):
+    count = size = 0
+    for _, batch in read_move_log(stagingdir, offset, 10000):
+        count += len(batch)
+        size += sum(s for s, _ in batch)
+    return count, size
+
+def purge_batch(batch, totals):
+    start = time.time()
+    nbytes = 0
+    for size, path in batch:
+        try:
+            os.unlink(path)
+            totals.actioned += 1
+            nbytes += size
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print("Unable to delete %s: %s" % (path, str(e)))
+            totals.errors += 1
+    totals.actiontime += time.time() - start
+    return nbytes
+
+def purge_staging(stagingdir, batchsize, throttle, dryrun):
+    """
+    Delete the sstate/ tree of the staging directory in throttled batches.
+    Objects listed in the move log go first, checkpointing after every batch
+    so an interrupted run resumes where it stopped. Anything else left
+    behind in sstate/ (e.g. from before the move log existed) is then
+    removed by walking the tree.
+    """
+    totals = Totals()
+    sweepdir = os.path.join(stagingdir, STAGING_SUBDIR)
+    checkpoint = read_checkpoint(stagingdir)
+    if checkpoint["offset"]:
+        print("Resuming purge of %s, %d objects (%s) already deleted" % (stagingdir,
+            checkpoint["deleted"], format_bytes(checkpoint["deleted_bytes"])))
+    totals.scanned, totals.scanned_bytes = move_log_totals(stagingdir, checkpoint["offset"])
+    print("Move log lists %d objects, %s to delete" % (totals.scanned, format_bytes(totals.scanned_bytes)))
+    utils.flush()
+    if dryrun:
+        return totals
+
+    for offset, batch in read_move_log(stagingdir, checkpoint["offset"], batchsize):
+        batch = [(size, path) for size, path in batch if path.startswith(sweepdir + "/")]
+        # Only count what this batch deleted, like the bytes. After a crash
+        # part of the batch may already be gone.
+        actioned = totals.actioned
+        nbytes = purge_batch(batch, totals)
+        totals.matched += len(batch)
+        totals.matched_bytes += nbytes
+        checkpoint["offset"] = offset
+        checkpoint["deleted"] += totals.actioned - actioned
+        checkpoint["deleted_bytes"] += nbytes
+        write_checkpoint(stagingdir, checkpoint)
+        throttle.account(nbytes, len(batch))
+
+    # Sweep up anything which wasn't in the move log
+    start = time.time()
+    leftovers = []
+    for root, dirs, files in os.walk(sweepdir):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                leftovers.append((os.lstat(path).st_size, path))
+            except FileNotFoundError:
+                continue
+            if len(leftovers) >= batchsize:
+                nbytes = purge_batch(leftovers, totals)
+                throttle.account(nbytes, len(leftovers))
+                totals.matched += len(leftovers)
+                totals.matched_bytes += nbytes
+                leftovers = []
+    nbytes = purge_batch(leftovers, totals)
+    throttle.account(nbytes, len(leftovers))
+    totals.matched += len(leftovers)
+    totals.matched_bytes += nbytes
+    totals.scantime += time.time() - start
+
+    for root, dirs, files in os.walk(sweepdir, topdown=False):
+        for name in dirs:
+            try:
+                os.rmdir(os.path.join(root, name))
+            except OSError:
+                pass
+    try:
+        os.rmdir(sweepdir)
+    except OSError:
+        pass
+    for name in [MOVE_LOG, PURGE_CHECKPOINT]:
+        try:
+            os.unlink(os.path.join(stagingdir, name))
+        except FileNotFoundError:
+            pass
+    return totals
+
+def cmd_purge(args):
+    start = time.time()
+    if not os.path.isdir(args.dest):
+        print("Nothing to purge in %s" % args.dest)
+        return 0
+    throttle = Throttle(args.bytes_per_sec and parse_size(args.bytes_per_sec), args.files_per_sec)
+    totals = purge_staging(os.path.abspath(args.dest), args.batch_size, throttle, args.dry_run)
+    report("purge", totals, time.time() - start, args)
+    return 1 if totals.errors else 0
+
+def lock(lockfile):
+    """Take an exclusive flock, returning None if someone else holds it"""
+    lf = open(lockfile, "a+")
+    try:
+        fcntl.flock(lf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lf.close()
+        return None
+    return lf
+
+def main():
+    parser = utils.ArgParser(description='Remove old objects from the published sstate directory.')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    age = subparsers.add_parser('age', help="Move or delete objects older than an mtime/atime policy")
+    add_common_args(age)
+    add_action_args(age)
+    age.add_argument('--mtime',
+                     type=int, default=15,
+                     help="Minimum age in days since modification (as find -mtime +N)")
+    age.add_argument('--atime',
+                     type=int, default=15,
+                     help="Minimum age in days since last access (as find -atime +N)")
+    age.set_defaults(func=cmd_age)
+
+    evict = subparsers.add_parser('evict', help="Evict least recently accessed objects until the share is below a target size")
+    add_common_args(evict)
+    add_action_args(evict)
+    evict.add_argument('-t', '--target-size',
+                       required=True,
+                       help="Target size for the sstate directory, e.g. 20T")
+    evict.add_argument('-p', '--protect',
+                       action='append', default=[],
+                       help="Release sstate directory whose symlinked objects must not be evicted (default: from SSTATEDIR_RELEASE)")
+    evict.add_argument('-r', '--report-dir',
+                       default=".",
+                       help="Directory to write the eviction report into")
+    evict.set_defaults(func=cmd_evict)
+
+    purge = subparsers.add_parser('purge', help="Delete the contents of a staging directory in throttled, resumable batches")
+    purge.add_argument('-d', '--dest',
+                       default=DEFAULT_PURGE_DIR,
+                       help="Staging directory to purge")
+    purge.add_argument('-n', '--dry-run',
+                       action='store_true',
+                       help="Only report the number of objects and bytes which would be deleted")
+    purge.add_argument('-l', '--log',
+                       help="Append the timing summary to this file")
+    purge.add_argument('-b', '--batch-size',
+                       type=int, default=1000,
+                       help="Number of objects to delete per batch")
+    purge.add_argument('--bytes-per-sec',
+                       help="Limit the rate data is deleted at, e.g. 500M")
+    purge.add_argument('--files-per-sec',
+                       type=int,
+                       help="Limit the rate files are deleted at")
+    purge.set_defaults(func=cmd_purge)
+
+    parser.add_argument('--lock',
+                        help="Hold an exclusive flock on this file while running, exit if it is already held")
+
+    args = parser.parse_args()
+    if args.lock:
+        lf = lock(args.lock)
+        if not lf:
+            print("Already running a clean up. Exiting.")
+            return 0
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
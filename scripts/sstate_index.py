@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Persistent index of the objects in the published sstate directory
+#
+# The index is an SQLite database holding the path, size, mtime, atime and
+# the recipe/task parsed from the filename of every sstate object. It is
+# updated incrementally: directories whose mtime hasn't changed since the
+# last update aren't rescanned. Note that reading an object updates its
+# atime without touching the directory so atimes in the index can be older
+# than reality; anything selected for removal must be re-checked on disk.
+#
+
+import concurrent.futures
+import os
+import sqlite3
+import sys
+import time
+
+import utils
+import sstate_clean
+
+DEFAULT_INDEX = "/mnt/tank/yocto/sstate-index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime INTEGER
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);
+CREATE TABLE IF NOT EXISTS objects (
+    path TEXT PRIMARY KEY,
+    dir TEXT,
+    size INTEGER,
+    mtime REAL,
+    atime REAL,
+    recipe TEXT,
+    task TEXT,
+    kind TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_dir ON objects(dir);
+CREATE INDEX IF NOT EXISTS objects_atime ON objects(atime);
+CREATE INDEX IF NOT EXISTS objects_recipe ON objects(recipe);
+"""
+
+def parse_sstate_name(name):
+    """
+    Return (recipe, task, kind) for an sstate object name such as
+    sstate:zlib:core2-64-poky-linux:1.3:r0:core2-64:11:<hash>_package.tar.zst.siginfo
+    where kind is "" for the object itself, or "siginfo"/"sig".
+    """
+    kind = ""
+    for suffix in ["siginfo", "sig"]:
+        if name.endswith("." + suffix):
+            kind = suffix
+            name = name[:-len(suffix) - 1]
+            break
+    for ext in [".tar", ".tgz"]:
+        if ext in name:
+            name = name[:name.index(ext)]
+            break
+    if not name.startswith("sstate:"):
+        return None, None, kind
+    fields = name.split(":")
+    recipe = fields[1] if len(fields) > 1 else None
+    task = None
+    if "_" in fields[-1]:
+        task = fields[-1].split("_", 1)[1]
+    return recipe, task, kind
+
+class DirUpdate(object):
+    def __init__(self, path, parent, mtime, objects):
+        self.path = path
+        self.parent = parent
+        self.mtime = mtime
+        self.objects = objects
+
+def scan_dir(path, parent, knowndirs, recurse, updates, seen):
+    """
+    Collect updates for path and, if recurse is set, its subdirectories.
+    Unchanged directories only cost a stat() of the directory itself.
+    """
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return
+    seen.add(path)
+    known = knowndirs.get(path)
+    if known and known[1] == mtime:
+        if recurse:
+            for subdir in known[2]:
+                scan_dir(subdir, path, knowndirs, recurse, updates, seen)
+        return
+    objects = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False) or not sstate_clean.is_sstate_object(entry.name):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            objects.append(sstate_clean.SstateObject(entry.path, st.st_size, st.st_mtime, st.st_atime))
+    updates.append(DirUpdate(path, parent, mtime, objects))
+    if recurse:
+        for subdir in subdirs:
+            scan_dir(subdir, path, knowndirs, recurse, updates, seen)
+
+class SstateIndex(object):
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        self.db = sqlite3.connect(dbpath)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def knowndirs(self):
+        dirs = {}
+        for path, parent, mtime in self.db.execute("SELECT path, parent, mtime FROM dirs"):
+            dirs[path] = [parent, mtime, []]
+        for path, (parent, _, _) in dirs.items():
+            if parent in dirs:
+                dirs[parent][2].append(path)
+        return dirs
+
+    def update(self, sstatedir, jobs=16):
+        """Bring the index up to date, returns (rescanned dirs, total dirs)"""
+        sstatedir = os.path.abspath(sstatedir)
+        knowndirs = self.knowndirs()
+        updates = []
+        seen = set()
+        # The top two levels are scanned serially without recursion, the
+        # XX/YY prefix directories below them in parallel
+        scan_dir(sstatedir, None, knowndirs, False, updates, seen)
+        prefixes, _ = sstate_clean.list_prefixes(sstatedir)
+        for top in sorted(set(os.path.dirname(p) for p in prefixes)):
+            scan_dir(top, sstatedir, knowndirs, False, updates, seen)
+
+        def worker(prefix):
+            u = []
+            s = set()
+            scan_dir(prefix, os.path.dirname(prefix), knowndirs, True, u, s)
+            return u, s
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for u, s in executor.map(worker, prefixes):
+                updates.extend(u)
+                seen.update(s)
+
+        with self.db:
+            for gone in set(knowndirs) - seen:
+                self.db.execute("DELETE FROM objects WHERE dir = ?", (gone,))
+                self.db.execute("DELETE FROM dirs WHERE path = ?", (gone,))
+            for u in updates:
+                self.db.execute("DELETE FROM objects WHERE dir = ?", (u.path,))
+                self.db.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    ((o.path, u.path, o.size, o.mtime, o.atime) + parse_sstate_name(os.path.basename(o.path)) for o in u.objects))
+                self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (u.path, u.parent, u.mtime))
+        return len(updates), len(seen)
+
+    def select(self, mtime_cutoff=None, atime_cutoff=None, under=None):
+        """Return objects last modified and accessed before the cutoffs"""
+        query = "SELECT path, size, mtime, atime FROM objects WHERE 1"
+        params = []
+        if mtime_cutoff is not None:
+            query += " AND mtime <= ?"
+            params.append(mtime_cutoff)
+        if atime_cutoff is not None:
+            query += " AND atime <= ?"
+            params.append(atime_cutoff)
+        if under:
+            # A plain prefix match, LIKE would treat _ and % in paths as wildcards
+            prefix = under.rstrip("/") + "/"
+            query += " AND substr(path, 1, ?) = ?"
+            params.extend([len(prefix), prefix])
+        return [sstate_clean.SstateObject(*row) for row in self.db.execute(query, params)]
+
+    def totals(self, mtime_cutoff=None, atime_cutoff=None):
+        query = "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects WHERE 1"
+        params = []
+        if mtime_cutoff is not None:
+            query += " AND mtime <= ?"
+            params.append(mtime_cutoff)
+        if atime_cutoff is not None:
+            query += " AND atime <= ?"
+            params.append(atime_cutoff)
+        return self.db.execute(query, params).fetchone()
+
+    def top_recipes(self, limit=20):
+        return self.db.execute("SELECT recipe, COUNT(*), SUM(size) FROM objects GROUP BY recipe ORDER BY SUM(size) DESC LIMIT ?", (limit,)).fetchall()
+
+    def refresh(self, objects):
+        """Record fresh stat data for objects which turned out to still be in use"""
+        with self.db:
+            self.db.executemany("UPDATE objects SET size = ?, mtime = ?, atime = ? WHERE path = ?",
+                ((o.size, o.mtime, o.atime, o.path) for o in objects))
+
+    def remove(self, paths):
+        with self.db:
+            self.db.executemany("DELETE FROM objects WHERE path = ?", ((p,) for p in paths))
+
+def cmd_update(args):
+    start = time.time()
+    index = SstateIndex(args.index)
+    rescanned, total = index.update(args.sstate_dir, args.jobs)
+    count, size = index.totals()
+    print("Rescanned %d of %d directories in %.1fs, index has %d objects, %s" % (
+        rescanned, total, time.time() - start, count, sstate_clean.format_bytes(size)))
+    index.close()
+    return 0
+
+def cmd_plan(args):
+    index = SstateIndex(args.index)
+    if args.update:
+        index.update(args.sstate_dir, args.jobs)
+    policy = sstate_clean.AgePolicy(args.mtime, args.atime)
+    mtime_cutoff, atime_cutoff = policy.cutoffs()
+    count, size = index.totals(mtime_cutoff, atime_cutoff)
+    allcount, allsize = index.totals()
+    print("Policy %s would free %d of %d objects, %s of %s" % (policy, count, allcount,
+        sstate_clean.format_bytes(size), sstate_clean.format_bytes(allsize)))
+    index.close()
+    return 0
+
+def cmd_recipes(args):
+    index = SstateIndex(args.index)
+    for recipe, count, size in index.top_recipes(args.limit):
+        print("%12s %8d  %s" % (sstate_clean.format_bytes(size), count, recipe or "(unknown)"))
+    index.close()
+    return 0
+
+def main():
+    parser = utils.ArgParser(description='Maintain and query an index of the published sstate directory.')
+    parser.add_argument('-i', '--index',
+                        default=DEFAULT_INDEX,
+                        help="The index database")
+    parser.add_argument('-s', '--sstate-dir',
+                        default=sstate_clean.DEFAULT_SSTATE_DIR,
+                        help="The published sstate directory")
+    parser.add_argument('-j', '--jobs',
+                        type=int, default=16,
+                        help="Number of prefix directories to scan in parallel")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    update = subparsers.add_parser('update', help="Rescan directories which changed since the last update")
+    update.set_defaults(func=cmd_update)
+
+    plan = subparsers.add_parser('plan', help="Show how much an age policy would free")
+    plan.add_argument('--mtime', type=int, default=15,
+                      help="Minimum age in days since modification")
+    plan.add_argument('--atime', type=int, default=15,
+                      help="Minimum age in days since last access")
+    plan.add_argument('-u', '--update', action='store_true',
+                      help="Update the index first")
+    plan.set_defaults(func=cmd_plan)
+
+    recipes = subparsers.add_parser('recipes', help="Show the recipes using the most sstate space")
+    recipes.add_argument('-n', '--limit', type=int, default=20,
+                         help="Number of recipes to show")
+    recipes.set_defaults(func=cmd_recipes)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,8 @@
 #
 
 import os, sys, glob
+import concurrent.futures
+from collections import Counter
 
 # constants
 HOME = "/home/pokybuild/yocto-worker/"
@@ -25,80 +27,64 @@ subs = {
 def usage():
     print("Usage: " + sys.argv[0] + " <dest> <target>")
 
-def list_top_outputs(logfile):
-    # top delimiter
-    top_start = "start: top output"
-    top_end = "end: top output"
-
-    # list of top outputs
-    top_outputs = []
-
-    # flag
+# top delimiters
+top_start = "start: top output"
+top_end = "end: top output"
+
+class TopSnapshot(object):
+    """Aggregates of a single top invocation, the header lines are kept verbatim"""
+    def __init__(self, short_summary, commands):
+        self.short_summary = short_summary
+        self.summary = Counter()
+        self.kernel_summary = Counter()
+        self.zombie_summary = Counter()
+        self.other_builds = {}
+        # Identical command lines are common, classify each one only once.
+        # Counter keeps the order of first appearance so ties in the sorted
+        # summaries come out in the same order as a line by line count.
+        for cmd, count in Counter(commands).items():
+            if cmd.startswith(HOME):
+                self.other_builds[cmd.split(HOME)[1].split("/")[0]] = None
+            if cmd[0] == "[" and cmd[-1] == "]":    # kernel processes
+                self.kernel_summary[cmd[1:-1].split("/")[0]] += count
+            elif zombie_proc_id in cmd:             # zombie processes
+                zproc = cmd.split()[0][1:-1]
+                if parser in zproc:
+                    zproc = parser
+                self.zombie_summary[zproc] += count
+            else:                                   # userspace processes
+                self.summary[cmd.split(maxsplit=1)[0]] += count
+
+def summarize_top(logfile):
+    """
+    Read the top outputs in logfile in a single pass, keeping only the
+    per invocation aggregates. Returns the snapshots and the other builds
+    seen running, in order of first appearance.
+    """
+    snapshots = []
+    other_builds = {}
     collect = False
     with open(logfile) as log:
-        top_output = []
         for line in log:
             lstrip = line.strip()
             if collect:
                 if lstrip.startswith(top_end):
+                    snapshot = TopSnapshot(header[:top_header + cpu_hoggers], commands)
+                    snapshots.append(snapshot)
+                    other_builds.update(snapshot.other_builds)
                     collect = False
-                    top_outputs.append(top_output)
-                    top_output = []
+                elif len(header) < top_header:
+                    header.append(lstrip)
                 else:
-                    top_output.append(lstrip)
-            if lstrip.startswith(top_start):
+                    if len(header) < top_header + cpu_hoggers:
+                        header.append(lstrip)
+                    commands.append(lstrip.split(maxsplit=max_cols)[-1])
+            elif lstrip.startswith(top_start):
                 collect = True
-                    
-    return top_outputs
-
-def summarize_top(top_outs, target):
-    summaries = []
-    kernel_summaries = []
-    zombie_summaries = []
-    short_summaries = []
-    other_builds = []
-    for top_out in top_outs:
-        summary = {}
-        kernel_summary = {}
-        zombie_summary = {}
-        short_summary = top_out[:top_header + cpu_hoggers]
-        for line in top_out[top_header:]:
-            cmd = line.split(maxsplit=max_cols)[-1]
-            if cmd.startswith(HOME):
-                b = cmd.split(HOME)[1].split("/")[0]
-                if b not in other_builds:
-                    other_builds.append(b)
-            if cmd[0] == "[" and cmd[-1] == "]":    # kernel processes
-                kproc = cmd[1:-1].split("/")[0]
-                if kproc not in kernel_summary:
-                    kernel_summary[kproc] = 1
-                else:
-                    kernel_summary[kproc] += 1
-            elif zombie_proc_id in cmd:             # zombie processes
-                zproc = cmd.split()[0][1:-1]
-                if parser in zproc:
-                    zproc = parser
-                if zproc not in zombie_summary:
-                    zombie_summary[zproc] = 1
-                else:
-                    zombie_summary[zproc] += 1
-            else:                                   # userspace processes
-                cmd_split = cmd.split()
-                prog = cmd_split[0]
-                if prog not in summary:
-                    summary[prog] = 1
-                else:
-                    summary[prog] += 1
-        summary = dict(sorted(summary.items(), key=lambda item: item[1], reverse=True))
-        kernel_summary = dict(sorted(kernel_summary.items(), key=lambda item: item[1], reverse=True))
-        zombie_summary = dict(sorted(zombie_summary.items(), key=lambda item: item[1], reverse=True))
-
-        summaries.append(summary)
-        kernel_summaries.append(kernel_summary)
-        zombie_summaries.append(zombie_summary)
-        short_summaries.append(short_summary)
-    return (short_summaries, summaries, kernel_summaries, zombie_summaries, other_builds)
-    
+                header = []
+                commands = []
+    return snapshots, list(other_builds)
+
 def summarize_path(path):
     sub = ["/recipe-sysroot-native/", "/../../libexec/", "/gcc/"]
     p = path
@@ -111,7 +97,15 @@ def summarize_path(path):
     
     return p
 
-def write_summary(short_summary, summary, kernel_summary, zombie_summary, other_build, target, logfile):
+def format_counts(counts, shorten=False):
+    out = ""
+    # most_common() is a stable sort, ties stay in order of first appearance
+    for k, v in counts.most_common():
+        if v > 1 or any(k.startswith(x) for x in special_cmds):
+            out += (str(v) + "  " + (summarize_path(k) if shorten else k) + "\n")
+    return out
+
+def write_summary(snapshots, other_build, target, logfile):
     dirname = os.path.dirname(logfile)
     fname = os.path.basename(logfile)
     report_name = fname.split(".")[0] + "_summary.txt"
@@ -123,59 +117,52 @@ def write_summary(short_summary, summary, kernel_summary, zombie_summary, other_
         out += (v + " = " + k + "\n")
     out += "\n"
 
-    out += "top was invoked " + str(len(short_summary)) + " times.\n\n"
+    out += "top was invoked " + str(len(snapshots)) + " times.\n\n"
     out += "Current build: " + target + "\n"
     out += "Other builds:"
     for b in other_build:
         out += " " + b
     out += "\n\n"
-    for i in range(len(short_summary)):
-        for l in short_summary[i]:
+    parts = [out]
+    for snapshot in snapshots:
+        out = ""
+        for l in snapshot.short_summary:
             out += (l + "\n")
-
         out += ("\nUserspace Process Summary: " + "\n")
-        if not summary:
-            out += "There were no userspace processes\n"
-        else:
-            for k, v in summary[i].items():
-                if v > 1 or any(k.startswith(x) for x in special_cmds):
-                    r = summarize_path(k)
-                    out += (str(v) + "  " + r + "\n")
-        
+        out += format_counts(snapshot.summary, shorten=True)
         out += ("\nKernel Process Summary: " + "\n")
-        if not kernel_summary:
-            out += "There were no kernel processes\n"
-        else:
-            for k, v in kernel_summary[i].items():
-                if v > 1 or any(k.startswith(x) for x in special_cmds):
-                    out += (str(v) + "  " + k + "\n")
-
+        out += format_counts(snapshot.kernel_summary)
         out += ("\nZombie Process Summary: " + "\n")
-        if not zombie_summary:
-            out += "There were no zombie processes\n"
-        else:
-            for k, v in zombie_summary[i].items():
-                if v > 1 or any(k.startswith(x) for x in special_cmds):
-                    out += (str(v) + "  " + k + "\n")
+        out += format_counts(snapshot.zombie_summary)
         out += ("\n")
+        parts.append(out)
 
     with open(outfile, "w") as of:
-        of.write(out)
+        of.write("".join(parts))
+    return outfile
+
+def summarize_file(logfile, target):
+    snapshots, other_build = summarize_top(logfile)
+    return write_summary(snapshots, other_build, target, logfile)
 
 def main():
     if len(sys.argv) != 3:
         usage()
         sys.exit()
-        
+
     dest = sys.argv[1]
     target = sys.argv[2]
     host_data_dir = "intermittent_failure_host_data"
     directory = os.path.join(dest, target, host_data_dir)
     regs = (directory + "/*_top.txt", directory + "/*_failure_*.txt")
-    for exts in regs:
-        for f in glob.glob(exts):
-            outputs = list_top_outputs(f)
-            short_summary, summary, kernel_summary, zombie_summary, other_build = summarize_top(outputs, target)
-            write_summary(short_summary, summary, kernel_summary, zombie_summary, other_build, target, f)
-
-main()
+    files = list(dict.fromkeys(f for exts in regs for f in glob.glob(exts)))
+    if len(files) < 2:
+        for f in files:
+            summarize_file(f, target)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(files), os.cpu_count() or 1)) as executor:
+        for _ in executor.map(summarize_file, files, [target] * len(files)):
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Benchmark summarize_top_output.py over a synthetic directory of host-stats
+# files. With --compare, another version of the script is run over a copy of
+# the same data and the _summary.txt files are checked to be identical.
+#
+
+import argparse
+import filecmp
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HOME = "/home/pokybuild/yocto-worker/"
+
+HEADER = [
+    "top - 10:01:02 up 12 days,  3:04,  0 users,  load average: 95.12, 80.03, 70.44",
+    "Tasks: 1412 total,  60 running, 1340 sleeping,   0 stopped,  12 zombie",
+    "%Cpu(s): 80.1 us, 15.2 sy,  0.0 ni,  4.1 id,  0.4 wa,  0.0 hi,  0.2 si,  0.0 st",
+    "MiB Mem : 257652.1 total,  10234.5 free, 120345.6 used, 127072.0 buff/cache",
+    "MiB Swap:   8192.0 total,   8100.0 free,     92.0 used. 130000.2 avail Mem",
+    "",
+    "PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM     TIME+ COMMAND",
+]
+
+def synthetic_commands(rand):
+    builds = ["a-full", "qemux86-64", "beaglebone", "oe-selftest-debian", "genericarm64"]
+    build = rand.choice(builds)
+    work = HOME + build + "/build/build/tmp/work/core2-64-poky-linux/recipe%d/1.0/" % rand.randint(0, 500)
+    return rand.choice([
+        work + "recipe-sysroot-native/usr/bin/x86_64-poky-linux/../../libexec/x86_64-poky-linux/gcc/x86_64-poky-linux/14.2.0/cc1 -quiet foo.c",
+        work + "recipe-sysroot-native/usr/bin/make -j 16",
+        "python3 " + HOME + build + "/build/bitbake/bin/bitbake-worker decafbad",
+        "[kworker/u%d:%d-events_unbound]" % (rand.randint(0, 128), rand.randint(0, 9)),
+        "[ksoftirqd/%d]" % rand.randint(0, 64),
+        "[rcu_sched]",
+        "[Parser-%d] <defunct>" % rand.randint(1, 32),
+        "[sh] <defunct>",
+        "tar -xf downloads/foo-%d.tar.gz" % rand.randint(0, 100),
+        "rm -rf tmp/work/recipe%d" % rand.randint(0, 500),
+        "qemu-system-x86_64 -kernel bzImage",
+        "/usr/bin/gcc -c bar%d.c" % rand.randint(0, 10),
+        "ld.bfd -o out",
+        "sshd: pokybuild",
+    ])
+
+def write_host_stats(path, rand, snapshots, processes):
+    with open(path, "w") as f:
+        for _ in range(snapshots):
+            f.write("Some unrelated host data\n")
+            f.write("start: top output\n")
+            for line in HEADER:
+                f.write(line + "\n")
+            for pid in range(processes):
+                f.write("%7d pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 %s\n" % (
+                    pid, synthetic_commands(rand)))
+            f.write("end: top output\n")
+
+def generate(dest, target, files, snapshots, processes, seed):
+    rand = random.Random(seed)
+    directory = os.path.join(dest, target, "intermittent_failure_host_data")
+    os.makedirs(directory)
+    for i in range(files):
+        if i % 2:
+            name = "host_stats_%d_top.txt" % i
+        else:
+            name = "host_stats_%d_failure_%d.txt" % (i, i)
+        write_host_stats(os.path.join(directory, name), rand, snapshots, processes)
+    return directory
+
+def run(script, dest, target):
+    """Run script, returns the wall clock time and the peak RSS in MiB"""
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, script, dest, target])
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, script)
+    return time.time() - start, rusage.ru_maxrss / 1024
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark summarize_top_output.py")
+    parser.add_argument("--files", type=int, default=8, help="Number of host-stats files")
+    parser.add_argument("--snapshots", type=int, default=200, help="top invocations per file")
+    parser.add_argument("--processes", type=int, default=1500, help="Processes per top invocation")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--compare", help="Another version of summarize_top_output.py to time and check against")
+    args = parser.parse_args()
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "summarize_top_output.py")
+    target = "qemux86-64"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dest = os.path.join(tmpdir, "current")
+        directory = generate(dest, target, args.files, args.snapshots, args.processes, args.seed)
+        size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+        print("%d files, %.1f MiB of host data" % (args.files, size / 1024 / 1024))
+        if args.compare:
+            otherdest = os.path.join(tmpdir, "other")
+            shutil.copytree(dest, otherdest)
+            print("%s: %.2fs, peak RSS %.0f MiB" % ((args.compare,) + run(args.compare, otherdest, target)))
+        print("%s: %.2fs, peak RSS %.0f MiB" % ((script,) + run(script, dest, target)))
+        if args.compare:
+            otherdir = os.path.join(otherdest, target, "intermittent_failure_host_data")
+            summaries = sorted(f for f in os.listdir(directory) if f.endswith("_summary.txt"))
+            _, mismatch, errors = filecmp.cmpfiles(directory, otherdir, summaries, shallow=False)
+            if mismatch or errors or summaries != sorted(f for f in os.listdir(otherdir) if f.endswith("_summary.txt")):
+                print("Summaries differ: %s" % " ".join(mismatch + errors))
+                return 1
+            print("%d summaries identical" % len(summaries))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
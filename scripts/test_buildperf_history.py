@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+import buildperf_history
+
+
+def globalres_line(count, build="10:00.00", size=1000, host="perf-host", branch="master"):
+    values = [build] + ["0"] * 7 + [str(size)] + ["0"] * 3
+    return ",".join([host, "%s:%040x" % (branch, count), str(count)] + values) + "\n"
+
+class TestChangePoint(unittest.TestCase):
+    def test_median_band(self):
+        median, band = buildperf_history.median_band([10, 11, 9, 10, 30], 3.0, 0.0)
+        self.assertEqual(median, 10)
+        self.assertAlmostEqual(band, 3.0 * 1.4826 * 1)
+        # Identical values still get the minimal relative band
+        self.assertEqual(buildperf_history.median_band([50, 50, 50], 3.0, 0.02), (50, 1.0))
+
+    def test_step(self):
+        values = [100, 101, 99, 100, 102, 98, 100, 101, 99, 100, 120, 121]
+        i, before, after, band = buildperf_history.change_point(values)
+        self.assertEqual(i, 10)
+        self.assertEqual(before, 100)
+        self.assertEqual(after, 120.5)
+        self.assertAlmostEqual(band, 3.0 * 1.4826 * 1)
+        self.assertEqual(buildperf_history.change_point([v * -1 + 200 for v in values])[0], 10,
+                         msg="Decreases must be found too")
+
+    def test_noise(self):
+        values = [100, 101, 99, 100, 102, 98, 100, 101, 99, 100, 102, 99]
+        self.assertIsNone(buildperf_history.change_point(values))
+
+    def test_outlier_recovered(self):
+        values = [100, 101, 99, 100, 102, 98, 100, 101, 150, 100, 101]
+        self.assertIsNone(buildperf_history.change_point(values),
+                          msg="A single outlier followed by normal runs isn't a change")
+
+    def test_minruns(self):
+        values = [100, 101, 99, 120, 121]
+        self.assertIsNone(buildperf_history.change_point(values))
+        self.assertEqual(buildperf_history.change_point(values, minruns=3)[0], 3)
+
+    def test_recent_window(self):
+        # The step is older than the recent runs so it's already the norm
+        values = [100] * 5 + [120] * 12
+        self.assertIsNone(buildperf_history.change_point(values))
+        self.assertEqual(buildperf_history.change_point(values, recent=12)[0], 5)
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-buildperf-history.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.db = os.path.join(self.tempdir, "history.sqlite")
+        self.globalres = os.path.join(self.tempdir, "results", "globalres.log")
+        os.makedirs(os.path.dirname(self.globalres))
+
+    def test_globalres_runs(self):
+        with open(self.globalres, "w") as f:
+            f.write(globalres_line(1, build="1:02.50", size=2048))
+            f.write("\n")
+            f.write("perf-host,master:abcd,2,1.0,2.0\n")
+            f.write(globalres_line(3, build="broken"))
+            f.write(globalres_line(4, build="0"))
+        runs, skipped = buildperf_history.globalres_runs(self.globalres)
+        self.assertEqual(skipped, 2)
+        self.assertEqual(runs[0], ("perf-host", "master", "%040x" % 1, 1,
+                                   [("test1", "build", "time", 62.5), ("test1", "tmpdir", "size", 2048.0)]))
+        self.assertEqual(runs[1][4], [("test1", "tmpdir", "size", 1000.0)],
+                         msg="Tests recorded as 0 didn't run and have no measurement")
+
+    def test_summary(self):
+        with open(self.globalres, "w") as f:
+            for count in range(1, 11):
+                f.write(globalres_line(count, build="10:%02d.00" % (count % 3)))
+            for count in range(11, 13):
+                f.write(globalres_line(count, build="12:00.00"))
+        self.assertEqual(buildperf_history.ingest(self.db, [self.tempdir]), 12)
+        self.assertEqual(buildperf_history.ingest(self.db, [self.tempdir]), 0)
+
+        history = buildperf_history.BuildPerfHistory(self.db)
+        self.addCleanup(history.close)
+        runs, changes = history.changes("perf-host", "master", "qemux86")
+        self.assertEqual(len(runs), 12)
+        self.assertEqual([c[:5] for c in changes], [("test1", "build", "time", "%040x" % 11, 2)])
+
+        text = buildperf_history.summary(self.db, "perf-host", "master", "qemux86")
+        self.assertIn("test1.build time: 601.0s -> 720.0s", text)
+        self.assertIsNone(buildperf_history.summary(self.db, "other-host", "master", "qemux86"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import unittest.mock
+import archive_buildstats
+import buildstats_store
+
+
+class TestBuildstatsStore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-buildstats-store.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.bsdir = os.path.join(self.tempdir, "buildstats")
+        self.store = os.path.join(self.tempdir, "store.npz")
+
+    def write_task(self, timestamp, pf, task, started, elapsed, cpu=1.0, read=0, write=0):
+        d = os.path.join(self.bsdir, timestamp, pf)
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, task), "w") as f:
+            f.write("Event: TaskStarted\n")
+            f.write("Started: %f\n" % started)
+            f.write("Elapsed time: %.2f seconds\n" % elapsed)
+            f.write("rusage ru_utime: %f\n" % (cpu / 2))
+            f.write("Child rusage ru_stime: %f\n" % (cpu / 2))
+            f.write("IO read_bytes: %d\n" % read)
+            f.write("IO write_bytes: %d\n" % write)
+
+    def make_builds(self, count):
+        for n in range(count):
+            ts = "2026010%d000000" % (n + 1)
+            start = 1767225600 + n * 86400
+            self.write_task(ts, "zlib-1.3-r0", "do_compile", start, 10 + n, read=100 * n)
+            self.write_task(ts, "zlib-1.3-r0", "do_install", start + 10, 2)
+            self.write_task(ts, "glibc-2.39-r0", "do_compile", start, 100, cpu=300.0, write=5000)
+
+    def test_round_trip(self):
+        self.make_builds(3)
+        self.assertEqual(buildstats_store.ingest(self.store, [self.bsdir], "host"), 3)
+        self.assertEqual(buildstats_store.ingest(self.store, [self.bsdir], "host"), 0,
+                         msg="Builds already in the store must be skipped")
+
+        store = buildstats_store.BuildstatsStore(self.store)
+        self.assertEqual(store.builds, ["host-20260101000000", "host-20260102000000", "host-20260103000000"])
+        self.assertEqual(len(store.columns["build"]), 9)
+        self.assertEqual(sorted(store.recipes), ["glibc", "zlib"])
+        self.assertEqual(store.top("elapsed", 2),
+                         [("glibc", "do_compile", 100.0), ("zlib", "do_compile", 12.0)])
+        self.assertEqual(store.top("cpu", 1, 0), [("glibc", "do_compile", 300.0)])
+        self.assertEqual(store.percentiles("elapsed", [50, 100])["do_compile"], (6, [12.0, 100.0]))
+        self.assertEqual(store.latest_builds(1).tolist(), [2])
+
+    def test_incremental(self):
+        self.make_builds(2)
+        buildstats_store.ingest(self.store, [os.path.join(self.bsdir, "20260101000000")], "host")
+        buildstats_store.ingest(self.store, [os.path.join(self.bsdir, "20260102000000")], "host")
+        store = buildstats_store.BuildstatsStore(self.store)
+        self.assertEqual(store.builds, ["host-20260101000000", "host-20260102000000"])
+        self.assertEqual(store.columns["build"].tolist(), [0, 0, 0, 1, 1, 1])
+        self.assertEqual(store.columns["read_bytes"].tolist(), [0, 0, 0, 0, 100, 0])
+
+    def test_many_builds(self):
+        # Columns of builds added in one session are only concatenated once
+        store = buildstats_store.BuildstatsStore(self.store)
+        for n in range(50):
+            store.add_build("b%d" % n, [("r", "do_t", (n, float(n), 0.0, 0, 0))])
+        self.assertFalse(store.add_build("b7", []))
+        self.assertEqual(store.columns["elapsed"].tolist(), [float(n) for n in range(50)])
+        store.save()
+        self.assertEqual(buildstats_store.BuildstatsStore(self.store).columns["build"].tolist(), list(range(50)))
+
+    def test_tarball(self):
+        self.make_builds(1)
+        dest = os.path.join(self.tempdir, "archives")
+        os.makedirs(dest)
+        try:
+            tarball = archive_buildstats.archive_timestamp(self.bsdir, "20260101000000", dest, "host-20260101000000.tar.zst")
+        except OSError:
+            self.skipTest("zstd is not available")
+        self.assertEqual(buildstats_store.ingest(self.store, [tarball]), 1)
+        store = buildstats_store.BuildstatsStore(self.store)
+        self.assertEqual(store.builds, ["host-20260101000000"])
+        self.assertEqual(sorted(store.columns["elapsed"].tolist()), [2.0, 10.0, 100.0])
+
+    def add_builds(self, store, elapsed):
+        # One build a day, elapsed is a list of (zlib, glibc) times per build
+        for n, (zlib, glibc) in enumerate(elapsed):
+            start = 1767225600 + n * 86400
+            store.add_build("b%d" % n, [("zlib", "do_compile", (start, zlib, 0.0, 0, 0)),
+                                        ("glibc", "do_compile", (start, glibc, 0.0, 0, 0))])
+
+    def test_regressions(self):
+        store = buildstats_store.BuildstatsStore(self.store)
+        # zlib doubles in the last two builds, glibc only grows by 25%
+        self.add_builds(store, [(20, 100)] * 4 + [(40, 125)] * 2)
+        self.assertEqual(store.regressions("elapsed", 2, 4, 1.5, 10.0), [("zlib", "do_compile", 20.0, 40.0)])
+        self.assertEqual(store.regressions("elapsed", 2, 4, 1.1, 10.0),
+                         [("glibc", "do_compile", 100.0, 125.0), ("zlib", "do_compile", 20.0, 40.0)],
+                         msg="The largest increases must come first")
+        self.assertEqual(store.regressions("elapsed", 2, 4, 1.5, 25.0), [],
+                         msg="Increases below the minimum aren't reported")
+
+    def test_no_regressions(self):
+        store = buildstats_store.BuildstatsStore(self.store)
+        # The step happened before the baseline window so it's the norm now
+        self.add_builds(store, [(20, 100)] * 2 + [(40, 100)] * 4)
+        self.assertEqual(store.regressions("elapsed", 2, 2, 1.5, 10.0), [])
+        self.assertEqual(store.regressions("elapsed", 6, 2, 1.5, 10.0), [],
+                         msg="Without builds before the recent ones there is nothing to compare to")
+        # A baseline partly before the step averages 30, not enough either
+        self.assertEqual(store.regressions("elapsed", 2, 4, 1.5, 10.0), [])
+
+    def test_unknown_build(self):
+        self.make_builds(1)
+        buildstats_store.ingest(self.store, [self.bsdir], "host")
+        argv = ["buildstats_store.py", "-s", self.store, "top", "-b", "host-20990101000000"]
+        with unittest.mock.patch.object(sys, "argv", argv), contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(buildstats_store.main(), 1)
+        self.assertEqual(out.getvalue(), "Build host-20990101000000 is not in store %s\n" % self.store)
+
+
+if __name__ == '__main__':
+    unittest.main()
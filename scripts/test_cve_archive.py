@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import cve_archive
+
+
+def package(name, issues, version="1.0"):
+    return {"name" : name, "version" : version,
+            "issue" : [{"id" : cve, "status" : status, "link" : "https://nvd.nist.gov/vuln/detail/" + cve} for cve, status in issues]}
+
+class TestCVEArchive(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-cve-archive.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.archive = cve_archive.CVEArchive(os.path.join(self.tempdir, "archive"))
+        self.reports = os.path.join(self.tempdir, "reports")
+
+    def write_report(self, branch, timestamp, packages):
+        path = os.path.join(self.reports, branch, "%s.json" % timestamp)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        report = {"version" : "1", "package" : packages}
+        with open(path, "w") as f:
+            json.dump(report, f)
+        return path, report
+
+    def test_round_trip(self):
+        zlib = package("zlib", [("CVE-1", "Unpatched"), ("CVE-2", "Patched")])
+        curl = package("curl", [("CVE-3", "Unpatched")])
+        path1, report1 = self.write_report("master", 1700000000, [zlib, curl])
+        path2, report2 = self.write_report("master", 1700086400, [zlib, package("curl", [("CVE-3", "Patched")], "1.1")])
+
+        self.assertEqual(self.archive.add("master", "1700000000", path1), (2, 2))
+        self.assertEqual(self.archive.add("master", "1700086400", path2), (2, 1),
+                         msg="Unchanged package records must only be stored once")
+        self.assertEqual(self.archive.branches(), ["master"])
+        self.assertEqual(self.archive.snapshots("master"), ["1700000000", "1700086400"])
+        self.assertEqual(self.archive.report("master", "1700000000"), report1)
+        self.assertEqual(self.archive.report("master", "1700086400"), report2)
+
+        manifest = self.archive.manifestpath("master", "1700000000")
+        self.assertEqual(list(cve_archive.manifest_unpatched(manifest)), [("zlib", ["CVE-1"]), ("curl", ["CVE-3"])])
+        self.assertEqual(list(cve_archive.manifest_unpatched(self.archive.manifestpath("master", "1700086400"))),
+                         [("zlib", ["CVE-1"]), ("curl", [])])
+
+    def test_import(self):
+        self.write_report("master", 1700000000, [package("zlib", [("CVE-1", "Unpatched")])])
+        self.write_report("kirkstone", 9, [package("zlib", [("CVE-1", "Unpatched")])])
+        self.write_report("kirkstone", 10, [package("zlib", [("CVE-1", "Patched")])])
+        with open(os.path.join(self.reports, "master", "notes.json"), "w") as f:
+            f.write("{}")
+        added = list(self.archive.import_reports(self.reports))
+        self.assertEqual(added, [("kirkstone", "10", 1, 1), ("kirkstone", "9", 1, 1), ("master", "1700000000", 1, 0)])
+        self.assertEqual(self.archive.snapshots("kirkstone"), ["9", "10"], msg="Snapshots must sort numerically")
+
+    def test_write_atomic_failure(self):
+        path = os.path.join(self.tempdir, "archive", "snapshots", "master", "1.json")
+        with self.assertRaises(TypeError):
+            self.archive.write_atomic(path, None)
+        self.assertEqual(os.listdir(os.path.dirname(path)), [], msg="The temporary file must be removed")
+
+    def test_gc(self):
+        path, _ = self.write_report("master", 1, [package("zlib", [("CVE-1", "Unpatched")])])
+        self.archive.add("master", "1", path)
+        path, report = self.write_report("master", 2, [package("zlib", [("CVE-1", "Patched")])])
+        self.archive.add("master", "2", path)
+        leftover = self.archive.manifestpath("master", "3") + ".tmp"
+        with open(leftover, "w") as f:
+            f.write("{")
+
+        self.assertEqual(self.archive.gc()[0], 1, msg="Only the interrupted write can go")
+        self.assertFalse(os.path.exists(leftover))
+        os.unlink(self.archive.manifestpath("master", "1"))
+        self.assertEqual(self.archive.gc(dry_run=True)[0], 1)
+        self.assertEqual(self.archive.gc()[0], 1)
+        self.assertEqual(self.archive.gc()[0], 0)
+        self.assertEqual(self.archive.report("master", "2"), report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+spec = importlib.util.spec_from_file_location("cve_delta", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cve-delta.py"))
+cve_delta = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(cve_delta)
+
+
+class TestCVEDelta(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-cve-delta.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def write_report(self, name, packages):
+        path = os.path.join(self.tempdir, name)
+        with open(path, "w") as f:
+            json.dump({"version" : "1", "package" : packages}, f)
+        return path
+
+    def package(self, name, issues):
+        package = {"version" : "1.0", "issue" : [{"id" : cve, "status" : status, "summary" : "..."} for cve, status in issues]}
+        if name is not None:
+            package["name"] = name
+        return package
+
+    def test_delta(self):
+        old = {
+            ("zlib", "CVE-1") : "Unpatched",
+            ("zlib", "CVE-2") : "Unpatched",
+            ("zlib", "CVE-3") : "Patched",
+            ("curl", "CVE-4") : "Unpatched",
+            ("curl", "CVE-5") : "Unpatched",
+        }
+        new = {
+            ("zlib", "CVE-1") : "Unpatched",
+            ("zlib", "CVE-2") : "Patched",
+            ("zlib", "CVE-3") : "Unpatched",
+            ("curl", "CVE-4") : "Ignored",
+            ("curl", "CVE-6") : "Unpatched",
+            ("curl", "CVE-7") : "Patched",
+        }
+        changes = cve_delta.delta(old, new)
+        self.assertEqual(changes["unpatched"], [("curl", "CVE-6", None, "Unpatched"), ("zlib", "CVE-3", "Patched", "Unpatched")])
+        self.assertEqual(changes["fixed"], [("zlib", "CVE-2", "Unpatched", "Patched")])
+        self.assertEqual(changes["ignored"], [("curl", "CVE-4", "Unpatched", "Ignored")])
+        self.assertEqual(changes["removed"], [("curl", "CVE-5", "Unpatched", None)])
+
+        text = cve_delta.format_delta("old.json", "new.json", changes)
+        self.assertIn("2 newly unpatched, 1 newly fixed, 1 newly ignored, 1 no longer reported\n", text)
+        self.assertIn("  curl: https://web.nvd.nist.gov/view/vuln/detail?vulnId=CVE-5 (Unpatched -> not reported)\n", text)
+
+    def test_unchanged(self):
+        report = {("zlib", "CVE-1") : "Unpatched"}
+        self.assertEqual(cve_delta.delta(report, dict(report)), dict((c, []) for c, _ in cve_delta.CATEGORIES))
+
+    def test_reports(self):
+        old = self.write_report("old.json", [self.package("zlib", [("CVE-1", "Unpatched")]),
+                                             self.package(None, [("CVE-2", "Patched")])])
+        new = self.write_report("new.json", [self.package("zlib", [("CVE-1", "Patched"), ("CVE-3", "Unpatched")]),
+                                             self.package(None, [("CVE-2", "Unpatched")])])
+        changes = cve_delta.delta(cve_delta.index_report(old), cve_delta.index_report(new))
+        self.assertEqual(changes["fixed"], [("zlib", "CVE-1", "Unpatched", "Patched")])
+        self.assertEqual(changes["unpatched"], [("", "CVE-2", "Patched", "Unpatched"), ("zlib", "CVE-3", None, "Unpatched")],
+                         msg="Packages without a name must not break sorting")
+        cve_delta.format_delta(old, new, changes)
+
+
+if __name__ == '__main__':
+    unittest.main()
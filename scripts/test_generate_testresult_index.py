@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+spec = importlib.util.spec_from_file_location("generate_testresult_index",
+                                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "generate-testresult-index.py"))
+index = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(index)
+
+
+def results(branch):
+    return {"run1" : {"configuration" : {"LAYERS" : {"meta" : {"branch" : branch, "commit" : "abcd"}}, "MACHINE" : "qemux86-64"},
+                      "result" : {"ping.PingTest.test_ping" : {"status" : "PASSED"}}}}
+
+class TestIndexBase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-generate-testresult-index.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def make_build(self, build, branch="master", target="qemux86-64"):
+        d = os.path.join(self.tempdir, build, "testresults", target)
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, "testresults.json"), "w") as f:
+            json.dump(results(branch), f)
+        with open(os.path.join(self.tempdir, build, "testresults", "testresult-report.txt"), "w") as f:
+            f.write("report\n")
+        return os.path.join(self.tempdir, build, "testresults")
+
+    def index(self, *extra):
+        """Run the index command, returns the builds which were scanned"""
+        args = index.parse_args(["index", self.tempdir, "--no-ptest-logs"] + list(extra))
+        with unittest.mock.patch.object(index, "scan_build", wraps=index.scan_build) as scan, \
+                contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(index.cmd_index(args), 0)
+        return sorted(call.args[1] for call in scan.call_args_list)
+
+    def listing(self, name="index.json"):
+        with open(os.path.join(self.tempdir, name)) as f:
+            return json.load(f)
+
+class TestCache(TestIndexBase):
+    def test_cache(self):
+        self.make_build("20260101-1")
+        buildpath = self.make_build("20260102-1", branch="scarthgap")
+        self.assertEqual(self.index(), ["20260101-1", "20260102-1"])
+        self.assertEqual([(b["build"], b["branch"]) for b in self.listing()["builds"]],
+                         [("20260102-1", "scarthgap"), ("20260101-1", "master")])
+        self.assertEqual(self.index(), [], msg="Unchanged builds must come from the cache")
+
+        # A new file in the testresults directory changes its mtime
+        st = os.stat(buildpath)
+        with open(os.path.join(buildpath, "testresult-regressions-report.txt"), "w") as f:
+            f.write("regressions\n")
+        os.utime(buildpath, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertEqual(self.index(), ["20260102-1"])
+        self.assertEqual(self.listing()["builds"][0]["regressions"], "./20260102-1/testresults/testresult-regressions-report.txt")
+
+    def test_signature(self):
+        buildpath = self.make_build("20260101-1")
+        self.assertEqual(self.index(), ["20260101-1"])
+        # Only the mtime of the target directory changes, not the one of
+        # testresults itself
+        mtime = os.stat(buildpath).st_mtime_ns
+        os.makedirs(os.path.join(buildpath, "qemux86-64", "buildperf-x"))
+        os.utime(buildpath, ns=(mtime, mtime))
+        self.assertEqual(self.index(), ["20260101-1"], msg="A change below testresults must invalidate the cache")
+        self.assertEqual(self.index(), [])
+
+    def test_full(self):
+        self.make_build("20260101-1")
+        self.index()
+        self.assertEqual(self.index("--full"), ["20260101-1"])
+
+    def test_removed_build(self):
+        self.make_build("20260101-1")
+        self.make_build("20260102-1")
+        self.index()
+        shutil.rmtree(os.path.join(self.tempdir, "20260102-1"))
+        self.assertEqual(self.index(), [])
+        self.assertEqual([b["build"] for b in self.listing()["builds"]], ["20260101-1"])
+
+class TestShards(TestIndexBase):
+    def test_stale_shards(self):
+        for n in range(1, 4):
+            self.make_build("202601%02d-1" % n)
+        self.make_build("20251231-1")
+        self.index("--page-size", "1")
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, "index-2026-01-3.html")))
+        self.assertEqual([s["shard"] for s in self.listing()["shards"]], ["2026-01", "2025-12"])
+
+        # Pruned results: January shrinks to one page, December goes
+        for build in ["20260102-1", "20260103-1", "20251231-1"]:
+            shutil.rmtree(os.path.join(self.tempdir, build))
+        self.index("--page-size", "1")
+        shards = sorted(n for n in os.listdir(self.tempdir) if n.startswith("index-"))
+        self.assertEqual(shards, ["index-2026-01.html", "index-2026-01.json"])
+        self.assertEqual([s["shard"] for s in self.listing()["shards"]], ["2026-01"])
+        self.assertEqual([b["build"] for b in self.listing("index-2026-01.json")["builds"]], ["20260101-1"])
+
+    def test_unchanged_shards_kept(self):
+        self.make_build("20260101-1")
+        self.make_build("20260102-1")
+        self.index("--page-size", "1")
+        before = sorted(n for n in os.listdir(self.tempdir) if n.startswith("index-"))
+        self.index("--page-size", "1")
+        self.assertEqual(sorted(n for n in os.listdir(self.tempdir) if n.startswith("index-")), before)
+        self.assertEqual(before, ["index-2026-01-2.html", "index-2026-01.html", "index-2026-01.json"])
+
+class TestBranch(TestIndexBase):
+    def test_streamed(self):
+        buildpath = self.make_build("20260101-1", branch="kirkstone")
+        path = os.path.join(buildpath, "qemux86-64", "testresults.json")
+        with unittest.mock.patch.object(index.json, "load", side_effect=AssertionError("full parse")):
+            self.assertEqual(index.get_file_branch(path), "kirkstone")
+
+    def test_fallback(self):
+        buildpath = self.make_build("20260101-1", branch="kirkstone")
+        path = os.path.join(buildpath, "qemux86-64", "testresults.json")
+        with unittest.mock.patch.object(index.utils, "json_find", side_effect=ValueError("not understood")):
+            self.assertEqual(index.get_file_branch(path), "kirkstone",
+                             msg="A file the streaming reader can't handle must be parsed in full")
+
+    def test_fallback_later_run(self):
+        # The branch is only in the second record, which the full parse finds
+        path = os.path.join(self.tempdir, "testresults.json")
+        data = {"run0" : {"configuration" : {}}}
+        data.update(results("styhead"))
+        with open(path, "w") as f:
+            json.dump(data, f)
+        with unittest.mock.patch.object(index.utils, "json_find", side_effect=ValueError("not understood")):
+            self.assertEqual(index.get_file_branch(path), "styhead")
+
+    def test_no_branch(self):
+        d = os.path.join(self.tempdir, "20260101-1", "testresults", "qemux86-64")
+        os.makedirs(d)
+        with open(os.path.join(d, "testresults.json"), "w") as f:
+            json.dump({"run1" : {"configuration" : {}}}, f)
+        self.assertEqual(index.get_build_branch(os.path.join(self.tempdir, "20260101-1", "testresults")), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import host_data_index
+import summarize_top_output
+
+
+HOME = summarize_top_output.HOME
+
+def header(clock, load="95.12, 80.03, 70.44"):
+    return [
+        "top - %s up 12 days,  3:04,  0 users,  load average: %s" % (clock, load),
+        "Tasks: 1412 total,  60 running, 1340 sleeping,   0 stopped,  12 zombie",
+        "%Cpu(s): 80.1 us, 15.2 sy,  0.0 ni,  4.1 id,  0.4 wa,  0.0 hi,  0.2 si,  0.0 st",
+        "MiB Mem : 257652.1 total,  10234.5 free, 120345.6 used, 127072.0 buff/cache",
+        "MiB Swap:   8192.0 total,   8100.0 free,     92.0 used. 130000.2 avail Mem",
+        "",
+        "    PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM     TIME+ COMMAND",
+    ]
+
+def process(pid, cmd):
+    return "%7d pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 %s\n" % (pid, cmd)
+
+def timestamp(*args):
+    return datetime.datetime(*args).timestamp()
+
+class TestHostDataIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-host-data-index.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.results = os.path.join(self.tempdir, "results")
+        self.indexdir = os.path.join(self.tempdir, "index")
+
+    def write_host_data(self, build, name, clocks, target="qemux86-64", worker="worker1", buildstats="20260101233000"):
+        targetdir = os.path.join(self.results, build, "testresults", target)
+        hostdata = os.path.join(targetdir, host_data_index.HOST_DATA_DIR)
+        os.makedirs(hostdata, exist_ok=True)
+        path = os.path.join(hostdata, name)
+        with open(path, "w") as f:
+            for clock in clocks:
+                f.write("start: top output\n")
+                f.write("".join(l + "\n" for l in header(clock)))
+                f.write(process(1, "qemu-system-x86_64 -m 512"))
+                f.write(process(2, "[sh] <defunct>"))
+                f.write(process(3, HOME + "beaglebone/build/x"))
+                f.write("end: top output\n")
+        if worker:
+            manifest = os.path.join(targetdir, host_data_index.MANIFEST)
+            data = {"worker" : worker, "files" : {}}
+            if os.path.exists(manifest):
+                with open(manifest) as f:
+                    data = json.load(f)
+            rel = os.path.join(host_data_index.HOST_DATA_DIR, name)
+            data["files"][rel] = {"source" : "/build/tmp/buildstats/%s/%s" % (buildstats, name)}
+            with open(manifest, "w") as f:
+                json.dump(data, f)
+        return path
+
+    def ingest(self):
+        args = argparse.Namespace(results=[self.results], index_dir=self.indexdir)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(host_data_index.cmd_ingest(args), 0)
+        return out.getvalue()
+
+    def query(self, worker="worker1", **kwargs):
+        index = host_data_index.HostDataIndex(self.indexdir, worker)
+        self.addCleanup(index.close)
+        return list(index.query(**kwargs))
+
+    def test_failure_type(self):
+        self.assertEqual(host_data_index.failure_type("host_stats_do_testimage_failure_1.txt"), "do_testimage")
+        self.assertEqual(host_data_index.failure_type("host_stats_failure_2.txt"), "failure")
+        self.assertEqual(host_data_index.failure_type("host_stats_0_top.txt"), "interval")
+
+    def test_snapshot_time(self):
+        start = datetime.datetime(2026, 1, 1, 23, 30)
+        when, load = host_data_index.snapshot_time(start, header("23:50:00")[0])
+        self.assertEqual(when, datetime.datetime(2026, 1, 1, 23, 50))
+        self.assertEqual(load, [95.12, 80.03, 70.44])
+        when, _ = host_data_index.snapshot_time(when, header("00:10:00")[0])
+        self.assertEqual(when, datetime.datetime(2026, 1, 2, 0, 10), msg="The time of day wrapped around midnight")
+        self.assertEqual(host_data_index.snapshot_time(start, "garbage"), (start, None))
+        self.assertEqual(host_data_index.snapshot_time(None, header("23:50:00")[0]), (None, None))
+
+    def test_ingest(self):
+        path = self.write_host_data("20260101-1", "host_stats_0_top.txt", ["23:50:00", "00:10:00"])
+        self.write_host_data("20260101-1", "host_stats_do_testimage_failure_1.txt", ["00:20:00"])
+        self.assertIn("Checked 2 files from 1 workers", self.ingest())
+        records = self.query()
+        self.assertEqual([(r["time"], r["failure"]) for r in records],
+                         [(timestamp(2026, 1, 1, 23, 50), "interval"),
+                          (timestamp(2026, 1, 2, 0, 10), "interval"),
+                          (timestamp(2026, 1, 2, 0, 20), "do_testimage")])
+        self.assertEqual(records[0]["build"], "20260101-1")
+        self.assertEqual(records[0]["target"], "qemux86-64")
+        self.assertEqual(records[0]["load1"], 95.12)
+        self.assertEqual(records[0]["qemu"], 1)
+        self.assertEqual(records[0]["zombies"], 1)
+        self.assertEqual(records[0]["other_builds"], ["beaglebone"])
+
+        # Unchanged files are skipped, changed ones replace their snapshots
+        self.assertIn("added 0 snapshots", self.ingest())
+        with open(path, "a") as f:
+            f.write("start: top output\n")
+            f.write("".join(l + "\n" for l in header("00:30:00")))
+            f.write("end: top output\n")
+        self.assertIn("added 3 snapshots", self.ingest())
+        self.assertEqual(len(self.query()), 4)
+
+    def test_query(self):
+        self.write_host_data("20260101-1", "host_stats_0_top.txt", ["23:50:00", "00:10:00"])
+        self.write_host_data("20260101-1", "host_stats_do_testimage_failure_1.txt", ["00:20:00"])
+        self.write_host_data("20260102-1", "host_stats_0_top.txt", ["09:00:00"], buildstats="20260102085500")
+        self.ingest()
+        since = timestamp(2026, 1, 2)
+        until = timestamp(2026, 1, 2, 9)
+        self.assertEqual([r["time"] for r in self.query(since=since)],
+                         [timestamp(2026, 1, 2, 0, 10), timestamp(2026, 1, 2, 0, 20), timestamp(2026, 1, 2, 9)])
+        self.assertEqual([r["time"] for r in self.query(since=since, until=until)],
+                         [timestamp(2026, 1, 2, 0, 10), timestamp(2026, 1, 2, 0, 20)])
+        self.assertEqual([r["time"] for r in self.query(failure="do_testimage")], [timestamp(2026, 1, 2, 0, 20)])
+        self.assertEqual(len(self.query(failure="interval", build="20260102-1")), 1)
+        self.assertEqual(self.query(since=since, failure="do_testimage", until=timestamp(2026, 1, 2, 0, 20)), [])
+
+    def test_no_manifest(self):
+        path = self.write_host_data("20260101-1", "host_stats_0_top.txt", ["23:50:00", "00:10:00"], worker=None)
+        mtime = timestamp(2026, 1, 2, 0, 15)
+        os.utime(path, (mtime, mtime))
+        self.ingest()
+        records = self.query(worker="unknown")
+        self.assertEqual([r["time"] for r in records], [timestamp(2026, 1, 1, 23, 50), timestamp(2026, 1, 2, 0, 10)],
+                         msg="Without a manifest the date comes from the file mtime")
+        self.assertEqual(len(self.query(worker="unknown", since=timestamp(2026, 1, 2))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
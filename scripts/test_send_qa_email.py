@@ -8,7 +8,11 @@ set POKY_PATH environment variable accordingly:
 `POKY_PATH=~/src/poky ./scripts/test_send_qa_email.py`
 """
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 import unittest
 import send_qa_email
 import logging
@@ -87,6 +91,132 @@ class TestVersion(unittest.TestCase):
                 self.assertEqual(target, expected_target)
 
 
+class TestTestResultsMirror(unittest.TestCase):
+    """Uses a local bare repository as the test results remote, no network or poky needed"""
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-send-qa-email.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.remote = os.path.join(self.tempdir, "remote.git")
+        self.mirrorbase = os.path.join(self.tempdir, "mirrors")
+        self.git(self.tempdir, "init", "--quiet", "--bare", "-b", "master", self.remote)
+        work = os.path.join(self.tempdir, "work")
+        self.git(self.tempdir, "clone", "--quiet", self.remote, work)
+        for branch in ["master", "kirkstone"]:
+            self.git(work, "checkout", "--quiet", "-B", branch)
+            self.commit(work, branch + "-1")
+            self.git(work, "tag", "%s/1-g0000000/0" % branch)
+            self.git(work, "push", "--quiet", "origin", branch, "--tags")
+
+    def git(self, cwd, *args):
+        return subprocess.check_output(["git", "-c", "user.name=Test", "-c", "user.email=test@example.com"] + list(args),
+                                       cwd=cwd, universal_newlines=True)
+
+    def commit(self, repo, name):
+        with open(os.path.join(repo, name), "w") as f:
+            f.write(name)
+        self.git(repo, "add", name)
+        self.git(repo, "commit", "--quiet", "-m", name)
+
+    def remote_refs(self):
+        return send_qa_email.git_refs(self.remote)
+
+    def clone(self, name, branch):
+        mirror = send_qa_email.update_testresults_mirror(self.remote, self.mirrorbase, log)
+        self.assertIsNotNone(mirror)
+        clone = os.path.join(self.tempdir, name)
+        send_qa_email.clone_testresults(mirror, self.remote, clone, ["--branch", branch], log)
+        return mirror, clone
+
+    def test_clone_and_push(self):
+        mirror, clone = self.clone("clone", "master")
+        self.assertEqual(self.git(clone, "rev-parse", "HEAD"), self.git(self.remote, "rev-parse", "master"))
+        self.assertEqual(self.git(clone, "remote", "get-url", "--push", "origin").strip(), self.remote)
+
+        # A tag deleted from the remote since the mirror was updated must
+        # not come back when storing new results
+        self.git(self.remote, "tag", "-d", "kirkstone/1-g0000000/0")
+        before = send_qa_email.git_refs(clone)
+        self.assertIn("refs/tags/kirkstone/1-g0000000/0", before)
+        self.commit(clone, "results")
+        self.git(clone, "tag", "master/2-g1111111/0")
+
+        pushed = send_qa_email.push_new_refs(clone, before, False, log)
+        self.assertEqual(pushed, ["refs/heads/master", "refs/tags/master/2-g1111111/0"])
+        refs = self.remote_refs()
+        self.assertEqual(refs["refs/heads/master"], self.git(clone, "rev-parse", "HEAD").strip())
+        self.assertIn("refs/tags/master/2-g1111111/0", refs)
+        self.assertNotIn("refs/tags/kirkstone/1-g0000000/0", refs)
+        self.assertEqual(send_qa_email.push_new_refs(clone, send_qa_email.git_refs(clone), False, log), [])
+
+    def test_incremental_update(self):
+        mirror, _ = self.clone("clone1", "master")
+        work = os.path.join(self.tempdir, "work")
+        self.git(work, "checkout", "--quiet", "master")
+        self.commit(work, "master-2")
+        self.git(work, "push", "--quiet", "origin", "master")
+        _, clone = self.clone("clone2", "master")
+        self.assertEqual(self.git(clone, "rev-parse", "HEAD"), self.git(self.remote, "rev-parse", "master"))
+        # The clone borrows the mirror's objects rather than copying them
+        with open(os.path.join(clone, ".git", "objects", "info", "alternates")) as f:
+            self.assertEqual(f.read().strip(), os.path.join(mirror, "objects"))
+
+    def test_gc(self):
+        mirror, _ = self.clone("clone", "master")
+        stamp = mirror + ".gc-stamp"
+        self.assertTrue(os.path.exists(stamp), msg="A new mirror should be repacked straight away")
+        self.assertFalse(send_qa_email.gc_mirror(mirror, log))
+        old = time.time() - send_qa_email.MIRROR_GC_INTERVAL - 60
+        os.utime(stamp, (old, old))
+        self.assertTrue(send_qa_email.gc_mirror(mirror, log))
+        self.assertGreater(os.stat(stamp).st_mtime, old)
+        self.assertEqual(self.git(mirror, "count-objects", "-v").split("\n")[0], "count: 0",
+                         msg="Objects should all be packed")
+
+
+class TestStages(unittest.TestCase):
+    def test_failed_base_still_stores(self):
+        stored = []
+        def base(results, log):
+            try:
+                raise ValueError("no tags")
+            except Exception as e:
+                return e
+        def store(results, log):
+            stored.append(True)
+        def regression(results, log):
+            raise results["base"]
+        with self.assertLogs(log, level="ERROR") as logs:
+            with self.assertRaises(ValueError):
+                send_qa_email.run_stages({
+                    "base" : (base, []),
+                    "store" : (store, []),
+                    "regression" : (regression, ["base", "store"]),
+                }, log)
+        self.assertEqual(stored, [True])
+        self.assertTrue(logs.output[0].startswith("ERROR:send-qa-email:[regression] Stage failed"))
+
+    def test_failure_stops_new_stages(self):
+        def fail(results, log):
+            raise subprocess.CalledProcessError(1, "false")
+        def after(results, log):
+            self.fail("Stages depending on a failed one must not run")
+        with self.assertRaises(subprocess.CalledProcessError):
+            send_qa_email.run_stages({"fail" : (fail, []), "after" : (after, ["fail"])}, log)
+
+    def test_run_prefixes_output(self):
+        stagelog = send_qa_email.StageLog(log, {"stage" : "store"})
+        with self.assertLogs(log) as logs:
+            send_qa_email.run(["sh", "-c", "echo out; echo err >&2"], stagelog)
+            output = send_qa_email.run(["sh", "-c", "echo data; echo msg >&2"], stagelog, output=True)
+        self.assertEqual(output, b"data\n")
+        self.assertEqual(logs.output, ["INFO:send-qa-email:[store] out", "INFO:send-qa-email:[store] err",
+                                       "INFO:send-qa-email:[store] msg"])
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            send_qa_email.run(["sh", "-c", "echo broken; exit 3"], stagelog)
+        self.assertEqual(cm.exception.returncode, 3)
+
+
+
 if __name__ == '__main__':
     if os.environ.get("POKY_PATH") is None:
         print("Please set POKY_PATH to proper poky clone location before running tests")
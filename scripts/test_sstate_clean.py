@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import sstate_clean
+
+from sstate_clean import SstateObject
+
+GiB = 1 << 30
+
+def obj(name, size, atime):
+    return SstateObject("/sstate/ab/cd/" + name, size, atime, atime)
+
+class TestSelectLRU(unittest.TestCase):
+    def test_oldest_first(self):
+        objects = [obj("a.tar.zst", GiB, 300), obj("b.tar.zst", GiB, 100), obj("c.tar.zst", GiB, 200)]
+        victims, remaining = sstate_clean.select_lru(objects, 2 * GiB, set())
+        self.assertEqual([os.path.basename(o.path) for o in victims], ["b.tar.zst"])
+        self.assertEqual(remaining, 2 * GiB)
+
+    def test_below_target(self):
+        objects = [obj("a.tar.zst", GiB, 100)]
+        victims, remaining = sstate_clean.select_lru(objects, 2 * GiB, set())
+        self.assertEqual(victims, [])
+        self.assertEqual(remaining, GiB)
+
+    def test_protected(self):
+        objects = [obj("a.tar.zst", GiB, 100), obj("a.tar.zst.siginfo", 1, 100),
+                   obj("b.tar.zst", GiB, 200), obj("c.tar.zst", GiB, 300)]
+        victims, remaining = sstate_clean.select_lru(objects, GiB + 1, {"a.tar.zst"})
+        self.assertEqual([os.path.basename(o.path) for o in victims], ["b.tar.zst", "c.tar.zst"],
+                         msg="Protected objects and their siginfo must be skipped")
+        self.assertEqual(remaining, GiB + 1)
+
+    def test_protected_unreachable(self):
+        objects = [obj("a.tar.zst", GiB, 100), obj("b.tar.zst", GiB, 200)]
+        victims, remaining = sstate_clean.select_lru(objects, 0, {"a.tar.zst"})
+        self.assertEqual([os.path.basename(o.path) for o in victims], ["b.tar.zst"])
+        self.assertEqual(remaining, GiB)
+
+class TestSelectLRURechecked(unittest.TestCase):
+    def test_recently_read(self):
+        # b was read since the index was updated so c has to go instead
+        objects = [obj("a.tar.zst", GiB, 100), obj("b.tar.zst", GiB, 200), obj("c.tar.zst", GiB, 300),
+                   obj("d.tar.zst", GiB, 400)]
+        current = dict((o.path, o) for o in objects)
+        current[objects[1].path] = objects[1]._replace(atime=1000000)
+        restated = []
+        def restat(paths):
+            restated.extend(paths)
+            return [current[p] for p in paths]
+
+        victims, remaining, refreshed, gone = sstate_clean.select_lru_rechecked(objects, 2 * GiB, set(), restat)
+        self.assertEqual([os.path.basename(o.path) for o in victims], ["a.tar.zst", "c.tar.zst"])
+        self.assertEqual(remaining, 2 * GiB, msg="Replacement victims must be selected to reach the target")
+        self.assertEqual(refreshed, [current[objects[1].path]])
+        self.assertEqual(gone, [])
+        self.assertEqual(sorted(restated), sorted(set(restated)), msg="Objects should only be checked once")
+
+    def test_gone(self):
+        objects = [obj("a.tar.zst", GiB, 100), obj("b.tar.zst", GiB, 200), obj("c.tar.zst", GiB, 300)]
+        def restat(paths):
+            return [o for o in objects if o.path in paths and not o.path.endswith("a.tar.zst")]
+
+        victims, remaining, refreshed, gone = sstate_clean.select_lru_rechecked(objects, GiB, set(), restat)
+        self.assertEqual([os.path.basename(o.path) for o in victims], ["b.tar.zst"])
+        self.assertEqual(remaining, GiB)
+        self.assertEqual(gone, [objects[0].path])
+
+class TestProtection(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-sstate-clean.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def test_protected_objects(self):
+        release = os.path.join(self.tempdir, "4.0.1", "sstate", "ab", "cd")
+        os.makedirs(release)
+        os.symlink("/elsewhere/sstate/ab/cd/a.tar.zst", os.path.join(release, "a.tar.zst"))
+        os.symlink("/elsewhere/sstate/ab/cd/a.tar.zst.siginfo", os.path.join(release, "a.tar.zst.siginfo"))
+        os.symlink("../../../../sstate/ab/cd/b.tar.zst.sig", os.path.join(release, "b.tar.zst.sig"))
+        protected = sstate_clean.protected_objects([os.path.join(self.tempdir, "4.0.1"), os.path.join(self.tempdir, "missing")])
+        self.assertEqual(protected, {"a.tar.zst", "b.tar.zst"})
+
+    def test_release_sstate_dirs(self):
+        for release in ["4.0.1", "4.0.2"]:
+            os.makedirs(os.path.join(self.tempdir, release, "sstate"))
+        config = {"defaults" : {"SSTATEDIR_RELEASE" : ["SSTATE_MIRRORS += 'file://.* http://example.com/PATH'",
+                                                       "SSTATE_DIR ?= '%s/@RELEASENUM@/sstate'" % self.tempdir]}}
+        self.assertEqual(sorted(sstate_clean.release_sstate_dirs(config)),
+                         [os.path.join(self.tempdir, r, "sstate") for r in ["4.0.1", "4.0.2"]])
+
+    def test_config_release_sstate_dirs(self):
+        # The settings shipped in config.json, with BASE_SHAREDDIR moved
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config.json")) as f:
+            config = json.load(f)
+        config["BASE_SHAREDDIR"] = self.tempdir
+        self.assertEqual(sstate_clean.release_sstate_dirs(config), [],
+                         msg="Missing directories must not be protected")
+        os.makedirs(os.path.join(self.tempdir, "pub", "sstate"))
+        self.assertEqual(sstate_clean.release_sstate_dirs(config), [os.path.join(self.tempdir, "pub", "sstate")],
+                         msg="Shared release sstate directories and unresolvable overrides must be handled")
+
+    def test_no_release_sstate_dirs(self):
+        os.makedirs(os.path.join(self.tempdir, "build", "sstate"))
+        config = {"defaults" : {"SSTATEDIR_RELEASE" : ["SSTATE_DIR ?= '${HELPERBUILDDIR}/sstate'"]}}
+        self.assertEqual(sstate_clean.release_sstate_dirs(config), [])
+
+class TestAge(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-sstate-clean.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.sstatedir = os.path.join(self.tempdir, "sstate")
+        self.staging = os.path.join(self.tempdir, "staging")
+        now = time.time()
+        for name, mtime_days, atime_days in [("old.tar.zst", 30, 30), ("old.tar.zst.siginfo", 20, 20),
+                                             ("read.tar.zst", 30, 2), ("new.tar.zst", 2, 30),
+                                             ("edge.tar.zst", 15.5, 30), ("README", 30, 30)]:
+            path = os.path.join(self.sstatedir, "ab", "cd", name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(b"x" * 10)
+            os.utime(path, (now - atime_days * 86400, now - mtime_days * 86400))
+
+    def age(self, *extra, **kwargs):
+        args = argparse.Namespace(sstate_dir=self.sstatedir, dest=self.staging, delete=False, dry_run=False,
+                                  batch_size=1, jobs=2, index=None, no_update=False, log=None, mtime=15, atime=15)
+        vars(args).update(kwargs)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(sstate_clean.cmd_age(args), 0)
+
+    def remaining(self):
+        return sorted(os.listdir(os.path.join(self.sstatedir, "ab", "cd")))
+
+    def test_move(self):
+        self.age()
+        self.assertEqual(self.remaining(), ["README", "edge.tar.zst", "new.tar.zst", "read.tar.zst"],
+                         msg="Objects modified or read within the policy and non-objects must stay")
+        self.assertEqual(sorted(os.listdir(os.path.join(self.staging, "sstate", "ab", "cd"))), ["old.tar.zst", "old.tar.zst.siginfo"])
+        with open(os.path.join(self.staging, sstate_clean.MOVE_LOG)) as f:
+            self.assertEqual(sorted(f.readlines()), ["10\tsstate/ab/cd/old.tar.zst\n", "10\tsstate/ab/cd/old.tar.zst.siginfo\n"])
+
+    def test_cutoffs(self):
+        self.age(mtime=1, atime=25)
+        self.assertEqual(self.remaining(), ["README", "old.tar.zst.siginfo", "read.tar.zst"])
+        self.age(mtime=1, atime=1)
+        self.assertEqual(self.remaining(), ["README"])
+
+    def test_delete(self):
+        self.age(delete=True, mtime=10)
+        self.assertEqual(self.remaining(), ["README", "new.tar.zst", "read.tar.zst"])
+        self.assertFalse(os.path.exists(self.staging))
+
+    def test_dry_run(self):
+        self.age(dry_run=True)
+        self.assertEqual(len(self.remaining()), 6)
+        self.assertFalse(os.path.exists(self.staging))
+
+    def test_indexed(self):
+        index = os.path.join(self.tempdir, "index.sqlite")
+        self.age(delete=True, index=index)
+        self.assertEqual(self.remaining(), ["README", "edge.tar.zst", "new.tar.zst", "read.tar.zst"])
+        self.age(delete=True, index=index, mtime=1, atime=1)
+        self.assertEqual(self.remaining(), ["README"])
+
+class CountingThrottle(sstate_clean.Throttle):
+    def account(self, nbytes, nfiles):
+        self.bytes += nbytes
+        self.files += nfiles
+
+class Interrupted(Exception):
+    pass
+
+class InterruptingThrottle(CountingThrottle):
+    """Stop the purge after a number of batches, as if it was killed"""
+    def __init__(self, batches):
+        super().__init__()
+        self.batches = batches
+
+    def account(self, nbytes, nfiles):
+        super().account(nbytes, nfiles)
+        self.batches -= 1
+        if not self.batches:
+            raise Interrupted()
+
+class TestPurge(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-sstate-clean.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def write(self, path, size):
+        path = os.path.join(self.tempdir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+
+    def test_purge(self):
+        self.write("sstate/ab/cd/logged.tar.zst", 10)
+        self.write("sstate/ab/ef/leftover.tar.zst", 20)
+        self.write("unrelated/keep", 5)
+        with open(os.path.join(self.tempdir, sstate_clean.MOVE_LOG), "w") as f:
+            f.write("10\tsstate/ab/cd/logged.tar.zst\n5\tunrelated/keep\n")
+
+        throttle = CountingThrottle()
+        totals = sstate_clean.purge_staging(self.tempdir, 1000, throttle, False)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "sstate")))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, "unrelated", "keep")),
+                        msg="Only the sstate/ tree of the staging directory may be purged")
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, sstate_clean.MOVE_LOG)))
+        self.assertEqual((totals.actioned, totals.errors), (2, 0))
+        self.assertEqual((throttle.files, throttle.bytes), (2, 30),
+                         msg="Every batch, including leftovers, must be throttled")
+
+    def test_resume(self):
+        names = ["sstate/ab/cd/%d.tar.zst" % n for n in range(5)]
+        with open(os.path.join(self.tempdir, sstate_clean.MOVE_LOG), "w") as f:
+            for n, name in enumerate(names):
+                self.write(name, 10 + n)
+                f.write("%d\t%s\n" % (10 + n, name))
+        firstbatch = sum(len("%d\t%s\n" % (10 + n, name)) for n, name in enumerate(names[:2]))
+
+        throttle = InterruptingThrottle(1)
+        with self.assertRaises(Interrupted), contextlib.redirect_stdout(io.StringIO()):
+            sstate_clean.purge_staging(self.tempdir, 2, throttle, False)
+        self.assertEqual(sstate_clean.read_checkpoint(self.tempdir), {"offset" : firstbatch, "deleted" : 2, "deleted_bytes" : 21})
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir, "sstate", "ab", "cd"))), ["2.tar.zst", "3.tar.zst", "4.tar.zst"])
+
+        # As if the first run had already deleted 2.tar.zst when it was killed
+        os.unlink(os.path.join(self.tempdir, names[2]))
+        throttle = InterruptingThrottle(1)
+        with self.assertRaises(Interrupted), contextlib.redirect_stdout(io.StringIO()) as out:
+            sstate_clean.purge_staging(self.tempdir, 2, throttle, False)
+        self.assertIn("Resuming purge of %s, 2 objects (21.0 B) already deleted" % self.tempdir, out.getvalue())
+        self.assertIn("Move log lists 3 objects, 39.0 B to delete", out.getvalue())
+        self.assertEqual(sstate_clean.read_checkpoint(self.tempdir)["deleted"], 3,
+                         msg="Objects already gone must not be counted again")
+        self.assertEqual(sstate_clean.read_checkpoint(self.tempdir)["deleted_bytes"], 34)
+
+        throttle = CountingThrottle()
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            totals = sstate_clean.purge_staging(self.tempdir, 2, throttle, False)
+        self.assertIn("3 objects (34.0 B) already deleted", out.getvalue())
+        self.assertEqual((totals.scanned, totals.actioned), (1, 1))
+        self.assertEqual((throttle.files, throttle.bytes), (1, 14))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "sstate")))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, sstate_clean.PURGE_CHECKPOINT)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+import sstate_index
+
+from sstate_clean import SstateObject
+
+
+def name(recipe, task="package", suffix=""):
+    return "sstate:%s:core2-64-poky-linux:1.0:r0:core2-64:11:%s_%s.tar.zst%s" % (recipe, "0" * 64, task, suffix)
+
+class TestParseName(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(sstate_index.parse_sstate_name(name("zlib")), ("zlib", "package", ""))
+        self.assertEqual(sstate_index.parse_sstate_name(name("zlib", "populate_sysroot", ".siginfo")), ("zlib", "populate_sysroot", "siginfo"))
+        self.assertEqual(sstate_index.parse_sstate_name("foo.tgz.sig"), (None, None, "sig"))
+
+class TestSstateIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-sstate-index.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.sstatedir = os.path.join(self.tempdir, "sstate")
+        self.index = sstate_index.SstateIndex(os.path.join(self.tempdir, "index.sqlite"))
+        self.addCleanup(self.index.close)
+
+    def write(self, prefix, filename, size=10, age=0):
+        d = os.path.join(self.sstatedir, prefix)
+        os.makedirs(d, exist_ok=True)
+        path = os.path.join(d, filename)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        if age:
+            os.utime(path, (1000000000 - age, 1000000000 - age))
+        return path
+
+    def touch_dir(self, prefix, mtime):
+        # Make sure a change is seen even within the timestamp granularity
+        os.utime(os.path.join(self.sstatedir, prefix), (mtime, mtime))
+
+    def paths(self):
+        return sorted(p for p, in self.index.db.execute("SELECT path FROM objects"))
+
+    def test_update(self):
+        a = self.write("ab/cd", name("zlib"))
+        b = self.write("ab/ef", name("glibc"), size=20)
+        self.write("ab/ef", "README")
+        self.assertEqual(self.index.update(self.sstatedir, jobs=2), (4, 4))
+        self.assertEqual(self.paths(), [a, b], msg="Only sstate objects are indexed")
+        self.assertEqual(self.index.totals(), (2, 30))
+        self.assertEqual(self.index.top_recipes(), [("glibc", 1, 20), ("zlib", 1, 10)])
+
+        self.assertEqual(self.index.update(self.sstatedir), (0, 4), msg="Unchanged directories aren't rescanned")
+
+        c = self.write("ab/ef", name("busybox"))
+        self.touch_dir("ab/ef", 2000000000)
+        self.assertEqual(self.index.update(self.sstatedir), (1, 4))
+        self.assertEqual(self.paths(), [a, c, b])
+
+        os.unlink(b)
+        self.touch_dir("ab/ef", 2000000001)
+        shutil.rmtree(os.path.join(self.sstatedir, "ab", "cd"))
+        self.touch_dir("ab", 2000000001)
+        self.assertEqual(self.index.update(self.sstatedir), (2, 3))
+        self.assertEqual(self.paths(), [c], msg="Removed objects and directories must leave the index")
+        self.assertEqual(self.index.db.execute("SELECT COUNT(*) FROM dirs").fetchone(), (3,))
+
+    def test_select(self):
+        old = self.write("ab/cd", name("zlib"), age=30 * 86400)
+        self.write("ab/cd", name("glibc"), age=5 * 86400)
+        other = self.write("a_/cd", name("busybox"), age=30 * 86400)
+        self.index.update(self.sstatedir)
+        cutoff = 1000000000 - 10 * 86400
+        self.assertEqual(sorted(o.path for o in self.index.select(cutoff, cutoff)), [other, old])
+        self.assertEqual([o.path for o in self.index.select(cutoff, cutoff, under=os.path.join(self.sstatedir, "ab"))], [old])
+        self.assertEqual([o.path for o in self.index.select(cutoff, cutoff, under=os.path.join(self.sstatedir, "a_") + "/")], [other],
+                         msg="_ in the prefix must not match any character")
+        self.assertEqual(self.index.totals(cutoff, cutoff), (2, 20))
+
+    def test_refresh_remove(self):
+        old = self.write("ab/cd", name("zlib"), age=30 * 86400)
+        gone = self.write("ab/cd", name("glibc"), age=30 * 86400)
+        self.index.update(self.sstatedir)
+        cutoff = 1000000000 - 10 * 86400
+        self.assertEqual(len(self.index.select(cutoff, cutoff)), 2)
+
+        # old was read since the update, gone was deleted
+        self.index.refresh([SstateObject(old, 15, 1000000000 - 30 * 86400, 1000000000)])
+        self.index.remove([gone])
+        self.assertEqual(self.index.select(cutoff, cutoff), [])
+        self.assertEqual(self.index.select(), [SstateObject(old, 15, 1000000000 - 30 * 86400, 1000000000)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import tempfile
+import unittest
+import summarize_top_output
+
+
+HOME = summarize_top_output.HOME
+HEADER = [
+    "top - 10:01:02 up 12 days,  3:04,  0 users,  load average: 95.12, 80.03, 70.44",
+    "Tasks: 1412 total,  60 running, 1340 sleeping,   0 stopped,  12 zombie",
+    "%Cpu(s): 80.1 us, 15.2 sy,  0.0 ni,  4.1 id,  0.4 wa,  0.0 hi,  0.2 si,  0.0 st",
+    "MiB Mem : 257652.1 total,  10234.5 free, 120345.6 used, 127072.0 buff/cache",
+    "MiB Swap:   8192.0 total,   8100.0 free,     92.0 used. 130000.2 avail Mem",
+    "",
+    "    PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM     TIME+ COMMAND",
+]
+CC1 = HOME + "qemux86-64/build/build/tmp/work/core2-64-poky-linux/gcc/14.2.0/recipe-sysroot-native/usr/bin/x86_64-poky-linux/../../libexec/x86_64-poky-linux/gcc/x86_64-poky-linux/14.2.0/cc1 -quiet a.c"
+SNAPSHOTS = [
+    [CC1, "make -j 16", "sh -c true", "make -j 16", "sh -c false",
+     "[kworker/u64:1-events]", "[kworker/u64:2-events]", "[rcu_sched]",
+     "[Parser-1] <defunct>", "[Parser-2] <defunct>", "[sh] <defunct>",
+     "tar -xf foo.tar.gz", "python3 " + HOME + "beaglebone/build/bitbake/bin/bitbake-worker x", CC1],
+    ["rm -rf x", "qemu-system-x86_64 -m 512", "ld -o x", "ld -o y", HOME + "a-full/build/x"],
+]
+
+# Output of the original list based implementation for the data above
+EXPECTED = (
+    'NOTE:\n'
+    'Processes that occur only once is not reported.\n'
+    'Program names have been shortened for better readability.\n'
+    'Substitutions are as follows:\n'
+    '~/ = /home/pokybuild/yocto-worker/\n'
+    '/...WORK_DIR.../ = /build/build/tmp/work/\n'
+    '\n'
+    'top was invoked 2 times.\n'
+    '\n'
+    'Current build: t\n'
+    'Other builds: qemux86-64 a-full\n'
+    '\n'
+    'top - 10:01:02 up 12 days,  3:04,  0 users,  load average: 95.12, 80.03, 70.44\n'
+    'Tasks: 1412 total,  60 running, 1340 sleeping,   0 stopped,  12 zombie\n'
+    '%Cpu(s): 80.1 us, 15.2 sy,  0.0 ni,  4.1 id,  0.4 wa,  0.0 hi,  0.2 si,  0.0 st\n'
+    'MiB Mem : 257652.1 total,  10234.5 free, 120345.6 used, 127072.0 buff/cache\n'
+    'MiB Swap:   8192.0 total,   8100.0 free,     92.0 used. 130000.2 avail Mem\n'
+    '\n'
+    'PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM     TIME+ COMMAND\n'
+    '0 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 /home/pokybuild/yocto-worker/qemux86-64/build/build/tmp/work/core2-64-poky-linux/gcc/14.2.0/recipe-sysroot-native/usr/bin/x86_64-poky-linux/../../libexec/x86_64-poky-linux/gcc/x86_64-poky-linux/14.2.0/cc1 -quiet a.c\n'
+    '1 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 make -j 16\n'
+    '2 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 sh -c true\n'
+    '3 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 make -j 16\n'
+    '4 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 sh -c false\n'
+    '\n'
+    'Userspace Process Summary: \n'
+    '2  ~/qemux86-64/...WORK_DIR.../core2-64-poky-linux/gcc/14.2.0/...GCC.../x86_64-poky-linux/14.2.0/cc1\n'
+    '2  make\n'
+    '2  sh\n'
+    '1  tar\n'
+    '\n'
+    'Kernel Process Summary: \n'
+    '2  kworker\n'
+    '\n'
+    'Zombie Process Summary: \n'
+    '2  Parser\n'
+    '\n'
+    'top - 10:01:02 up 12 days,  3:04,  0 users,  load average: 95.12, 80.03, 70.44\n'
+    'Tasks: 1412 total,  60 running, 1340 sleeping,   0 stopped,  12 zombie\n'
+    '%Cpu(s): 80.1 us, 15.2 sy,  0.0 ni,  4.1 id,  0.4 wa,  0.0 hi,  0.2 si,  0.0 st\n'
+    'MiB Mem : 257652.1 total,  10234.5 free, 120345.6 used, 127072.0 buff/cache\n'
+    'MiB Swap:   8192.0 total,   8100.0 free,     92.0 used. 130000.2 avail Mem\n'
+    '\n'
+    'PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM     TIME+ COMMAND\n'
+    '0 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 rm -rf x\n'
+    '1 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 qemu-system-x86_64 -m 512\n'
+    '2 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 ld -o x\n'
+    '3 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 ld -o y\n'
+    '4 pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 /home/pokybuild/yocto-worker/a-full/build/x\n'
+    '\n'
+    'Userspace Process Summary: \n'
+    '2  ld\n'
+    '1  rm\n'
+    '1  qemu-system-x86_64\n'
+    '\n'
+    'Kernel Process Summary: \n'
+    '\n'
+    'Zombie Process Summary: \n'
+    '\n'
+)
+
+
+class TestSummarizeTop(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def process(self, pid, cmd):
+        return "%7d pokybu+  20   0  123456  65432  12345 R  99.0   0.1   1:23.45 %s\n" % (pid, cmd)
+
+    def write_host_stats(self):
+        logfile = os.path.join(self.tmpdir, "host_stats_0_top.txt")
+        with open(logfile, "w") as f:
+            # A stray end marker and data between snapshots are ignored
+            f.write("unrelated\nend: top output\n")
+            for snapshot in SNAPSHOTS:
+                f.write("start: top output\n")
+                f.write("".join(l + "\n" for l in HEADER))
+                f.write("".join(self.process(pid, cmd) for pid, cmd in enumerate(snapshot)))
+                f.write("end: top output\nmore data\n")
+            # An unterminated snapshot isn't reported
+            f.write("start: top output\n")
+            f.write("".join(l + "\n" for l in HEADER))
+            f.write(self.process(1, HOME + "unterminated/x"))
+        return logfile
+
+    def test_summary(self):
+        logfile = self.write_host_stats()
+        outfile = summarize_top_output.summarize_file(logfile, "t")
+        self.assertEqual(outfile, os.path.join(self.tmpdir, "host_stats_0_top_summary.txt"))
+        with open(outfile) as f:
+            self.assertEqual(f.read(), EXPECTED)
+
+    def test_aggregates(self):
+        snapshots, other_builds = summarize_top_output.summarize_top(self.write_host_stats())
+        self.assertEqual(len(snapshots), 2)
+        self.assertEqual(other_builds, ["qemux86-64", "a-full"])
+        self.assertEqual(list(snapshots[0].summary.items()), [(CC1.split()[0], 2), ("make", 2), ("sh", 2), ("tar", 1), ("python3", 1)])
+        self.assertEqual(dict(snapshots[0].kernel_summary), {"kworker": 2, "rcu_sched": 1})
+        self.assertEqual(dict(snapshots[0].zombie_summary), {"Parser": 2, "sh": 1})
+        self.assertEqual(len(snapshots[0].short_summary), summarize_top_output.top_header + summarize_top_output.cpu_hoggers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import testresults_store
+
+
+def make_run(revision, machine, results, branch="master", image="core-image-sato"):
+    return {
+        "configuration" : {
+            "LAYERS" : {"meta" : {"branch" : branch, "commit" : revision, "commit_count" : 1000}},
+            "TEST_TYPE" : "runtime",
+            "MACHINE" : machine,
+            "IMAGE_BASENAME" : image,
+            "STARTTIME" : "20260101000000",
+        },
+        "result" : dict((test, {"status" : status, "duration" : 1.0}) for test, status in results.items()),
+    }
+
+class TestTestResultsStore(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-testresults-store.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.db = os.path.join(self.tempdir, "store", "testresults.sqlite")
+
+    def write_results(self, build, target, runs):
+        d = os.path.join(self.tempdir, build, "testresults", target)
+        os.makedirs(d, exist_ok=True)
+        path = os.path.join(d, "testresults.json")
+        with open(path, "w") as f:
+            json.dump(runs, f)
+        return path
+
+    def test_ingest(self):
+        self.write_results("build1", "qemux86-64", {
+            "run1" : make_run("aaaa1111", "qemux86-64", {"ping.PingTest.test_ping" : "PASSED",
+                                                          "ptestresult.zlib.test1" : "FAILED"})})
+        self.write_results("build1", "qemuarm", {
+            "run2" : make_run("aaaa1111", "qemuarm", {"ping.PingTest.test_ping" : "PASSED"})})
+        self.assertEqual(testresults_store.ingest(self.db, [self.tempdir]), (2, 2))
+        self.assertEqual(testresults_store.ingest(self.db, [self.tempdir]), (0, 0),
+                         msg="Unchanged files must not be read again")
+
+        store = testresults_store.TestResultsStore(self.db)
+        self.addCleanup(store.close)
+        self.assertEqual([r[:3] for r in store.revisions()], [("master", "aaaa1111", 2)])
+        runs = store.runs("aaaa1111")
+        self.assertEqual(sorted(name for _, name in runs.values()), ["run1", "run2"])
+        results = store.results(dict((name, runid) for runid, name in runs.values())["run1"])
+        self.assertEqual(results, {"ping.PingTest.test_ping" : "PASSED", "ptestresult.zlib.test1" : "FAILED"})
+        section = store.db.execute("SELECT section FROM results JOIN tests ON tests.id = results.test WHERE tests.name = ?",
+                                   ("ptestresult.zlib.test1",)).fetchone()
+        self.assertEqual(section, ("zlib",))
+
+    def test_reingest_changed(self):
+        path = self.write_results("build1", "qemux86-64", {
+            "run1" : make_run("aaaa1111", "qemux86-64", {"a" : "PASSED", "b" : "PASSED"})})
+        testresults_store.ingest(self.db, [path])
+        self.write_results("build1", "qemux86-64", {
+            "run1" : make_run("aaaa1111", "qemux86-64", {"a" : "FAILED"})})
+        os.utime(path, ns=(0, 0))
+        self.assertEqual(testresults_store.ingest(self.db, [path]), (1, 1))
+
+        store = testresults_store.TestResultsStore(self.db)
+        self.addCleanup(store.close)
+        runs = list(store.runs("aaaa1111").values())
+        self.assertEqual(len(runs), 1, msg="Runs of a changed file must be replaced")
+        self.assertEqual(store.results(runs[0][0]), {"a" : "FAILED"})
+
+    def test_regressions(self):
+        self.write_results("build1", "qemux86-64", {
+            "base-x86" : make_run("aaaa1111", "qemux86-64", {"a" : "PASSED", "b" : "SKIPPED", "c" : "FAILED", "d" : "PASSED"}),
+            "base-arm" : make_run("aaaa1111", "qemuarm", {"a" : "PASSED"})})
+        self.write_results("build2", "qemux86-64", {
+            "target-x86" : make_run("bbbb2222", "qemux86-64", {"a" : "PASSED", "b" : "FAILED", "c" : "FAILED"}),
+            "target-mips" : make_run("bbbb2222", "qemumips", {"a" : "PASSED"})})
+        testresults_store.ingest(self.db, [self.tempdir])
+
+        store = testresults_store.TestResultsStore(self.db)
+        self.addCleanup(store.close)
+        self.assertEqual(store.resolve("master"), "bbbb2222")
+        self.assertEqual(store.resolve("aaaa"), "aaaa1111")
+        self.assertIsNone(store.resolve("cccc"))
+
+        report, missing, added = store.regressions("aaaa1111", "bbbb2222")
+        self.assertEqual(report, [("base-x86", "target-x86", [("b", "SKIPPED", "FAILED"), ("d", "PASSED", None)])])
+        self.assertEqual(missing, ["base-arm"])
+        self.assertEqual(added, ["target-mips"])
+
+        text = testresults_store.regression_report(self.db, "aaaa1111", "bbbb2222")
+        self.assertIn("Total: 2 new regression(s)", text)
+        self.assertIn("    d: PASSED -> None\n", text)
+        self.assertIn("Not run for bbbb2222: base-arm\n", text)
+        self.assertIsNone(testresults_store.regression_report(self.db, "aaaa1111", "cccc"))
+
+    def test_invalid_files(self):
+        self.write_results("build1", "qemux86-64", {"run1" : make_run("aaaa1111", "qemux86-64", {"a" : "PASSED"})})
+        bad = [
+            ["not", "a", "dict"],
+            {"run" : "not a dict"},
+            {"run" : {"configuration" : [], "result" : {}}},
+            {"run" : {"configuration" : {}, "result" : ["a"]}},
+            {"run" : {"configuration" : {"LAYERS" : {"meta" : "poky"}}, "result" : {}}},
+            {"run" : {"configuration" : {"LAYERS" : {"meta" : {"branch" : ["master"]}}}, "result" : {}}},
+        ]
+        for n, data in enumerate(bad):
+            self.write_results("bad%d" % n, "qemux86-64", data)
+        d = os.path.join(self.tempdir, "truncated", "testresults")
+        os.makedirs(d)
+        with open(os.path.join(d, "testresults.json"), "w") as f:
+            f.write('{"run": {')
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            self.assertEqual(testresults_store.ingest(self.db, [self.tempdir]), (1, 1),
+                             msg="Invalid files must be skipped without stopping the ingest")
+        self.assertEqual(out.getvalue().count("Skipping "), len(bad) + 1)
+
+    def test_skips_hidden(self):
+        self.write_results(".objects", "x", {"run" : make_run("aaaa1111", "qemux86-64", {"a" : "PASSED"})})
+        self.assertEqual(testresults_store.ingest(self.db, [self.tempdir]), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,17 @@
 #!/usr/bin/env python3
 
+import errno
+import hashlib
+import io
+import json
 import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import threading
 import unittest
+import unittest.mock
 import utils
 
 
@@ -95,5 +105,272 @@ class TestGetComparisonBranch(unittest.TestCase):
             comparebranch, None,  msg="No specific comparebranch should be returned")
 
 
+class TestMoveToTrash(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-utils-trash.")
+        self.trashdir = os.path.join(self.tempdir, "trash")
+        self.spooldir = os.path.join(self.tempdir, "trash-spool")
+        os.makedirs(self.trashdir)
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def mount_tmpfs(self, path):
+        os.makedirs(path)
+        try:
+            subprocess.check_call(["mount", "-t", "tmpfs", "tmpfs", path], stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest("Unable to mount a tmpfs to simulate another filesystem")
+        self.addCleanup(subprocess.check_call, ["umount", path])
+
+    def make_build(self, path):
+        os.makedirs(os.path.join(path, "tmp", "work"))
+        with open(os.path.join(path, "tmp", "work", "file"), "w") as f:
+            f.write("data")
+
+    def test_same_device(self):
+        build = os.path.join(self.tempdir, "build")
+        self.make_build(build)
+        dest = utils.movetotrash(build, self.trashdir, self.spooldir)
+        self.assertFalse(os.path.exists(build))
+        self.assertEqual(os.path.dirname(dest), self.trashdir)
+        self.assertTrue(os.path.exists(os.path.join(dest, "build", "tmp", "work", "file")))
+        self.assertEqual(utils.readtrashspool(self.spooldir), [],
+                         msg="TRASH_DIR is always monitored, nothing should be spooled")
+
+    def test_cross_device(self):
+        otherfs = os.path.join(self.tempdir, "otherfs")
+        self.mount_tmpfs(otherfs)
+        build = os.path.join(otherfs, "builds", "build")
+        self.make_build(build)
+        self.assertNotEqual(os.stat(build).st_dev, os.stat(self.trashdir).st_dev)
+
+        dest = utils.movetotrash(build, self.trashdir, self.spooldir)
+        self.assertFalse(os.path.exists(build))
+        trashroot = os.path.join(otherfs, ".ab-trash")
+        self.assertEqual(os.path.dirname(dest), trashroot,
+                         msg="Cross device clobber must use a trash root on the same filesystem")
+        self.assertEqual(os.stat(dest).st_dev, os.stat(otherfs).st_dev)
+        self.assertTrue(os.path.exists(os.path.join(dest, "build", "tmp", "work", "file")))
+
+        requests = [r for _, r in utils.readtrashspool(self.spooldir)]
+        self.assertEqual(requests, [{"type" : "trashroot", "path" : trashroot}])
+
+    def test_cross_device_mountpoint(self):
+        otherfs = os.path.join(self.tempdir, "otherfs")
+        self.mount_tmpfs(otherfs)
+        self.make_build(otherfs)
+
+        dest = utils.movetotrash(otherfs, self.trashdir, self.spooldir)
+        self.assertIsNone(dest, msg="A mountpoint can't be renamed and must be queued for deletion")
+        self.assertTrue(os.path.exists(os.path.join(otherfs, "tmp", "work", "file")))
+        requests = [r for _, r in utils.readtrashspool(self.spooldir)]
+        self.assertEqual(requests, [{"type" : "delete", "path" : otherfs}])
+
+    def test_bind_mount(self):
+        src = os.path.join(self.tempdir, "src")
+        bind = os.path.join(self.tempdir, "bind")
+        os.makedirs(src)
+        os.makedirs(bind)
+        try:
+            subprocess.check_call(["mount", "--bind", src, bind], stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest("Unable to bind mount a directory")
+        self.addCleanup(subprocess.check_call, ["umount", bind])
+        build = os.path.join(bind, "builds", "build")
+        self.make_build(build)
+        self.assertEqual(os.stat(build).st_dev, os.stat(self.trashdir).st_dev)
+
+        dest = utils.movetotrash(build, self.trashdir, self.spooldir)
+        self.assertFalse(os.path.exists(build))
+        self.assertEqual(os.listdir(self.trashdir), [], msg="The failed attempt must not leave a directory behind")
+        trashroot = os.path.join(bind, ".ab-trash")
+        self.assertEqual(os.path.dirname(dest), trashroot,
+                         msg="A bind mount needs a trash root inside the mount")
+        self.assertTrue(os.path.exists(os.path.join(dest, "build", "tmp", "work", "file")))
+        requests = [r for _, r in utils.readtrashspool(self.spooldir)]
+        self.assertEqual(requests, [{"type" : "trashroot", "path" : trashroot}])
+
+
+class TestLinkOrCopyTree(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-utils-link.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.src = os.path.join(self.tempdir, "src")
+        os.makedirs(os.path.join(self.src, "sub"))
+        with open(os.path.join(self.src, "a"), "wb") as f:
+            f.write(b"x" * 10)
+        with open(os.path.join(self.src, "sub", "b"), "wb") as f:
+            f.write(b"x" * 20)
+
+    def test_linked(self):
+        dest = os.path.join(self.tempdir, "dest")
+        os.makedirs(dest)
+        with open(os.path.join(dest, "a"), "w") as f:
+            f.write("old")
+        self.assertEqual(utils.linkorcopytree(self.src, dest), (30, 0))
+        self.assertTrue(os.path.samefile(os.path.join(self.src, "sub", "b"), os.path.join(dest, "sub", "b")))
+        self.assertTrue(os.path.samefile(os.path.join(self.src, "a"), os.path.join(dest, "a")),
+                        msg="Existing files must be replaced")
+
+    def test_copied(self):
+        dest = os.path.join(self.tempdir, "dest")
+        with unittest.mock.patch.object(utils, "linkorcopy", side_effect=lambda src, dest: shutil.copy2(src, dest) and "copy"):
+            self.assertEqual(utils.linkorcopytree(self.src, dest), (0, 30))
+        with open(os.path.join(dest, "sub", "b"), "rb") as f:
+            self.assertEqual(f.read(), b"x" * 20)
+
+
+class TestArchiveDir(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="test-utils-archive.")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        if not shutil.which("zstd"):
+            self.skipTest("zstd is not available")
+        self.src = os.path.join(self.tempdir, "results")
+        os.makedirs(os.path.join(self.src, "sub"))
+        # Larger than a pipe buffer so the tar writer blocks if nothing reads
+        with open(os.path.join(self.src, "sub", "data"), "wb") as f:
+            f.write(os.urandom(4 * 1024 * 1024))
+        self.dest = os.path.join(self.tempdir, "results.tar.zst")
+
+    def archive(self):
+        # Run in a thread so a hang fails the test rather than blocking it
+        result = []
+        def run():
+            try:
+                result.append(utils.archivedir(self.src, "results", self.dest))
+            except Exception as e:
+                result.append(e)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(60)
+        self.assertFalse(thread.is_alive(), msg="archivedir() must not hang")
+        return result[0]
+
+    def test_archive(self):
+        size, sha256 = self.archive()
+        with open(self.dest, "rb") as f:
+            data = f.read()
+        self.assertEqual((size, sha256), (len(data), hashlib.sha256(data).hexdigest()))
+        with open(self.dest + ".sha256") as f:
+            self.assertEqual(f.read(), "%s  results.tar.zst\n" % sha256)
+        tarball = subprocess.check_output(["zstd", "-d", "-q", "-c", self.dest])
+        with tarfile.open(fileobj=io.BytesIO(tarball)) as tar:
+            self.assertEqual(sorted(tar.getnames()), ["results", "results/sub", "results/sub/data"])
+
+    def test_write_error(self):
+        realopen = open
+        class FullFile(io.FileIO):
+            def write(self, data):
+                raise OSError(errno.ENOSPC, "No space left on device")
+        def fakeopen(path, mode="r", *args, **kwargs):
+            if path == self.dest + ".tmp":
+                return FullFile(path, "w")
+            return realopen(path, mode, *args, **kwargs)
+        with unittest.mock.patch("builtins.open", fakeopen):
+            error = self.archive()
+        self.assertIsInstance(error, OSError)
+        self.assertEqual(error.errno, errno.ENOSPC)
+        self.assertEqual(os.listdir(self.tempdir), ["results"], msg="No partial archive may be left")
+
+class TestJSONStreamReader(unittest.TestCase):
+    DOC = {
+        "run1": {
+            "result": {"t%d" % i: {"status": "PASSED", "log": "a \"quoted\" {log} [%d]" % i} for i in range(200)},
+            "configuration": {"LAYERS": {"meta": {"branch": "master", "commit": "abc"}}, "VERSION": 1.25e3},
+        },
+        "run2": {"configuration": {"LAYERS": {"meta": {"branch": "other"}}}},
+    }
+
+    def find(self, text, path, chunksize=7):
+        return utils.JSONStreamReader(io.StringIO(text), chunksize).find(path)
+
+    def test_find(self):
+        text = json.dumps(self.DOC, indent=2)
+        for chunksize in [1, 7, 65536]:
+            self.assertEqual(self.find(text, [None, "configuration", "LAYERS", "meta", "branch"], chunksize), "master")
+            self.assertEqual(self.find(text, ["run1", "configuration", "VERSION"], chunksize), 1250.0)
+            self.assertEqual(self.find(text, ["run2", "configuration"], chunksize), self.DOC["run2"]["configuration"])
+
+    def test_not_found(self):
+        with self.assertRaises(utils.JSONStreamReader.NotFound):
+            self.find(json.dumps(self.DOC), [None, "configuration", "MACHINE"])
+        with self.assertRaises(utils.JSONStreamReader.NotFound):
+            self.find("[1, 2]", ["a"])
+
+    def test_early_exit(self):
+        f = io.StringIO(json.dumps({"a": {"b": 1}, "c": "x" * 1000000}))
+        self.assertEqual(utils.JSONStreamReader(f, 1024).find(["a", "b"]), 1)
+        self.assertLess(f.tell(), 4096)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            self.find('{"a": {"b" 1}}', ["a", "b"])
+
+    def test_iterate(self):
+        text = json.dumps({"x": [1, 2], "package": [{"name": "a", "issue": [{"id": 1}, {"id": 2}]}, {"issue": [], "name": "b"}], "y": {}})
+        for chunksize in [1, 7, 65536]:
+            reader = utils.JSONStreamReader(io.StringIO(text), chunksize)
+            found = []
+            for key in reader.items():
+                if key != "package":
+                    reader.skip_value()
+                    continue
+                for _ in reader.elements():
+                    package = {}
+                    for key in reader.items():
+                        if key == "issue":
+                            package[key] = [reader.read_value()["id"] for _ in reader.elements()]
+                        else:
+                            package[key] = reader.read_value()
+                    found.append(package)
+            self.assertEqual(found, [{"name": "a", "issue": [1, 2]}, {"issue": [], "name": "b"}])
+
+
+class TestGitMetadata(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpdir, "repo")
+        self.git("init", "-q", "-b", "master", self.repo, cwd=self.tmpdir)
+        for i in range(3):
+            self.git("commit", "-q", "--allow-empty", "-m", "commit %d" % i)
+            self.git("tag", "-a", "-m", "tag", "yocto-4.%d" % i)
+        self.git("tag", "light", "HEAD~1")
+        utils.gitcache_clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        utils.gitcache_clear()
+
+    def git(self, *args, cwd=None):
+        env = dict(os.environ, GIT_AUTHOR_NAME="a", GIT_AUTHOR_EMAIL="a@b", GIT_COMMITTER_NAME="a", GIT_COMMITTER_EMAIL="a@b")
+        return subprocess.check_output(["git"] + list(args), cwd=cwd or self.repo, env=env).decode("utf-8").strip()
+
+    def test_head(self):
+        head = self.git("rev-parse", "HEAD")
+        self.assertEqual(utils.readref(self.repo), head)
+        self.git("pack-refs", "--all")
+        self.assertEqual(utils.readref(self.repo), head)
+        self.assertEqual(utils.githead(self.repo), head)
+
+    def test_detached_and_worktree(self):
+        self.git("checkout", "-q", "HEAD~2")
+        self.assertEqual(utils.readref(self.repo), self.git("rev-parse", "HEAD"))
+        worktree = os.path.join(self.tmpdir, "wt")
+        self.git("worktree", "add", "-q", "-b", "other", worktree, "master~1")
+        self.assertEqual(utils.readref(worktree), self.git("rev-parse", "master~1"))
+        self.assertEqual(utils.githeads([self.repo, worktree]),
+                         {self.repo : self.git("rev-parse", "HEAD"), worktree : self.git("rev-parse", "master~1")})
+
+    def test_memoized(self):
+        head = utils.githead(self.repo)
+        self.git("commit", "-q", "--allow-empty", "-m", "another")
+        self.assertEqual(utils.githead(self.repo), head)
+        utils.gitcache_clear()
+        self.assertEqual(utils.githead(self.repo), self.git("rev-parse", "HEAD"))
+
+    def test_describe(self):
+        self.assertEqual(utils.gitdescribe(self.repo), "yocto-4.2")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: GPL-2.0-only
+#
+# Local store of test results for fast regression queries
+#
+# testresults.json files are ingested into an SQLite database with one row
+# per test run (keyed by branch and revision, with the configuration used to
+# match runs between revisions) and one row per test result holding the
+# status, duration and ptest section. Test names and statuses are interned
+# so a full build's results take little space. Ingestion is incremental,
+# files are only re-read when their mtime or size change.
+#
+# Regression reports between two revisions then come from the store
+# without cloning the test results repository or parsing historic files.
+#
+
+import fcntl
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+import utils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    file TEXT,
+    name TEXT,
+    branch TEXT,
+    revision TEXT,
+    commit_count INTEGER,
+    starttime TEXT,
+    match TEXT,
+    ingested REAL
+);
+CREATE INDEX IF NOT EXISTS runs_file ON runs(file);
+CREATE INDEX IF NOT EXISTS runs_revision ON runs(revision);
+CREATE INDEX IF NOT EXISTS runs_branch ON runs(branch, ingested);
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS statuses (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS results (
+    run INTEGER,
+    test INTEGER,
+    status INTEGER,
+    duration REAL,
+    section TEXT,
+    PRIMARY KEY (run, test)
+) WITHOUT ROWID;
+"""
+
+# Configuration used to pair up the runs of two revisions
+MATCH_KEYS = ["TEST_TYPE", "TESTSERIES", "MACHINE", "IMAGE_BASENAME", "HOST_DISTRO"]
+
+PASSING = ["PASSED", "SKIPPED", "EXPECTEDFAIL"]
+
+def run_metadata(config):
+    meta = config.get("LAYERS", {}).get("meta", {})
+    match = json.dumps([config.get(k) for k in MATCH_KEYS])
+    return meta.get("branch"), meta.get("commit"), meta.get("commit_count"), config.get("STARTTIME"), match
+
+SCALARS = (str, int, float, type(None))
+
+def check_results(data):
+    """Raise ValueError unless data has the structure of a testresults.json"""
+    if not isinstance(data, dict):
+        raise ValueError("not an object of test runs")
+    for name, run in data.items():
+        if not isinstance(run, dict):
+            raise ValueError("run %s is not an object" % name)
+        config = run.get("configuration", {})
+        if not isinstance(config, dict) or not isinstance(run.get("result", {}), dict):
+            raise ValueError("run %s has no configuration or result object" % name)
+        meta = config.get("LAYERS", {})
+        meta = meta.get("meta", {}) if isinstance(meta, dict) else None
+        if not isinstance(meta, dict):
+            raise ValueError("run %s has an invalid LAYERS configuration" % name)
+        for value in [meta.get("branch"), meta.get("commit"), meta.get("commit_count"), config.get("STARTTIME")]:
+            if not isinstance(value, SCALARS):
+                raise ValueError("run %s has an invalid revision or start time" % name)
+
+def ptest_section(test):
+    """ptestresult.<section>.<test> results belong to a ptest section"""
+    if test.startswith("ptestresult."):
+        parts = test.split(".", 2)
+        if len(parts) == 3:
+            return parts[1]
+    return None
+
+def find_testresults(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield os.path.abspath(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            # Skip hidden directories such as the collect-results object store
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            if "testresults.json" in files:
+                yield os.path.abspath(os.path.join(root, "testresults.json"))
+
+class TestResultsStore(object):
+    def __init__(self, dbpath):
+        self.dbpath = dbpath
+        utils.mkdir(os.path.dirname(os.path.abspath(dbpath)))
+        self.db = sqlite3.connect(dbpath, timeout=60)
+        # The store may live on shared storage where WAL doesn't work
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.executescript(SCHEMA)
+        self.tests = dict((name, id) for id, name in self.db.execute("SELECT id, name FROM tests"))
+        self.statuses = dict((name, id) for id, name in self.db.execute("SELECT id, name FROM statuses"))
+
+    def close(self):
+        self.db.close()
+
+    def intern(self, table, cache, name):
+        if name not in cache:
+            cache[name] = self.db.execute("INSERT INTO %s (name) VALUES (?)" % table, (name,)).lastrowid
+        return cache[name]
+
+    def ingest_file(self, path):
+        """
+        Add the runs in a testresults.json, returns the number of runs added
+        or None if unchanged. Raises ValueError for files which aren't valid
+        test results.
+        """
+        st = os.stat(path)
+        known = self.db.execute("SELECT mtime, size FROM files WHERE path = ?", (path,)).fetchone()
+        if known == (st.st_mtime_ns, st.st_size):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        check_results(data)
+        try:
+            self.add_runs(path, data, st)
+        except Exception:
+            # Interned names from the rolled back transaction are gone again
+            self.tests = dict((name, id) for id, name in self.db.execute("SELECT id, name FROM tests"))
+            self.statuses = dict((name, id) for id, name in self.db.execute("SELECT id, name FROM statuses"))
+            raise
+        return len(data)
+
+    def add_runs(self, path, data, st):
+        with self.db:
+            for (runid,) in self.db.execute("SELECT id FROM runs WHERE file = ?", (path,)).fetchall():
+                self.db.execute("DELETE FROM results WHERE run = ?", (runid,))
+            self.db.execute("DELETE FROM runs WHERE file = ?", (path,))
+            for name, run in data.items():
+                branch, revision, commit_count, starttime, match = run_metadata(run.get("configuration", {}))
+                runid = self.db.execute("INSERT INTO runs (file, name, branch, revision, commit_count, starttime, match, ingested) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (path, name, branch, revision, commit_count, starttime, match, time.time())).lastrowid
+                rows = []
+                for test, result in run.get("result", {}).items():
+                    if not isinstance(result, dict) or "status" not in result:
+                        continue
+                    rows.append((runid, self.intern("tests", self.tests, test), self.intern("statuses", self.statuses, result["status"]),
+                                 result.get("duration"), ptest_section(test)))
+                self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (path, st.st_mtime_ns, st.st_size))
+
+    def revisions(self, branch=None):
+        query = "SELECT branch, revision, COUNT(*), MAX(ingested) FROM runs"
+        params = []
+        if branch:
+            query += " WHERE branch = ?"
+            params.append(branch)
+        query += " GROUP BY branch, revision ORDER BY MAX(ingested) DESC"
+        return self.db.execute(query, params).fetchall()
+
+    def resolve(self, ref, repo=None):
+        """
+        Map a branch name (its most recently ingested revision), a revision
+        or prefix of one, or with repo any git reference, to a revision.
+        """
+        row = self.db.execute("SELECT revision FROM runs WHERE branch = ? ORDER BY ingested DESC LIMIT 1", (ref,)).fetchone()
+        if row:
+            return row[0]
+        rows = self.db.execute("SELECT DISTINCT revision FROM runs WHERE revision LIKE ?", (ref + "%",)).fetchall()
+        if len(rows) == 1:
+            return rows[0][0]
+        if repo:
+            try:
+                revision = subprocess.check_output(["git", "rev-parse", ref + "^{commit}"], cwd=repo, stderr=subprocess.DEVNULL).decode("utf-8").strip()
+            except subprocess.CalledProcessError:
+                return None
+            if self.db.execute("SELECT 1 FROM runs WHERE revision = ? LIMIT 1", (revision,)).fetchone():
+                return revision
+        return None
+
+    def runs(self, revision):
+        """Return {match: (run id, name)} for a revision, the latest run wins for duplicates"""
+        runs = {}
+        for runid, name, match in self.db.execute("SELECT id, name, match FROM runs WHERE revision = ? ORDER BY ingested, id", (revision,)):
+            runs[match] = (runid, name)
+        return runs
+
+    def results(self, runid):
+        return dict(self.db.execute("SELECT tests.name, statuses.name FROM results JOIN tests ON tests.id = results.test "
+                                    "JOIN statuses ON statuses.id = results.status WHERE run = ?", (runid,)))
+
+    def regressions(self, base, target):
+        """
+        Compare the matching runs of two revisions. Returns a list of
+        (base run, target run, [(test, base status, target status)]) and
+        the configurations only present in one of the revisions.
+        """
+        baseruns = self.runs(base)
+        targetruns = self.runs(target)
+        report = []
+        for match in sorted(set(baseruns) & set(targetruns)):
+            baseresults = self.results(baseruns[match][0])
+            targetresults = self.results(targetruns[match][0])
+            changes = []
+            for test in sorted(baseresults):
+                before = baseresults[test]
+                after = targetresults.get(test)
+                if before in PASSING and after not in PASSING:
+                    changes.append((test, before, after))
+            report.append((baseruns[match][1], targetruns[match][1], changes))
+        missing = sorted(baseruns[m][1] for m in set(baseruns) - set(targetruns))
+        added = sorted(targetruns[m][1] for m in set(targetruns) - set(baseruns))
+        return report, missing, added
+
+def lock_store(dbpath):
+    utils.mkdir(os.path.dirname(os.path.abspath(dbpath)))
+    lf = open(dbpath + ".lock", "a+")
+    fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+    return lf
+
+def ingest(dbpath, paths):
+    """Ingest the testresults.json files found below paths, returns (files read, runs added)"""
+    with lock_store(dbpath):
+        store = TestResultsStore(dbpath)
+        files = 0
+        runs = 0
+        for path in find_testresults(paths):
+            try:
+                added = store.ingest_file(path)
+            except ValueError as e:
+                # One broken file mustn't keep the others out of the store
+                print("Skipping %s: %s" % (path, e))
+                continue
+            if added is not None:
+                files += 1
+                runs += added
+        store.close()
+    return files, runs
+
+def format_report(base, target, report, missing, added):
+    out = "Regression report from the test results store, %s -> %s\n\n" % (base, target)
+    total = 0
+    for baserun, targetrun, changes in report:
+        if not changes:
+            continue
+        total += len(changes)
+        out += "Regression:  %s\n             %s\n" % (baserun, targetrun)
+        out += "    Total: %d new regression(s)\n" % len(changes)
+        for test, before, after in changes:
+            out += "    %s: %s -> %s\n" % (test, before, after)
+        out += "\n"
+    if not total:
+        out += "No regressions found in %d matched runs\n" % len(report)
+    for name in missing:
+        out += "Not run for %s: %s\n" % (target, name)
+    for name in added:
+        out += "Not run for %s: %s\n" % (base, name)
+    return out
+
+def regression_report(dbpath, base, target, repo=None):
+    """Return the text report between two references, or None if the store can't resolve them"""
+    if not os.path.exists(dbpath):
+        return None
+    store = TestResultsStore(dbpath)
+    try:
+        baserev = store.resolve(base, repo)
+        targetrev = store.resolve(target, repo)
+        if not baserev or not targetrev:
+            return None
+        report, missing, added = store.regressions(baserev, targetrev)
+        if not report:
+            return None
+        return format_report(base, target, report, missing, added)
+    finally:
+        store.close()
+
+def main():
+    parser = utils.ArgParser(description='Maintain and query a local store of test results.')
+    parser.add_argument('-s', '--store',
+                        help="The store database (default: TESTRESULTS_STORE from the config)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser('ingest', help="Add testresults.json files, or directories containing them")
+    p.add_argument('paths', nargs='+')
+
+    p = subparsers.add_parser('revisions', help="List the revisions in the store")
+    p.add_argument('-b', '--branch', help="Only show this branch")
+
+    p = subparsers.add_parser('regression-report', help="Report regressions between two revisions")
+    p.add_argument('base', help="Base branch, revision or (with --repo) git reference")
+    p.add_argument('target', help="Target branch, revision or (with --repo) git reference")
+    p.add_argument('--repo', help="Repository used to resolve references such as tags")
+
+    args = parser.parse_args()
+
+    dbpath = args.store or utils.getconfig("TESTRESULTS_STORE", utils.loadconfig())
+    if not dbpath:
+        print("No store given and TESTRESULTS_STORE isn't set")
+        return 1
+
+    if args.command == "ingest":
+        start = time.time()
+        files, runs = ingest(dbpath, args.paths)
+        print("Ingested %d runs from %d changed files in %.1fs" % (runs, files, time.time() - start))
+    elif args.command == "revisions":
+        store = TestResultsStore(dbpath)
+        for branch, revision, count, ingested in store.revisions(args.branch):
+            print("%s %-20s %4d runs  %s" % (revision, branch, count, time.strftime("%Y-%m-%d %H:%M", time.localtime(ingested))))
+        store.close()
+    elif args.command == "regression-report":
+        report = regression_report(dbpath, args.base, args.target, args.repo)
+        if report is None:
+            print("No matching results for %s and %s in the store" % (args.base, args.target))
+            return 1
+        sys.stdout.write(report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
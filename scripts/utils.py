@@ -18,6 +18,8 @@ import argparse
 import fnmatch
 import glob
 import fcntl
+import random
+import shlex
 
 
 def is_a_main_branch(reponame, branchname):
@@ -243,6 +245,53 @@ def getbuildhistoryconfig(ourconfig, builddir, target, reponame, branchname, ste
 def runcmd(cmd):
     return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
 
+#
+# Source oe-init-build-env in topdir once and snapshot the resulting
+# environment and working directory, commands are then run directly in it
+# rather than through a shell which sets the environment up again each time.
+# Environments are cached per topdir/BDIR for the lifetime of the process.
+#
+class BuildEnv(object):
+    _cache = {}
+
+    def __init__(self, topdir, env=None, initscript="oe-init-build-env"):
+        self.topdir = os.path.abspath(topdir)
+        env = dict(os.environ if env is None else env)
+        # The environment is dumped as JSON by the same python once set up,
+        # the script's own output goes to stderr so it stays in the logs
+        dump = "import json, os, sys; json.dump([os.getcwd(), dict(os.environ)], sys.stdout)"
+        script = ". ./%s 1>&2 && exec %s -c %s" % (initscript, shlex.quote(sys.executable), shlex.quote(dump))
+        output = subprocess.check_output(["/bin/sh", "-c", script], cwd=self.topdir, env=env)
+        self.cwd, self.env = json.loads(output.decode("utf-8"))
+
+    @classmethod
+    def get(cls, topdir, bdir=None):
+        """Return the cached environment for topdir and build directory bdir"""
+        key = (os.path.abspath(topdir), bdir)
+        if key not in cls._cache:
+            env = dict(os.environ)
+            if bdir:
+                env["BDIR"] = bdir
+            cls._cache[key] = cls(topdir, env)
+        return cls._cache[key]
+
+    def _kwargs(self, kwargs):
+        kwargs.setdefault("cwd", self.cwd)
+        kwargs.setdefault("env", self.env)
+        return kwargs
+
+    def call(self, cmd, **kwargs):
+        return subprocess.call(cmd, **self._kwargs(kwargs))
+
+    def check_call(self, cmd, **kwargs):
+        return subprocess.check_call(cmd, **self._kwargs(kwargs))
+
+    def check_output(self, cmd, **kwargs):
+        return subprocess.check_output(cmd, **self._kwargs(kwargs))
+
+    def Popen(self, cmd, **kwargs):
+        return subprocess.Popen(cmd, **self._kwargs(kwargs))
+
 
 def fetchgitrepo(clonedir, repo, params, stashdir, depth=None):
     sharedrepo = "%s/%s" % (clonedir, repo)
@@ -301,6 +350,227 @@ def flush():
     sys.stdout.flush()
     sys.stderr.flush()
 
+# FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+def reflink(src, dest):
+    """Create dest as a copy-on-write clone of src, raises OSError if unsupported"""
+    with open(src, "rb") as s, open(dest, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dest)
+            raise
+
+def linkorcopy(src, dest, hardlink=True):
+    """
+    Put a copy of src at dest as cheaply as possible: a hardlink (unless
+    hardlink is False, e.g. when src may be rewritten later) or reflink if
+    src and dest are on the same filesystem, otherwise a real copy.
+    Returns the method used.
+    """
+    import shutil
+
+    if os.stat(src).st_dev == os.stat(os.path.dirname(dest)).st_dev:
+        if hardlink:
+            try:
+                os.link(src, dest)
+                return "hardlink"
+            except OSError:
+                pass
+        try:
+            reflink(src, dest)
+            shutil.copystat(src, dest)
+            return "reflink"
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+    return "copy"
+
+def linkorcopytree(src, dest):
+    """
+    linkorcopy() every file below src into dest, replacing existing files.
+    Returns the number of bytes (linked, copied).
+    """
+    linked = copied = 0
+    for root, dirs, files in os.walk(src):
+        destdir = os.path.join(dest, os.path.relpath(root, src))
+        mkdir(destdir)
+        for f in files:
+            target = os.path.join(destdir, f)
+            if os.path.lexists(target):
+                os.unlink(target)
+            if linkorcopy(os.path.join(root, f), target) == "copy":
+                copied += os.path.getsize(target)
+            else:
+                linked += os.path.getsize(target)
+    return linked, copied
+
+#
+# Archive srcdir as arcname into a tarball at dest compressed by a
+# multi-threaded zstd. The sha256 of the compressed output is computed as it
+# is written and saved in sha256sum format to dest.sha256. The archive only
+# appears once complete. Returns (size, sha256).
+#
+def archivedir(srcdir, arcname, dest):
+    import hashlib
+    import tarfile
+    import threading
+
+    tmp = dest + ".tmp"
+    zstd = subprocess.Popen(["zstd", "-T0", "-q", "-c"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    errors = []
+    def writetar():
+        try:
+            with tarfile.open(fileobj=zstd.stdin, mode="w|") as tar:
+                tar.add(srcdir, arcname=arcname)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                zstd.stdin.close()
+            except OSError:
+                pass
+    writer = threading.Thread(target=writetar)
+    writer.start()
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        try:
+            with open(tmp, "wb") as out:
+                for chunk in iter(lambda: zstd.stdout.read(1024 * 1024), b""):
+                    digest.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            # Nothing reads the output any more, stop zstd so that the tar
+            # writer doesn't stay blocked on a full pipe
+            zstd.kill()
+            raise
+        finally:
+            zstd.stdout.close()
+            writer.join()
+            ret = zstd.wait()
+        if errors:
+            raise errors[0]
+        if ret:
+            raise subprocess.CalledProcessError(ret, "zstd")
+        with open(dest + ".sha256", "w") as f:
+            f.write("%s  %s\n" % (digest.hexdigest(), os.path.basename(dest)))
+        os.rename(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return size, digest.hexdigest()
+
+#
+# Trash handling shared by janitor/clobberdir and janitor/ab-janitor
+#
+# Directories are never deleted synchronously. They are renamed into a trash
+# root on the same filesystem (TRASH_DIR where possible, otherwise a
+# per-filesystem .ab-trash directory) and, for anything the janitor wouldn't
+# otherwise know about, a request is written into the trash spool directory.
+#
+def gettrashdirs(ourconfig):
+    trashdir = getconfig("TRASH_DIR", ourconfig)
+    spooldir = getconfig("TRASH_SPOOL_DIR", ourconfig)
+    if trashdir and not spooldir:
+        spooldir = trashdir.rstrip("/") + "-spool"
+    return trashdir, spooldir
+
+def getmountpoint(path):
+    path = os.path.realpath(path)
+    # The mount table also knows about bind mounts, which share the st_dev
+    # of the filesystem they come from
+    try:
+        with open("/proc/self/mounts") as f:
+            mounts = [re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), line.split()[1]) for line in f]
+    except OSError:
+        mounts = []
+    mounts = [m for m in mounts if path == m or path.startswith(m.rstrip("/") + "/")]
+    if mounts:
+        return max(mounts, key=len)
+    dev = os.stat(path).st_dev
+    while path != "/":
+        parent = os.path.dirname(path)
+        if os.stat(parent).st_dev != dev:
+            break
+        path = parent
+    return path
+
+def gettrashroot(path, trashdir, skip=()):
+    path = os.path.realpath(path)
+    dev = os.stat(path).st_dev
+    if trashdir not in skip and os.path.exists(trashdir) and os.stat(trashdir).st_dev == dev:
+        return trashdir
+    for base in [getmountpoint(path), os.path.dirname(path)]:
+        trashroot = os.path.join(base, ".ab-trash")
+        # Never put the trash inside the directory we're removing
+        if base == path or trashroot in skip:
+            continue
+        try:
+            mkdir(trashroot)
+        except OSError:
+            continue
+        if os.stat(trashroot).st_dev == dev:
+            return trashroot
+    return None
+
+def queuetrash(spooldir, reqtype, path):
+    mkdir(spooldir)
+    name = "%s-%s-%s" % (int(time.time()), os.getpid(), random.randrange(100, 100000, 2))
+    tmpname = os.path.join(spooldir, "." + name)
+    with open(tmpname, "w") as f:
+        json.dump({"type" : reqtype, "path" : path}, f)
+    os.rename(tmpname, os.path.join(spooldir, name + ".json"))
+
+def readtrashspool(spooldir):
+    requests = []
+    if not os.path.isdir(spooldir):
+        return requests
+    for name in sorted(os.listdir(spooldir)):
+        if not name.endswith(".json") or name.startswith("."):
+            continue
+        entry = os.path.join(spooldir, name)
+        try:
+            with open(entry) as f:
+                requests.append((entry, json.load(f)))
+        except (OSError, ValueError) as e:
+            print("Ignoring invalid trash spool entry %s: %s" % (entry, str(e)))
+    return requests
+
+def movetotrash(path, trashdir, spooldir):
+    """
+    Move path out of the way on its own filesystem so the janitor can delete
+    it in the background. Returns the location the directory was moved to, or
+    None if it could only be queued for deletion in place (e.g. a mountpoint).
+    """
+    path = os.path.realpath(path)
+    tried = []
+    while True:
+        trashroot = gettrashroot(path, trashdir, tried)
+        if not trashroot:
+            queuetrash(spooldir, "delete", path)
+            return None
+        tried.append(trashroot)
+        trashdest = os.path.join(trashroot, str(int(time.time())) + '-' + str(random.randrange(100, 100000, 2)))
+        mkdir(trashdest)
+        try:
+            os.rename(path, os.path.join(trashdest, os.path.basename(path)))
+            break
+        except OSError as e:
+            os.rmdir(trashdest)
+            # A bind mount has the st_dev of its filesystem but renames
+            # across it still fail, try the next trash root
+            if e.errno != errno.EXDEV:
+                raise
+    if trashroot != trashdir:
+        # Tell the janitor about trash roots other than TRASH_DIR
+        queuetrash(spooldir, "trashroot", trashroot)
+    return trashdest
+
 def printheader(msg, timestamp=True):
     print("")
     print("====================================================================================================")
@@ -424,6 +694,335 @@ def sha256_file(filename):
             pass
     return method.hexdigest()
 
+#
+# Run git ls-remote with the given arguments, the output is cached in
+# cachedir (if given) for ttl seconds so repeated lookups don't hit the
+# network each time.
+#
+def lsremote(args, cachedir=None, ttl=300, cwd=None):
+    import hashlib
+
+    cmd = ["git", "ls-remote"] + args
+    if not cachedir:
+        return subprocess.check_output(cmd, cwd=cwd).decode('utf-8')
+    key = hashlib.sha1(json.dumps([args, cwd]).encode("utf-8")).hexdigest()
+    cachefile = os.path.join(cachedir, key)
+    try:
+        if time.time() - os.stat(cachefile).st_mtime < ttl:
+            with open(cachefile) as f:
+                return f.read()
+    except FileNotFoundError:
+        pass
+    output = subprocess.check_output(cmd, cwd=cwd).decode('utf-8')
+    mkdir(cachedir)
+    tmp = cachefile + ".%d.tmp" % os.getpid()
+    with open(tmp, "w") as f:
+        f.write(output)
+    os.rename(tmp, cachefile)
+    return output
+
+#
+# Git metadata lookups which read refs and packed-refs directly rather than
+# spawning a git process per query. Results are memoized for the lifetime of
+# the process, callers which move HEAD need to call gitcache_clear().
+#
+_gitcache = {}
+_githash_re = re.compile(r"^[0-9a-f]{40}([0-9a-f]{24})?$")
+
+def gitcache_clear():
+    _gitcache.clear()
+
+def _gitmemo(key, func):
+    if key not in _gitcache:
+        _gitcache[key] = func()
+    return _gitcache[key]
+
+def gitdirs(repodir):
+    """Return the git directory and common directory (shared by worktrees) of a repository"""
+    gitdir = os.path.join(repodir, ".git")
+    if os.path.isfile(gitdir):
+        with open(gitdir) as f:
+            line = f.read().strip()
+        if line.startswith("gitdir: "):
+            gitdir = os.path.join(repodir, line[len("gitdir: "):])
+    elif not os.path.isdir(gitdir):
+        # Bare repository
+        gitdir = repodir
+    commondir = gitdir
+    try:
+        with open(os.path.join(gitdir, "commondir")) as f:
+            commondir = os.path.join(gitdir, f.read().strip())
+    except FileNotFoundError:
+        pass
+    return os.path.normpath(gitdir), os.path.normpath(commondir)
+
+def packedrefs(commondir):
+    """Return {ref: hash} from packed-refs, peeled tag lines are skipped"""
+    def read():
+        refs = {}
+        try:
+            with open(os.path.join(commondir, "packed-refs")) as f:
+                for line in f:
+                    if line.startswith(("#", "^")):
+                        continue
+                    fields = line.split()
+                    if len(fields) == 2:
+                        refs[fields[1]] = fields[0]
+        except FileNotFoundError:
+            pass
+        return refs
+    return _gitmemo(("packed-refs", commondir), read)
+
+def readref(repodir, ref="HEAD"):
+    """
+    Resolve ref (HEAD or a full refs/ name) to a hash from the files in the
+    git directory, following symbolic refs. Returns None if it can't be
+    resolved that way, e.g. for reftable repositories.
+    """
+    gitdir, commondir = gitdirs(repodir)
+    if os.path.exists(os.path.join(commondir, "reftable")):
+        return None
+    for _ in range(5):
+        value = None
+        # HEAD and other pseudo refs are per worktree, refs/ are shared
+        for d in ([gitdir] if not ref.startswith("refs/") else []) + [commondir]:
+            try:
+                with open(os.path.join(d, ref)) as f:
+                    value = f.read().strip()
+                break
+            except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                continue
+        if value is None:
+            value = packedrefs(commondir).get(ref)
+        if value is None:
+            return None
+        if value.startswith("ref: "):
+            ref = value[len("ref: "):]
+            continue
+        if _githash_re.match(value):
+            return value
+        return None
+    return None
+
+def githead(repodir):
+    """Return the revision checked out in repodir"""
+    def resolve():
+        revision = readref(repodir)
+        if not revision:
+            revision = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repodir).decode('utf-8').strip()
+        return revision
+    return _gitmemo(("HEAD", os.path.abspath(repodir)), resolve)
+
+def githeads(repodirs, jobs=8):
+    """Return {repodir: revision} for several repositories, resolved concurrently"""
+    import concurrent.futures
+
+    repodirs = list(repodirs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(repodirs, executor.map(githead, repodirs)))
+
+def gitdescribe(repodir):
+    """Return the most recent tag reachable from HEAD (git describe --abbrev=0)"""
+    def resolve():
+        return subprocess.check_output(["git", "describe", "--abbrev=0"], cwd=repodir).decode('utf-8').strip()
+    return _gitmemo(("describe", os.path.abspath(repodir)), resolve)
+
+#
+# Minimal streaming JSON reader which can pull a value out of a large
+# document without parsing (or even reading) all of it. Values which are
+# not on the path being searched are skipped with a regex scan rather than
+# decoded.
+#
+class JSONStreamReader(object):
+    string_re = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+    struct_re = re.compile(r'[{}\[\]"]')
+    ws_re = re.compile(r'[ \t\n\r]*')
+
+    class NotFound(Exception):
+        pass
+
+    def __init__(self, f, chunksize=65536):
+        self.f = f
+        self.chunksize = chunksize
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        # Drop what has been consumed so memory stays bounded
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunksize)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def peek(self):
+        while True:
+            self.pos = self.ws_re.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of JSON data")
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("Expected one of '%s' at '%s'" % (chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may continue in the next
+                # chunk, only trust it when followed by a delimiter
+                if self.eof or (end < len(self.buf) and self.buf[end] in " \t\n\r,:]}"):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def skip_value(self):
+        c = self.peek()
+        if c not in '{["':
+            self.read_value()
+            return
+        depth = 0
+        while True:
+            m = self.struct_re.search(self.buf, self.pos)
+            if not m:
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError("Unexpected end of JSON data")
+                continue
+            c = m.group()
+            if c == '"':
+                # A match always ends at the closing quote, no match means
+                # the string continues in the next chunk
+                self.pos = m.start()
+                s = self.string_re.match(self.buf, self.pos)
+                if not s:
+                    if not self.fill():
+                        raise ValueError("Unterminated JSON string")
+                    continue
+                self.pos = s.end()
+            elif c in "{[":
+                depth += 1
+                self.pos = m.end()
+            else:
+                depth -= 1
+                self.pos = m.end()
+            if depth == 0:
+                return
+
+    def items(self):
+        """
+        Iterate over the keys of the object at the current position, the
+        caller must consume each value (read_value, skip_value, ...) before
+        asking for the next key.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError("Expected an object key")
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def elements(self):
+        """Iterate over the array at the current position, the caller must consume each element"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(",]") == "]":
+                return
+
+    def find(self, path):
+        """
+        Return the first value at path, a list of object keys where None
+        matches any key, consuming only the document up to that value.
+        Raises JSONStreamReader.NotFound if there is no such value.
+        """
+        if not path:
+            return self.read_value()
+        if self.peek() != "{":
+            self.skip_value()
+            raise self.NotFound()
+        self.pos += 1
+        if self.peek() == "}":
+            self.pos += 1
+            raise self.NotFound()
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError("Expected an object key")
+            self.expect(":")
+            if path[0] is None or key == path[0]:
+                try:
+                    return self.find(path[1:])
+                except self.NotFound:
+                    pass
+            else:
+                self.skip_value()
+            if self.expect(",}") == "}":
+                raise self.NotFound()
+
+def json_find(filename, path):
+    """
+    Return the first value in the JSON file matching path (see
+    JSONStreamReader.find()), reading as little of the file as possible.
+    Raises KeyError if there is no such value and ValueError if the file
+    isn't valid JSON, callers can then fall back to a full parse.
+    """
+    with open(filename, "r") as f:
+        try:
+            return JSONStreamReader(f).find(path)
+        except JSONStreamReader.NotFound:
+            raise KeyError(path)
+
+def cvesummary_packages(filename):
+    """
+    Stream the packages of a cve-check cve-summary.json, yielding
+    (package name, [(CVE id, status), ...]) without loading the whole file
+    or keeping any of the other issue fields.
+    """
+    with open(filename, "r") as f:
+        reader = JSONStreamReader(f)
+        for key in reader.items():
+            if key != "package":
+                reader.skip_value()
+                continue
+            for _ in reader.elements():
+                # Packages without a name still sort with the others
+                name = ""
+                issues = []
+                for key in reader.items():
+                    if key == "name":
+                        name = reader.read_value()
+                    elif key == "issue":
+                        for _ in reader.elements():
+                            issue = reader.read_value()
+                            issues.append((issue['id'], issue['status']))
+                    else:
+                        reader.skip_value()
+                yield name, issues
+
 def enable_tools_tarball(btdir, name):
     btenv = glob.glob(btdir + "/environment-setup*")
     print("Using %s %s" % (name, btenv))